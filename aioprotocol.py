@@ -0,0 +1,592 @@
+"""
+asyncio backend: the same Server and command table, served by an asyncio.Protocol.
+
+Each connection feeds a RespParser from data_received() and answers every complete
+request in that chunk with one transport.write(), so a pipelined batch costs one
+send. There is no client cap. uvloop is used when it is installed.
+
+    server = AsyncServer('127.0.0.1', 31337)
+    asyncio.run(server.serve())
+
+AsyncClient keeps one connection per client and multiplexes every caller onto it:
+requests issued in the same loop iteration go out in one write, and replies come back
+in order to the futures waiting for them.
+
+    client = AsyncClient()
+    await client.set('a', 1)
+    replies = await client.pipeline().get('a').llen('q').execute()
+"""
+import asyncio
+import logging
+from collections import deque
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from protocol import (Server, Client, ProtocolHandler, RespParser, NEED_MORE, CommandError, Error,
+                      Transaction, WatchError, PUSHED, PubSub)
+from pubsub import Subscriber
+from streams import formatid
+
+
+def install_uvloop():
+    """Use uvloop's event loop for new loops if it is installed. Returns True if so."""
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class _Waiter(object):
+    """BlockedClient.wakeup for the loop: Server._serveblocked() sets it, a coroutine awaits it."""
+    def __init__(self, loop):
+        self.future = loop.create_future()
+
+    def is_set(self):
+        return self.future.done()
+
+    def set(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class RespProtocol(asyncio.Protocol):
+    """One client connection of an AsyncServer."""
+    def __init__(self, server):
+        self._server = server
+        self._protocol = server._protocol
+        self._parser = RespParser()
+        self._transport = None
+        self._address = None
+        self._blocked = None    # task running a blocking command; later requests wait for it.
+        self._transaction = Transaction()
+        self._subscriber = Subscriber(self._push)
+        self._replies = None    # the batch _process() is encoding; pushes made meanwhile join it.
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._address = transport.get_extra_info('peername')
+        logging.info(f'Connection received from: {self._address}')
+        self._server._connectedclients += 1
+        self._server._totalconnections += 1
+
+    def connection_lost(self, exc):
+        logging.info(f'Client went away: {self._address}')
+        self._server._connectedclients -= 1
+        if self._blocked is not None:
+            self._blocked.cancel()
+        self._server._unwatch(self._transaction)
+        self._server._unsubscribeall(self._subscriber)
+        self._server._forgetclient(self._subscriber)
+        if self._server._backlog is not None:
+            self._server._backlog.replicas.pop(self._subscriber, None)
+        self._transport = None
+
+    # Stop reading while the socket's send buffer is full: a client that pipelines
+    # without reading its replies can't make the server buffer them without bound.
+    def pause_writing(self):
+        self._transport.pause_reading()
+
+    def resume_writing(self):
+        self._transport.resume_reading()
+
+    def data_received(self, data):
+        self._parser.feed(data)
+        if self._blocked is None:
+            self._process()
+
+    def _process(self):
+        buf = self._replies = bytearray()
+        try:
+            self._processframes(buf)
+        finally:
+            self._replies = None
+        self._send(buf)
+
+    def _processframes(self, buf):
+        server = self._server
+        while self._transport is not None:
+            try:
+                frame = self._parser.gets()
+            except (CommandError, ValueError) as err:
+                logging.warning(f'Protocol error from {self._address}: {err}')
+                self._protocol._write(buf, Error(f"Protocol error. {err}"))
+                self._send(buf)
+                buf.clear()
+                self._transport.close()
+                return
+            if frame is NEED_MORE:
+                break
+            if (isinstance(frame, list) and frame and frame[0] in server.BLOCKING_COMMANDS
+                    and self._transaction.queued is None and not self._subscriber):
+                # Replies stay in order: send what is ready, answer this one when it
+                # unblocks, then carry on with whatever arrived meanwhile.
+                self._blocked = asyncio.ensure_future(self._block(frame))
+                return
+            self._encode(buf, server._execute(self._transaction, frame, subscriber=self._subscriber))
+
+    async def _block(self, frame):
+        resp = await self._server._blockingreply(frame)
+        self._blocked = None
+        if self._transport is None:
+            return
+        buf = bytearray()
+        self._encode(buf, resp)
+        self._send(buf)
+        self._process()
+
+    def _encode(self, buf, resp):
+        if resp is PUSHED:
+            return
+        start = len(buf)
+        try:
+            self._protocol._write(buf, resp)
+        except CommandError as exc:
+            del buf[start:]     # never leave half a reply in the stream.
+            self._protocol._write(buf, Error(exc.args[0]))
+
+    def _push(self, data, limit=None):
+        """Subscriber.push(): data is shared by every receiver of the message."""
+        transport = self._transport
+        if transport is None:
+            return
+        if self._replies is not None:
+            self._replies += data   # our own (un)subscribe reply: keep it in order.
+            return
+        transport.write(data)
+        if transport.get_write_buffer_size() > (limit or self._server._pubsublimit):
+            logging.warning(f'Closing {self._address}: it fell too far behind on its output')
+            transport.abort()
+
+    def _send(self, buf):
+        if buf and self._transport is not None:
+            if self._server._aof is not None:
+                self._server._aof.flush()   # replies never go out before their writes reach the log.
+            self._transport.write(bytes(buf))
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(bytes(buf).decode('utf-8', 'replace'))
+
+
+class AsyncServer(Server):
+    """A Server driven by an asyncio event loop instead of gevent.
+
+    Commands run on the loop thread, so they never race each other; active expiry is
+    a loop callback rather than a thread. BLPOP/BRPOP/BGET register in the same
+    blocked-client registry as the gevent backend and await a future instead of an Event.
+    """
+    BACKEND = 'asyncio'
+
+    def __init__(self, host='127.0.0.1', port=31337, **kwargs):
+        kwargs.setdefault('ttlthread', False)
+        self._loop = None
+        super(AsyncServer, self).__init__(host, port, **kwargs)
+        self.host = host
+        self.port = port
+        self._aioserver = None
+        self._expirehandle = None
+
+    async def start(self, sock=None):
+        loop = asyncio.get_running_loop()
+        if sock is not None:
+            self._aioserver = await loop.create_server(lambda: RespProtocol(self), sock=sock)
+        else:
+            self._aioserver = await loop.create_server(lambda: RespProtocol(self), self.host, self.port)
+        self._loop = loop
+        if self._primary is not None:
+            self._primary.start()   # REPLICAOF given to the constructor, before there was a loop.
+        self._expirecycle()
+        return self._aioserver
+
+    def close(self):
+        if self._primary is not None:
+            self._primary.stop()
+        if self._expirehandle is not None:
+            self._expirehandle.cancel()
+            self._expirehandle = None
+        if self._aioserver is not None:
+            self._aioserver.close()
+
+    async def serve(self, sock=None):
+        await self.start(sock)
+        try:
+            await self._aioserver.serve_forever()
+        finally:
+            self.close()
+
+    def run(self):
+        install_uvloop()
+        asyncio.run(self.serve())
+
+    # PrimaryLink and the waits for forked children run in threads; what they find is
+    # handed to the loop, which runs every command.
+    def _startlink(self):
+        if self._loop is not None:
+            self._primary.start()
+
+    def _callsoon(self, func, *args):
+        self._loop.call_soon_threadsafe(func, *args)
+
+    def _startlazyfree(self):
+        if self._loop is None:  # still loading, before start(): nobody is waiting yet.
+            while self._lazyfreer.free(self.LAZYFREE_BUDGET):
+                pass
+            self._lazyfreeing = False
+        else:
+            self._loop.call_soon(self._lazyfreecycle)
+
+    def _lazyfreecycle(self):
+        # One chunk per turn of the loop, after the callbacks that are ready.
+        if self._lazyfreer.free(self.LAZYFREE_BUDGET):
+            self._loop.call_soon(self._lazyfreecycle)
+        else:
+            self._lazyfreeing = False
+
+    def _expirecycle(self):
+        loop = asyncio.get_running_loop()
+        if self._expirehandle is not None:
+            # Run this late past its timer: a callback held the loop that long.
+            self._latencymonitor.add('event-loop', (loop.time() - self._expirehandle.when()) * 1000)
+        wait = self._activeexpire()
+        if wait == 0:
+            wait = self.ACTIVE_EXPIRE_PERIOD - self.ACTIVE_EXPIRE_BUDGET
+        self._expirehandle = loop.call_later(wait, self._expirecycle)
+
+    async def _blockingreply(self, data):
+        """Server._blockingcommand() for the loop: a disconnect cancels the task, and unregisters."""
+        self._commandsprocessed += 1
+        command = data[0]
+        if command in self.STREAM_READ_COMMANDS:
+            return await self._streamreadreply(command, data[1:])
+        try:
+            keys, timeout, move = self._blockingargs(command, data[1:])
+            if move is not None and not self._islist(move[0]):
+                raise CommandError('WRONGTYPE destination holds a value that is not a list')
+        except CommandError as exc:
+            return Error(exc.args[0])
+        ready = self._takeready(command, keys, move)
+        if ready is not None:
+            key, value, logged = ready
+            if logged is not None:
+                self._snapshot.changes += 1
+                self._propagate(logged)
+                self._servemoved(move)
+                if self._handoffs:
+                    self._flushhandoffs()   # clients a BLMOVE destination woke up.
+            return self._blockingresult(keys, key, value)
+
+        waiter = _Waiter(asyncio.get_running_loop())
+        client = self._block(command, keys, waiter, move)
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._unblock(client)
+        return self._blockingresult(keys, client.key, client.value)
+
+    async def _streamreadreply(self, command, args):
+        """Server._streamread() for the loop."""
+        try:
+            # get_response() refuses XREADGROUP on a replica; this path skips it.
+            if command == 'XREADGROUP' and self._primary is not None:
+                raise CommandError(self.READONLY_ERROR)
+            read = self._streamreadargs(command, args)
+            result = self._streamready(read)
+        except CommandError as exc:
+            return Error(exc.args[0])
+        if read.group is not None:
+            self._snapshot.changes += 1
+            self._propagate(self._readgroupcommand(
+                read, read.keys, ['>' if sid is None else formatid(sid) for sid in read.ids], read.count))
+        if result is not None or read.block is None:
+            return result
+
+        waiter = _Waiter(asyncio.get_running_loop())
+        client = self._block(command, read.keys, waiter, read)
+        try:
+            await asyncio.wait_for(waiter.future, read.block or None)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._unblock(client)
+        return client.value
+
+
+class _AsyncConnection(object):
+    """One stream to the server shared by every caller: replies resolve futures FIFO."""
+    def __init__(self, host, port, protocol, unixsocket=None):
+        self.host = host
+        self.port = port
+        self.unixsocket = unixsocket
+        self._protocol = protocol
+        self._reader = None
+        self._writer = None
+        self._readtask = None
+        self._connecting = None
+        self._pending = deque()
+        self._buf = bytearray()
+        self._flushscheduled = False
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open())
+        try:
+            await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _open(self):
+        if self.unixsocket:
+            reader, writer = await asyncio.open_unix_connection(self.unixsocket)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        self._reader, self._writer = reader, writer
+        self._readtask = asyncio.ensure_future(self._readreplies())
+
+    async def _readreplies(self):
+        parser = RespParser()
+        try:
+            while True:
+                chunk = await self._reader.read(65536)
+                if not chunk:
+                    raise ConnectionResetError('server closed the connection')
+                parser.feed(chunk)
+                frame = parser.gets()
+                while frame is not NEED_MORE:
+                    future = self._pending.popleft()
+                    if not future.done():
+                        future.set_result(frame)
+                    frame = parser.gets()
+        except (OSError, CommandError, ValueError) as err:
+            self._fail(err if isinstance(err, OSError) else ConnectionError(f"bad reply: {err}"))
+        except asyncio.CancelledError:
+            self._fail(ConnectionResetError('connection closed'))
+            raise
+
+    def _fail(self, err):
+        pending, self._pending = self._pending, deque()
+        for future in pending:
+            if not future.done():
+                future.set_exception(err)
+        writer, self._writer, self._reader = self._writer, None, None
+        self._buf.clear()
+        if writer is not None:
+            writer.close()
+
+    async def request(self, commands):
+        """Queue commands for the next write; returns their replies in order."""
+        await self.connect()
+        loop = asyncio.get_running_loop()
+        start = len(self._buf)
+        try:
+            for args in commands:
+                self._protocol._write(self._buf, args)
+        except CommandError:
+            del self._buf[start:]   # an argument we cannot encode; send nothing.
+            raise
+        futures = [loop.create_future() for _ in commands]
+        self._pending.extend(futures)
+        if not self._flushscheduled:
+            # Everything requested in this loop iteration goes out in one write.
+            self._flushscheduled = True
+            loop.call_soon(self._flush)
+        return await asyncio.gather(*futures)
+
+    def _flush(self):
+        self._flushscheduled = False
+        if self._buf and self._writer is not None:
+            self._writer.write(bytes(self._buf))
+            self._buf.clear()
+
+    async def close(self):
+        if self._readtask is not None:
+            self._readtask.cancel()
+            self._readtask = None
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class AsyncClient(Client):
+    """Client for asyncio code: every command method returns an awaitable.
+
+    Blocking commands get a connection of their own for the length of the call, so a
+    parked BLPOP never holds up the replies of other callers.
+    """
+    cache = None    # no client-side cache: GET/MGET always go to the server.
+
+    def __init__(self, host='127.0.0.1', port=31337, unixsocket=None):
+        self.host = host
+        self.port = port
+        self.unixsocket = unixsocket
+        self._protocol = ProtocolHandler()
+        self._connection = _AsyncConnection(host, port, self._protocol, unixsocket)
+        self.info = f"Connected to {unixsocket or f'{host}:{port}'}"
+
+    async def close(self):
+        await self._connection.close()
+
+    async def _request(self, commands):
+        if any(args and args[0] in Server.BLOCKING_COMMANDS for args in commands):
+            connection = _AsyncConnection(self.host, self.port, self._protocol, self.unixsocket)
+            try:
+                return await connection.request(commands)
+            finally:
+                await connection.close()
+        return await self._connection.request(commands)
+
+    async def execute(self, *args):
+        resp = (await self._request([args]))[0]
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+        return resp
+
+    def pipeline(self, transaction=False):
+        return AsyncPipeline(self, transaction)
+
+    def pubsub(self):
+        return AsyncPubSub(self)
+
+    async def scan_iter(self, match=None, count=None, _type=None):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await self.scan(cursor or 0, match, count, _type)
+            for key in keys:
+                yield key
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncPipeline(AsyncClient):
+    """Queue commands and send them in one write; `await pipeline.execute()` sends them.
+
+    transaction=True wraps them in MULTI/EXEC. The batch is written contiguously, so
+    other callers sharing the connection can't land inside it. WATCH needs a
+    connection of its own and isn't offered here; use the blocking Client for it.
+    """
+    def __init__(self, client, transaction=False):
+        self.host = client.host
+        self.port = client.port
+        self.unixsocket = client.unixsocket
+        self._protocol = client._protocol
+        self._connection = client._connection
+        self.info = client.info
+        self.transaction = transaction
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def execute(self, *args, raise_on_error=True):
+        if args:
+            self._commands.append(args)
+            return self
+        commands, self._commands = self._commands, []
+        return self._send(commands, raise_on_error)
+
+    async def _send(self, commands, raise_on_error):
+        if not commands:
+            return []
+        if self.transaction:
+            replies = await self._request([('MULTI',)] + commands + [('EXEC',)])
+            for resp in replies[1:-1]:
+                if isinstance(resp, Error):
+                    raise CommandError(resp.message)
+            replies = replies[-1]
+            if isinstance(replies, Error):
+                raise CommandError(replies.message)
+            if replies is None:
+                raise WatchError('Watched key changed; transaction not executed')
+        else:
+            replies = await self._request(commands)
+        if raise_on_error:
+            for resp in replies:
+                if isinstance(resp, Error):
+                    raise CommandError(resp.message)
+        return [CommandError(resp.message) if isinstance(resp, Error) else resp for resp in replies]
+
+
+class AsyncPubSub(object):
+    """Client.pubsub() for asyncio: a connection of its own; await get_message() for what arrives."""
+    def __init__(self, client):
+        self.host = client.host
+        self.port = client.port
+        self.unixsocket = client.unixsocket
+        self._protocol = client._protocol
+        self._parser = RespParser()
+        self._reader = None
+        self._writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def execute(self, *args):
+        """Send a command; its replies arrive through get_message()."""
+        if self._writer is None:
+            if self.unixsocket:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.unixsocket)
+            else:
+                self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._parser = RespParser()
+        buf = bytearray()
+        self._protocol._write(buf, args)
+        self._writer.write(bytes(buf))
+        await self._writer.drain()
+
+    async def subscribe(self, *channels):
+        await self.execute('SUBSCRIBE', *channels)
+
+    async def psubscribe(self, *patterns):
+        await self.execute('PSUBSCRIBE', *patterns)
+
+    async def unsubscribe(self, *channels):
+        await self.execute('UNSUBSCRIBE', *channels)
+
+    async def punsubscribe(self, *patterns):
+        await self.execute('PUNSUBSCRIBE', *patterns)
+
+    async def get_message(self, timeout=None):
+        """The next message as PubSub.message() makes it, or None after timeout seconds."""
+        frame = self._parser.gets()
+        while frame is NEED_MORE:
+            if self._reader is None:
+                raise ConnectionError('not subscribed')
+            try:
+                chunk = await asyncio.wait_for(self._reader.read(65536), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if not chunk:
+                await self.close()
+                raise ConnectionResetError('server closed the connection')
+            self._parser.feed(chunk)
+            frame = self._parser.gets()
+        return PubSub.message(frame)
+
+    async def listen(self):
+        while True:
+            yield await self.get_message()
@@ -1,60 +1,326 @@
 """
-Test the server
+Load generator in the spirit of redis-benchmark.
+
+Each of --processes processes opens -c connections and drives them all from one
+selector loop, keeping -P requests in flight on every connection. Requests are
+pre-encoded templates with only the key index filled in, so the client spends
+its time on the network and not on encoding. Latency is taken per request, from
+the write of its pipeline batch to its reply, into latency.Histogram (so the
+percentiles are within ~3%), and the processes' histograms are merged.
+
+    python client-benchmark.py -t set,get -n 200000 -c 50 --processes 4 -P 16
+    python client-benchmark.py --mix get=8,set=2 -r 100000 -d 128
+    python client-benchmark.py --json > v0.3.json
+    python client-benchmark.py --compare v0.3.json --tolerance 0.1   # exits 1 on a regression
+
+Keys are key:<12 digits> and mylist:<12 digits> for i < -r, visited round robin,
+so every key gets the same load. GET/MGET run against keys SET beforehand, and
+the lists LPOP/BLPOP use are filled beforehand so BLPOP never waits.
 """
-import concurrent.futures
-import sys, logging
 import argparse
+import csv
+import json
+import math
 import multiprocessing
+import random
+import selectors
+import socket
+import sys
 import time
+from collections import deque
 
-from protocol import Client, CommandError
+from latency import Histogram
+from protocol import Client, ProtocolHandler, RespParser, Error, NEED_MORE
 
-globalclient = Client()
+TESTS = ('SET', 'GET', 'MGET', 'LPUSH', 'LPOP', 'BLPOP')
+POP_COMMANDS = {'LPOP', 'BLPOP'}
+_KEY = 'key:\x00'     # placeholder for the key index in a template.
+_LIST = 'mylist:\x00'
 
-class Process(multiprocessing.Process):
-    def __init__(self):
-        super(Process, self).__init__()
 
+def template(command, value, mgetkeys):
+    """The encoded request, as bytes to format with key indexes (b'%012d' per key)."""
+    if command == 'SET':
+        args = ('SET', _KEY, value)
+    elif command == 'GET':
+        args = ('GET', _KEY)
+    elif command == 'MGET':
+        args = ('MGET',) + (_KEY,) * mgetkeys
+    elif command == 'LPUSH':
+        args = ('LPUSH', _LIST, value)
+    elif command == 'LPOP':
+        args = ('LPOP', _LIST)
+    else:
+        args = ('BLPOP', _LIST, 1)
+    buf = bytearray()
+    ProtocolHandler()._write(buf, list(args))
+    # The placeholder encodes to 1 byte; the 12 digits replacing it change the length prefix.
+    encoded = bytes(buf).replace(b'%', b'%%')
+    for name in (b'key:', b'mylist:'):
+        encoded = encoded.replace(b'$%d\r\n%s\x00' % (len(name) + 1, name), b'$%d\r\n%s%%012d' % (len(name) + 12, name))
+    return encoded, len(args) - 1 if command == 'MGET' else 1
 
-    def run(self):
-        globalclient.set('foo', 'bar')
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+class BenchConnection(object):
+    """One benchmark connection: its socket, parser, and the batch in flight."""
+    __slots__ = ('sock', 'parser', 'out', 'pending', 'sent')
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-t", help="commands to test")
-    parser.add_argument("-r", help="key space")
-    parser.add_argument("-n", help='repeat', default=50)
-    args = parser.parse_args()
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.parser = RespParser()
+        self.out = b''
+        self.pending = deque()  # commands of the batch in flight, in order.
+        self.sent = 0       # perf_counter_ns() when the batch was written.
+
+
+def drive(address, schedule, templates, requests, connections, pipeline, keyspace, offset, barrier, results):
+    """Run requests requests over connections connections; put (histograms, errors, start, end)."""
+    conns = [BenchConnection(address) for _ in range(connections)]
+    selector = selectors.DefaultSelector()
+    histograms = {command: Histogram() for command in set(schedule)}
+    errors = 0
+    seq = 0
+    left = requests
+
+    def send(conn):
+        nonlocal seq, left
+        size = min(pipeline, left)
+        left -= size
+        parts = []
+        for _ in range(size):
+            command = schedule[seq % len(schedule)]
+            encoded, nkeys = templates[command]
+            key = (offset + seq) % keyspace
+            seq += 1
+            parts.append(encoded % (key if nkeys == 1 else tuple((key + i) % keyspace for i in range(nkeys))))
+            conn.pending.append(command)
+        conn.out = b''.join(parts)
+        conn.sent = time.perf_counter_ns()
+        write(conn)
+
+    def write(conn):
+        try:
+            n = conn.sock.send(conn.out)
+        except BlockingIOError:
+            n = 0
+        conn.out = conn.out[n:]
+        selector.modify(conn.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.out else 0), conn)
+
+    for conn in conns:
+        selector.register(conn.sock, selectors.EVENT_READ, conn)
+    barrier.wait()
+    start = time.monotonic()
+    for conn in conns:
+        if left:
+            send(conn)
+    busy = sum(1 for conn in conns if conn.pending)
+    while busy:
+        for key, events in selector.select():
+            conn = key.data
+            if events & selectors.EVENT_WRITE and conn.out:
+                write(conn)
+            if not events & selectors.EVENT_READ:
+                continue
+            data = conn.sock.recv(1 << 16)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            conn.parser.feed(data)
+            now = time.perf_counter_ns()
+            while conn.pending:
+                reply = conn.parser.gets()
+                if reply is NEED_MORE:
+                    break
+                if type(reply) is Error:
+                    errors += 1
+                histograms[conn.pending.popleft()].record(now - conn.sent)
+            if not conn.pending:
+                if left:
+                    send(conn)
+                else:
+                    busy -= 1
+    end = time.monotonic()
+    for conn in conns:
+        conn.sock.close()
+    results.put((histograms, errors, start, end))
 
 
+def prefill(client, schedule, args):
+    """SET the keys GET/MGET read, and fill the lists LPOP/BLPOP take from. Not timed."""
+    commands = set(schedule)
+    batch = 1000
+    if commands & {'GET', 'MGET'}:
+        for first in range(0, args.r, batch):
+            p = client.pipeline()
+            for i in range(first, min(first + batch, args.r)):
+                p.set('key:%012d' % i, 'x' * args.d)
+            p.execute()
+    if commands & POP_COMMANDS:
+        # Round robin hands each list at most this many pops, whichever process they come from.
+        depth = math.ceil(args.n / args.r) + args.processes
+        values = ['x' * args.d] * depth
+        for first in range(0, args.r, batch):
+            p = client.pipeline()
+            for i in range(first, min(first + batch, args.r)):
+                p.delete('mylist:%012d' % i)
+                p.lpush('mylist:%012d' % i, *values)
+            p.execute()
 
-    p = Process()
-    p.start()
-    p.join()
 
-    logging.info("Start")
-    starttime = time.time()
+def run(name, schedule, args):
+    templates = {command: template(command, 'x' * args.d, args.mget_keys) for command in set(schedule)}
+    prefill(Client(args.host, args.p, poolnum=1), schedule, args)
+    share, extra = divmod(args.n, args.processes)
+    barrier = multiprocessing.Barrier(args.processes)
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(args.processes):
+        requests = share + (i < extra)
+        offset = i * (args.r // args.processes)
+        processes.append(multiprocessing.Process(target=drive, args=(
+            (args.host, args.p), schedule, templates, requests, args.c, args.P, args.r, offset, barrier, results)))
+    for p in processes:
+        p.start()
+    gathered = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    histograms = {}
+    for parts, _, _, _ in gathered:
+        for command, histogram in parts.items():
+            histograms[command] = histograms[command].merge(histogram) if command in histograms else histogram
+    seconds = max(end for _, _, _, end in gathered) - min(start for _, _, start, _ in gathered)
+    return summary(name, histograms, sum(errors for _, errors, _, _ in gathered), seconds, args)
 
 
-    logging.info("Start parallel threadpool executor:")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        f = [executor.submit(globalclient.set, f"foo{i}", "bar") for i in range(int(args.n))]
-        executor.shutdown(wait=True)
+def latencies(histogram):
+    """Milliseconds: avg, min, p50, p95, p99, p99.9, max (the last five to bucket precision)."""
+    return {'avg': round(histogram.total / histogram.count / 1e6, 3) if histogram.count else 0,
+            'min': round(histogram.percentile(0) / 1e6, 3),
+            'p50': round(histogram.percentile(50) / 1e6, 3),
+            'p95': round(histogram.percentile(95) / 1e6, 3),
+            'p99': round(histogram.percentile(99) / 1e6, 3),
+            'p999': round(histogram.percentile(99.9) / 1e6, 3),
+            'max': round(histogram.percentile(100) / 1e6, 3)}
 
-    # logging.info("Start the old way in serial:")
-    # for i in range(int(args.n)):
-    #     globalclient.set("foo", "bar")      #2.3 for 10,000 set request.
 
+def summary(name, histograms, errors, seconds, args):
+    overall = Histogram()
+    for histogram in histograms.values():
+        overall.merge(histogram)
+    result = {'test': name, 'requests': overall.count, 'errors': errors, 'seconds': round(seconds, 3),
+              'rps': round(overall.count / seconds, 2), 'latency_ms': latencies(overall)}
+    if len(histograms) > 1:
+        result['commands'] = {command: {'requests': histogram.count, 'latency_ms': latencies(histogram)}
+                              for command, histogram in sorted(histograms.items())}
+    return result
 
-    globalclient.close()
-    endtime = time.time()
-    logging.info("Done!")
-    print(f"""======SET====
-    {args.n} requests completed in {endtime-starttime} seconds
-    50 parallel clients
 
-    """)
+def parsemix(mix):
+    """'get=8,set=2' -> a shuffled schedule of 8 GETs and 2 SETs (same order on every run)."""
+    schedule = []
+    for part in mix.split(','):
+        command, _, weight = part.partition('=')
+        command = command.strip().upper()
+        if command not in TESTS:
+            raise ValueError(f"unknown command {command} in --mix")
+        schedule += [command] * int(weight or 1)
+    random.Random(0).shuffle(schedule)
+    return schedule
+
+
+def report(result, args):
+    lat = result['latency_ms']
+    if args.q:
+        print(f"{result['test']}: {result['rps']:.2f} requests per second, p50={lat['p50']:.3f} msec")
+        return
+    print(f"====== {result['test']} ======")
+    print(f"  {result['requests']} requests completed in {result['seconds']:.2f} seconds")
+    print(f"  {args.c * args.processes} parallel clients ({args.processes} processes x {args.c} connections)")
+    print(f"  {args.d} bytes payload, pipeline {args.P}, keyspace {args.r}")
+    if result['errors']:
+        print(f"  {result['errors']} error replies")
+    print(f"  {result['rps']:.2f} requests per second")
+    print("  latency (msec): " + " ".join(f"{k}={v:.3f}" for k, v in lat.items()))
+    for command, stats in result.get('commands', {}).items():
+        print(f"    {command:<6} {stats['requests']:>9} requests  "
+              + " ".join(f"{k}={v:.3f}" for k, v in stats['latency_ms'].items()))
+    print()
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """Print each test against the baseline run; False if one got slower by more than tolerance."""
+    before = {result['test']: result for result in baseline['tests']}
+    ok = True
+    print(f"{'test':<24} {'rps':>12} {'baseline':>12} {'p99 ms':>9} {'baseline':>9}", file=out)
+    for result in results:
+        old = before.get(result['test'])
+        if old is None:
+            continue
+        regressed = (result['rps'] < old['rps'] * (1 - tolerance)
+                     or result['latency_ms']['p99'] > old['latency_ms']['p99'] * (1 + tolerance))
+        ok = ok and not regressed
+        print(f"{result['test']:<24} {result['rps']:>12.2f} {old['rps']:>12.2f} "
+              f"{result['latency_ms']['p99']:>9.3f} {old['latency_ms']['p99']:>9.3f}{'  REGRESSION' if regressed else ''}", file=out)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--help", action="help")
+    parser.add_argument("-h", "--host", default='127.0.0.1')
+    parser.add_argument("-p", help="port", type=int, default=31337)
+    parser.add_argument("-c", help="connections per process", type=int, default=50)
+    parser.add_argument("--processes", help="client processes", type=int, default=1)
+    parser.add_argument("-n", help="requests per test", type=int, default=100000)
+    parser.add_argument("-P", help="pipeline depth: requests in flight per connection", type=int, default=1)
+    parser.add_argument("-d", help="value size in bytes", type=int, default=16)
+    parser.add_argument("-r", help="keyspace: number of distinct keys", type=int, default=10000)
+    parser.add_argument("-t", help="comma separated tests, run one after the other",
+                        default=','.join(TESTS).lower())
+    parser.add_argument("--mix", help="one test mixing commands by weight, e.g. get=8,set=2")
+    parser.add_argument("--mget-keys", type=int, default=10, help="keys per MGET")
+    parser.add_argument("-q", help="quiet: one line per test", action='store_true')
+    parser.add_argument("--csv", help="CSV output, as redis-benchmark --csv", action='store_true')
+    parser.add_argument("--json", help="JSON output, to keep and --compare later", action='store_true')
+    parser.add_argument("--label", default='', help="stored in the JSON output, e.g. a version")
+    parser.add_argument("--compare", help="JSON output of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown of rps or p99 that --compare reports as a regression")
+    args = parser.parse_args()
+
+    if args.mix:
+        tests = [(f"MIX({args.mix.lower()})", parsemix(args.mix))]
+    else:
+        tests = []
+        for name in args.t.upper().split(','):
+            if name not in TESTS:
+                parser.error(f"unknown test {name}; choose from {','.join(TESTS).lower()}")
+            tests.append((name, [name]))
 
+    results = []
+    for name, schedule in tests:
+        result = run(name, schedule, args)
+        results.append(result)
+        if not (args.csv or args.json):
+            report(result, args)
 
+    if args.csv:
+        writer = csv.writer(sys.stdout, quoting=csv.QUOTE_ALL)
+        writer.writerow(["test", "rps", "avg_latency_ms", "min_latency_ms", "p50_latency_ms",
+                         "p95_latency_ms", "p99_latency_ms", "max_latency_ms"])
+        for result in results:
+            lat = result['latency_ms']
+            writer.writerow([result['test'], f"{result['rps']:.2f}"]
+                            + [f"{lat[k]:.3f}" for k in ('avg', 'min', 'p50', 'p95', 'p99', 'max')])
+    if args.json:
+        config = {k: getattr(args, k) for k in ('c', 'processes', 'n', 'P', 'd', 'r', 'mget_keys')}
+        json.dump({'label': args.label, 'time': int(time.time()), 'config': config, 'tests': results},
+                  sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        # With --json the comparison goes to stderr, so stdout stays a valid JSON document.
+        if not compare(results, baseline, args.tolerance, sys.stderr if args.json else sys.stdout):
+            sys.exit(1)
@@ -8,12 +8,21 @@ from protocol import Client, CommandError
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
 
-client = Client()
+client = Client(poolnum=1)    # one connection, so MULTI/WATCH state stays with it.
 print("Start miniredis client.")
 print(client.info)
-print("""Available commands:[GET],[SET],[DELETE],[FLUSH],[MGET],[MSET],[LPUSH],[RPUSH],[LPOP],[RPOP],[BLPOP],[BRPOP],[LLEN]
-[EXPIRE],[TTL],[PERSIST]
-([MULTI],[EXEC] to be complete)
+print("""Available commands:[GET],[SET],[DELETE],[UNLINK],[FLUSH],[MGET],[MSET],[LPUSH],[RPUSH],[LPOP],[RPOP],[BLPOP],[BRPOP],[LLEN]
+[LRANGE],[LTRIM],[LREM],[LMOVE],[BLMOVE],[RPOPLPUSH],[BRPOPLPUSH]
+[HSET],[HGET],[HDEL],[HLEN],[HINCRBY],[HGETALL],[SADD],[SREM],[SCARD],[SISMEMBER],[SMEMBERS],[SINTER]
+[ZADD],[ZREM],[ZCARD],[ZSCORE],[ZRANK],[ZRANGEBYSCORE]
+[XADD],[XLEN],[XRANGE],[XREVRANGE],[XTRIM],[XREAD],[XGROUP],[XREADGROUP],[XACK],[XCLAIM],[XPENDING],[XINFO]
+[PFADD],[PFCOUNT],[PFMERGE],[BF.RESERVE],[BF.ADD],[BF.MADD],[BF.EXISTS],[BF.MEXISTS],[BF.CARD],[BF.INFO]
+[EXPIRE],[PEXPIRE],[TTL],[PTTL],[PERSIST]
+[MULTI],[EXEC],[DISCARD],[WATCH],[UNWATCH]
+[FCALL],[EVALSHA],[FUNCTION]
+[PUBLISH],[PUBSUB],[PING] (use Client.pubsub() to subscribe)
+[SCAN],[KEYS],[TYPE],[MEMORY]
+[SLOWLOG],[LATENCY],[REPLICAOF],[CLIENT]
 [INFO],[QUIT],[EXIT]""")
 
 while True:
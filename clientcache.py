@@ -0,0 +1,206 @@
+"""
+Client-side caching: GET/MGET values kept in the client process, kept correct by the server.
+
+A ClientCache opens a connection of its own, takes its CLIENT ID and subscribes it to
+__redis__:invalidate. Every pooled connection that reads through the cache first sends
+CLIENT TRACKING ON REDIRECT <that id>, so the server remembers the keys it reads and
+publishes them on that channel once they change; a listener thread drops them from the
+cache. If the listening connection is lost, invalidations may have been missed: the
+whole cache is dropped, and the next read sets it up again.
+
+A reply can arrive after the invalidation of what it read. So every fetch leaves a
+token in _pending, which invalidations (and the client's own writes) remove, and its
+value is only cached if the token is still there when the reply comes back.
+"""
+import os
+import socket
+import threading
+from collections import OrderedDict
+
+from protocol import Server, Connection, Error, CommandError, Disconnect
+
+
+_MISSING = object()
+
+
+class ClientCache(object):
+    """A bounded LRU of the values a Client read with GET/MGET, and its hit/miss counters."""
+    def __init__(self, pool, maxsize):
+        if int(maxsize) < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = int(maxsize)
+        self._pool = pool
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0      # cached keys dropped because they changed.
+        self._entries = OrderedDict()   # key -> value, least recently used first.
+        self._pending = {}          # key -> token of the fetch that may cache it.
+        self._lock = threading.Lock()
+        self._startlock = threading.Lock()
+        self._listener = None       # the connection invalidations arrive on ...
+        self._redirect = None       # ... and its client id; None until started.
+
+    def _checkpid(self):
+        # A forked child has none of the parent's invalidations: start empty.
+        if self.pid != os.getpid():
+            self._reset()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def close(self):
+        listener = self._listener
+        if listener is not None and listener._socket is not None:
+            try:
+                listener._socket.shutdown(socket.SHUT_RDWR)     # wakes the listener thread up.
+            except OSError:
+                pass
+
+    def get(self, key):
+        self._checkpid()
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is not _MISSING:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            token = self._pending[key] = object()
+        value, tracked = _MISSING, False
+        try:
+            value, tracked = self._fetch(('GET', key))
+        finally:
+            with self._lock:
+                self._settle(key, value, token, tracked)
+        if isinstance(value, Error):
+            raise CommandError(value.message)
+        return value
+
+    def mget(self, keys):
+        self._checkpid()
+        values = []
+        tokens = {}     # key -> token, for the keys to fetch.
+        with self._lock:
+            for key in keys:
+                value = self._entries.get(key, _MISSING)
+                if value is _MISSING:
+                    self.misses += 1
+                    tokens[key] = self._pending[key] = object()
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                values.append(value)
+        if not tokens:
+            return values
+        missing = list(tokens)
+        fetched, tracked = [], False
+        try:
+            fetched, tracked = self._fetch(('MGET', *missing))
+        finally:
+            with self._lock:
+                for i, key in enumerate(missing):
+                    self._settle(key, fetched[i] if tracked else None, tokens[key], tracked)
+        if isinstance(fetched, Error):
+            raise CommandError(fetched.message)
+        fetched = dict(zip(missing, fetched))
+        return [fetched[key] if value is _MISSING else value for key, value in zip(keys, values)]
+
+    def _settle(self, key, value, token, tracked):
+        """A fetch of key is over (under _lock): cache value if nothing invalidated it meanwhile."""
+        if self._pending.get(key) is not token:
+            return
+        del self._pending[key]
+        if tracked:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _fetch(self, command):
+        """Run command on a pooled connection tracking for our listener: (reply, whether it is tracked)."""
+        redirect = self._redirect or self._start()
+        connection = self._pool.get_connection()
+        try:
+            try:
+                return self._request(connection, redirect, command)
+            except (OSError, Disconnect):
+                if not connection.used:
+                    raise
+                # A pooled socket the server already closed; retry once on a fresh one.
+                return self._request(connection, redirect, command)
+        finally:
+            self._pool.release(connection)
+
+    def _request(self, connection, redirect, command):
+        if connection.tracking == redirect:
+            reply = connection.request([command])[0]
+        else:
+            tracking, reply = connection.request([('CLIENT', 'TRACKING', 'ON', 'REDIRECT', redirect), command])
+            if isinstance(tracking, Error):     # the listener is gone, or about to be noticed gone.
+                return reply, False
+            connection.tracking = redirect
+        return reply, not isinstance(reply, Error)
+
+    def _start(self):
+        """Connect the listener and start its thread; returns its client id."""
+        with self._startlock:
+            if self._redirect is not None:
+                return self._redirect
+            pool = self._pool
+            listener = Connection(pool.host, pool.port, pool._protocol, pool.unixsocket)
+            clientid, _ = listener.request([('CLIENT', 'ID'), ('SUBSCRIBE', Server.INVALIDATE_CHANNEL)])
+            if isinstance(clientid, Error):
+                listener.disconnect()
+                raise CommandError(clientid.message)
+            with self._lock:
+                self._listener, self._redirect = listener, clientid
+            threading.Thread(target=self._listen, args=(listener,), daemon=True).start()
+            return clientid
+
+    def _listen(self, listener):
+        reader = listener._reader
+        try:
+            while True:
+                frame = reader.read_frame()
+                if type(frame) is list and len(frame) == 3 and frame[0] == 'message':
+                    self.invalidate(frame[2])
+        except (OSError, Disconnect, CommandError, ValueError):
+            pass
+        finally:
+            listener.disconnect()
+            with self._lock:
+                if self._listener is listener:
+                    self._listener = self._redirect = None
+                    self._entries.clear()
+                    self._pending.clear()
+
+    def invalidate(self, keys):
+        """Drop keys from the cache; None drops everything."""
+        with self._lock:
+            if keys is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._pending.clear()
+                return
+            for key in keys:
+                self._pending.pop(key, None)
+                if self._entries.pop(key, _MISSING) is not _MISSING:
+                    self.invalidations += 1
+
+    def written(self, commands):
+        """The client's own writes went through: drop what they touched now, not when the server says."""
+        for args in commands:
+            command = args[0] if args else None
+            if command in ('FLUSH', 'FLUSHALL'):
+                self.invalidate(None)
+            elif command in Server.WRITE_COMMANDS or command in Server.FUNCTION_COMMANDS:
+                # Every argument that could be a key: dropping a value too is harmless.
+                self.invalidate([arg for arg in args[1:] if isinstance(arg, (str, bytes))])
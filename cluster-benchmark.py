@@ -0,0 +1,77 @@
+"""
+Throughput of the multi-process server against its number of workers.
+
+For each worker count, starts `server.py --workers N` on a spare port, drives it
+from several client processes sending pipelined SET/GET batches, and prints
+ops/sec. Scaling is only visible on a machine with at least as many cores as
+workers plus client processes.
+"""
+import argparse
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from protocol import Client
+
+
+def drive(port, requests, pipeline, clientid, results):
+    client = Client(port=port, poolnum=1)
+    keys = [f"bench:{clientid}:{i}" for i in range(pipeline)]
+    done = 0
+    starttime = time.time()
+    while done < requests:
+        p = client.pipeline()
+        for key in keys:
+            p.set(key, 'x' * 16)
+            p.get(key)
+        p.execute()
+        done += 2 * pipeline
+    results.put((done, time.time() - starttime))
+    client.close()
+
+
+def wait_ready(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            Client(port=port, poolnum=1).get('ready')
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not come up")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", help="comma separated worker counts", default="1,2,4")
+    parser.add_argument("-c", help="client processes", type=int, default=4)
+    parser.add_argument("-n", help="requests per client process", type=int, default=100000)
+    parser.add_argument("-P", help="pipeline depth", type=int, default=50)
+    parser.add_argument("--port", type=int, default=31400)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'ops/sec':>12} {'speedup':>8}")
+    baseline = None
+    for workers in [int(w) for w in args.w.split(",")]:
+        server = subprocess.Popen([sys.executable, "server.py", "--port", str(args.port),
+                                   "--workers", str(workers), "--dbfilename", ""],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(args.port)
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=drive, args=(args.port, args.n, args.P, i, results))
+                       for i in range(args.c)]
+            starttime = time.time()
+            for p in clients:
+                p.start()
+            for p in clients:
+                p.join()
+            elapsed = time.time() - starttime
+            total = sum(results.get()[0] for _ in clients)
+        finally:
+            server.terminate()
+            server.wait()
+        throughput = total / elapsed
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>12.0f} {throughput / baseline:>7.2f}x")
@@ -0,0 +1,309 @@
+"""
+Multi-process mode: N worker processes, each owning a range of hash slots.
+
+Every worker listens on the same TCP port through its own SO_REUSEPORT socket, so
+the kernel spreads client connections across them. A command whose keys belong to
+another worker is forwarded to it over a Unix socket; MGET/MSET are split per
+owner and gathered back in order.
+"""
+import os, signal, socket, tempfile, shutil
+import binascii
+
+import gevent
+from gevent.server import StreamServer
+
+from protocol import Server, Client, CommandError
+
+
+HASH_SLOTS = 16384
+
+
+def keyslot(key):
+    """Redis cluster's slot function: CRC16 of the key, or of its {hash tag} if any."""
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    start = key.find(b'{')
+    if start >= 0:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key, 0) % HASH_SLOTS
+
+
+def slotowner(slot, workers):
+    """Worker i owns slots [i * HASH_SLOTS // workers, (i + 1) * HASH_SLOTS // workers)."""
+    return slot * workers // HASH_SLOTS
+
+
+class ShardedServer(Server):
+    """A Server that only keeps the keys of its slot range and forwards the rest."""
+    # Commands without keys that run on every worker: the keyspace is spread over all of
+    # them, and so are the subscribers a PUBLISH must reach.
+    BROADCAST_COMMANDS = {'FLUSH', 'FLUSHALL', 'PUBLISH'}
+    # Commands without keys that stay on the worker the client happens to talk to.
+    LOCAL_COMMANDS = {'INFO', 'SAVE', 'BGSAVE', 'LASTSAVE', 'BGREWRITEAOF', 'FUNCTION', 'PUBSUB', 'PING',
+                      'SLOWLOG', 'LATENCY'}
+    # Commands whose second argument is a key too.
+    MOVE_COMMANDS = {'LMOVE', 'BLMOVE', 'RPOPLPUSH', 'BRPOPLPUSH'}
+    # Commands whose arguments are all keys.
+    MULTIKEY_COMMANDS = {'SINTER', 'UNLINK', 'PFCOUNT', 'PFMERGE'}
+    # Commands whose keys come later: after a subcommand, or after STREAMS (see _streamkeys).
+    STREAM_KEY_COMMANDS = {'XREAD', 'XREADGROUP', 'XGROUP', 'XINFO'}
+
+    def __init__(self, worker, workers, socketpaths, unixlistener, **kwargs):
+        super(ShardedServer, self).__init__(**kwargs)
+        self.worker = worker
+        self.workers = workers
+        self.info = f"{self.info} (worker {worker + 1}/{workers})"
+        self._peers = [None if i == worker else Client(unixsocket=path, poolnum=64)
+                       for i, path in enumerate(socketpaths)]
+        # Forwarded commands are always for keys this worker owns: answer them locally.
+        self._unixserver = StreamServer(
+            unixlistener,
+            lambda conn, address: self.connection_handler(conn, ('unix', worker), respond=self.local_response))
+
+    def local_response(self, data):
+        return Server.get_response(self, data)
+
+    def owner(self, key):
+        return slotowner(keyslot(key), self.workers)
+
+    def run(self):
+        self._unixserver.start()
+        super(ShardedServer, self).run()
+
+    def get_response(self, data):
+        if not isinstance(data, list) or len(data) < 1:
+            return self.local_response(data)
+        command = data[0]
+        if command in self.BROADCAST_COMMANDS:
+            return self._broadcast(data)
+        if command == 'MGET':
+            return self._mget(data[1:])
+        if command == 'MSET':
+            return self._mset(data[1:])
+        if command == 'SCAN':
+            return self._scan(data[1:])
+        if command == 'KEYS':
+            return [key for keys in self._gather([(owner, data) for owner in range(self.workers)]) for key in keys]
+        if command in self.FUNCTION_COMMANDS:
+            # A function runs where its declared keys live, and must not reach past them.
+            owners = self._owners(data)
+            if len(owners) > 1:
+                raise CommandError("CROSSSLOT Keys in request don't hash to the same worker")
+            return self._call(owners.pop() if owners else self.worker, data)
+        if len(data) < 2 or command in self.LOCAL_COMMANDS or command not in self._commands:
+            return self.local_response(data)
+        if command in self.STREAM_KEY_COMMANDS:
+            keys = self._streamkeys(data)
+            if not keys:
+                return self.local_response(data)    # for the syntax error.
+            owner, otherkeys = self.owner(keys[0]), keys[1:]
+        else:
+            owner = self.owner(data[1])
+            if command in self.MOVE_COMMANDS:
+                otherkeys = data[2:3]
+            elif command in self.MULTIKEY_COMMANDS:
+                otherkeys = data[2:]
+            elif command in self.BLOCKING_COMMANDS and len(data) > 3:
+                otherkeys = data[2:-1]
+            else:
+                otherkeys = ()
+        # A command that touches several keys runs in one worker, so they must all live there.
+        if any(self.owner(key) != owner for key in otherkeys):
+            raise CommandError("CROSSSLOT Keys in request don't hash to the same worker")
+        if owner == self.worker:
+            return self.local_response(data)
+        return self._peers[owner].execute(*data)
+
+    def _owners(self, data):
+        """The workers a command's keys live on; empty for commands without keys."""
+        command = data[0]
+        if len(data) < 2 or command in self.BROADCAST_COMMANDS or command in self.LOCAL_COMMANDS:
+            return set()
+        if command == 'MGET':
+            return {self.owner(key) for key in data[1:]}
+        if command == 'MSET':
+            return {self.owner(key) for key in data[1::2]}
+        if command in self.FUNCTION_COMMANDS:
+            return {self.owner(key) for key in self._functionkeys(data)}
+        if command in self.STREAM_KEY_COMMANDS:
+            return {self.owner(key) for key in self._streamkeys(data)}
+        return {self.owner(data[1])}
+
+    @staticmethod
+    def _streamkeys(data):
+        command = data[0]
+        if command in ('XGROUP', 'XINFO'):
+            return data[2:3]
+        for i in range(1 if command == 'XREAD' else 4, len(data)):
+            if str(data[i]).upper() == 'STREAMS':
+                streams = data[i + 1:]
+                return streams[:len(streams) // 2]
+        return []
+
+    def replicaof(self, host, port=None):
+        raise CommandError('Replication is not supported with several workers')
+
+    def _psync(self, subscriber, args):
+        raise CommandError('Replication is not supported with several workers')
+
+    def _clientcommand(self, subscriber, args):
+        if args and str(args[0]).upper() == 'TRACKING':
+            # The keys a connection reads live on other workers too, which never see it.
+            raise CommandError('CLIENT TRACKING is not supported with several workers')
+        return super(ShardedServer, self)._clientcommand(subscriber, args)
+
+    def _transactioncommand(self, transaction, command, args, respond):
+        if command == 'WATCH' and respond != self.local_response:
+            # The versions live on the owning worker, not on this connection's.
+            raise CommandError('WATCH is not supported with several workers')
+        return super(ShardedServer, self)._transactioncommand(transaction, command, args, respond)
+
+    def _exec(self, queued, respond=None):
+        """Run the transaction on the one worker that owns all of its keys."""
+        if respond == self.local_response:
+            return super(ShardedServer, self)._exec(queued, respond)
+        owners = set()
+        for data in queued:
+            owners |= self._owners(data)
+        if len(owners) > 1:
+            raise CommandError("CROSSSLOT Keys in request don't hash to the same worker")
+        owner = owners.pop() if owners else self.worker
+        if owner == self.worker:
+            return super(ShardedServer, self)._exec(queued, self.local_response)
+        commands = [('MULTI',)] + [tuple(data) for data in queued] + [('EXEC',)]
+        return self._peers[owner]._request(commands)[-1]
+
+    def _functioncall(self, data):
+        if any(owner != self.worker for owner in self._owners(data)):
+            raise CommandError('Function accessed a key owned by another worker; declare its keys')
+        return super(ShardedServer, self)._functioncall(data)
+
+    def _call(self, owner, data):
+        if owner == self.worker:
+            return self.local_response(data)
+        return self._peers[owner].execute(*data)
+
+    def _gather(self, calls):
+        """Run (owner, data) calls concurrently; returns their results in order."""
+        jobs = [gevent.spawn(self._call, owner, data) for owner, data in calls]
+        gevent.joinall(jobs)
+        for job in jobs:
+            if not job.successful():
+                raise job.exception
+        return [job.value for job in jobs]
+
+    def _broadcast(self, data):
+        results = self._gather([(owner, data) for owner in range(self.workers)])
+        if all(isinstance(result, int) for result in results):
+            return sum(results)
+        return results[self.worker]
+
+    def _mget(self, keys):
+        byowner = {}
+        for position, key in enumerate(keys):
+            byowner.setdefault(self.owner(key), []).append(position)
+        owners = list(byowner)
+        results = self._gather([(owner, ['MGET'] + [keys[i] for i in byowner[owner]]) for owner in owners])
+        values = [None] * len(keys)
+        for owner, result in zip(owners, results):
+            for position, value in zip(byowner[owner], result):
+                values[position] = value
+        return values
+
+    def _scan(self, args):
+        """SCAN the workers one after the other: cursor = worker's own cursor * workers + worker."""
+        if not args:
+            raise CommandError('SCAN needs a cursor')
+        try:
+            cursor = int(args[0])
+        except ValueError:
+            raise CommandError('invalid cursor')
+        if cursor < 0:
+            raise CommandError('invalid cursor')
+        owner, local = cursor % self.workers, cursor // self.workers
+        local, keys = self._call(owner, ['SCAN', local] + list(args[1:]))
+        if local:
+            return [local * self.workers + owner, keys]
+        # That worker is done; the next one starts at its own cursor 0, i.e. at cursor owner + 1.
+        return [owner + 1 if owner + 1 < self.workers else 0, keys]
+
+    def _mset(self, items):
+        if len(items) % 2:
+            raise CommandError('MSET needs key value pairs')
+        byowner = {}
+        for key, value in zip(items[::2], items[1::2]):
+            byowner.setdefault(self.owner(key), []).extend((key, value))
+        return sum(self._gather([(owner, ['MSET'] + pairs) for owner, pairs in byowner.items()]))
+
+
+def _listener(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def _unixlistener(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def _perworker(filename, worker):
+    return f"{filename}.{worker}" if filename else filename
+
+
+def run_workers(workers, host='127.0.0.1', port=31337, **kwargs):
+    """Fork `workers` ShardedServers sharing host:port and wait for them.
+
+    All listening sockets are bound before the first fork, so no worker can forward
+    to a peer that isn't accepting yet. Persistence files get a .<worker> suffix.
+    """
+    socketdir = tempfile.mkdtemp(prefix='miniredis-')
+    socketpaths = [os.path.join(socketdir, f"worker-{i}.sock") for i in range(workers)]
+    listeners = [_listener(host, port) for _ in range(workers)]
+    unixlisteners = [_unixlistener(path) for path in socketpaths]
+
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(workers):
+                if i != worker:
+                    listeners[i].close()
+                    unixlisteners[i].close()
+            workerkwargs = dict(kwargs)
+            for name in ('appendonly', 'dbfilename'):
+                if name in workerkwargs:
+                    workerkwargs[name] = _perworker(workerkwargs[name], worker)
+            server = ShardedServer(worker, workers, socketpaths, unixlisteners[worker],
+                                   host=host, port=port, listener=listeners[worker], **workerkwargs)
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    for sock in listeners + unixlisteners:
+        sock.close()
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for _ in pids:
+            os.wait()
+    finally:
+        shutil.rmtree(socketdir, ignore_errors=True)
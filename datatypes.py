@@ -0,0 +1,294 @@
+"""
+Hash, set and sorted-set values for Server._kv.
+
+Like Redis, each type has a compact encoding for small values and converts, once
+and for good, to the full structure when it grows past a threshold:
+
+    HashValue   listpack (flat (field, value, ...) tuple)  ->  hashtable (dict)
+    SetValue    intset (sorted int64 array) or listpack    ->  hashtable (set)
+    ZSetValue   listpack (sorted [(score, member), ...])   ->  sortedarray (dict + sorted list)
+
+The compact forms are searched linearly, which is cheaper than hashing at these
+sizes and saves the per-entry overhead of a dict or set. A listpack is an exact-size
+tuple rebuilt on every write, as Redis reallocates its listpacks: a small hash costs
+about 70% of the equivalent dict.
+"""
+import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+
+
+HASH_MAX_LISTPACK_ENTRIES = 128
+HASH_MAX_LISTPACK_VALUE = 64    # a longer str/bytes field or value converts to a dict.
+SET_MAX_INTSET_ENTRIES = 512
+SET_MAX_LISTPACK_ENTRIES = 128
+SET_MAX_LISTPACK_VALUE = 64
+ZSET_MAX_LISTPACK_ENTRIES = 128
+ZSET_MAX_LISTPACK_VALUE = 64
+
+# Rough bytes each entry costs the container itself, per encoding, for memory accounting.
+ENTRY_OVERHEAD = {'listpack': 16, 'intset': 8, 'hashtable': 64, 'sortedarray': 136}
+
+_INT64_MIN, _INT64_MAX = -(1 << 63), (1 << 63) - 1
+_MISSING = object()
+
+
+def _long(value, limit):
+    return isinstance(value, (str, bytes)) and len(value) > limit
+
+
+class HashValue(object):
+    """Field -> value map."""
+    __slots__ = ('_data',)
+
+    def __init__(self, pairs=()):
+        self._data = ()
+        for field, value in pairs:
+            self.set(field, value)
+
+    @property
+    def encoding(self):
+        return 'listpack' if type(self._data) is tuple else 'hashtable'
+
+    def __len__(self):
+        data = self._data
+        return len(data) // 2 if type(data) is tuple else len(data)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._data)
+
+    def _find(self, field):
+        data = self._data
+        for i in range(0, len(data), 2):
+            if data[i] == field:
+                return i
+        return -1
+
+    def get(self, field, default=None):
+        data = self._data
+        if type(data) is not tuple:
+            return data.get(field, default)
+        i = self._find(field)
+        return default if i < 0 else data[i + 1]
+
+    def __contains__(self, field):
+        data = self._data
+        return field in data if type(data) is not tuple else self._find(field) >= 0
+
+    def set(self, field, value):
+        """Set field; returns True if it is a new field."""
+        data = self._data
+        if type(data) is not tuple:
+            new = field not in data
+            data[field] = value
+            return new
+        i = self._find(field)
+        if i >= 0:
+            data = data[:i + 1] + (value,) + data[i + 2:]
+            new = False
+        else:
+            data = data + (field, value)
+            new = True
+        self._data = data
+        if (len(data) > 2 * HASH_MAX_LISTPACK_ENTRIES or _long(field, HASH_MAX_LISTPACK_VALUE)
+                or _long(value, HASH_MAX_LISTPACK_VALUE)):
+            self._data = dict(zip(data[::2], data[1::2]))
+        return new
+
+    def delete(self, field):
+        data = self._data
+        if type(data) is not tuple:
+            return data.pop(field, _MISSING) is not _MISSING
+        i = self._find(field)
+        if i < 0:
+            return False
+        self._data = data[:i] + data[i + 2:]
+        return True
+
+    def items(self):
+        data = self._data
+        if type(data) is not tuple:
+            return data.items()
+        return zip(data[::2], data[1::2])
+
+    def elements(self):
+        """Every object held, for memory estimates."""
+        data = self._data
+        if type(data) is tuple:
+            return data
+        return [item for pair in data.items() for item in pair]
+
+
+class SetValue(object):
+    """Unordered set of unique members."""
+    __slots__ = ('_data',)
+
+    def __init__(self, members=()):
+        self._data = array('q')
+        for member in members:
+            self.add(member)
+
+    @property
+    def encoding(self):
+        t = type(self._data)
+        return 'intset' if t is array else 'listpack' if t is tuple else 'hashtable'
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._data)
+
+    def __contains__(self, member):
+        data = self._data
+        if type(data) is array:
+            if type(member) is not int or not _INT64_MIN <= member <= _INT64_MAX:
+                return False
+            i = bisect_left(data, member)
+            return i < len(data) and data[i] == member
+        return member in data
+
+    def add(self, member):
+        """Add member; returns True if it wasn't there."""
+        data = self._data
+        t = type(data)
+        if t is array:
+            if type(member) is int and _INT64_MIN <= member <= _INT64_MAX:
+                i = bisect_left(data, member)
+                if i < len(data) and data[i] == member:
+                    return False
+                data.insert(i, member)
+                if len(data) > SET_MAX_INTSET_ENTRIES:
+                    self._data = set(data)
+                return True
+            # A member that isn't an int64: the ints go on in the next encoding.
+            data = self._data = tuple(data) if len(data) < SET_MAX_LISTPACK_ENTRIES else set(data)
+            t = type(data)
+        if t is tuple:
+            if member in data:
+                return False
+            data = self._data = data + (member,)
+            if len(data) > SET_MAX_LISTPACK_ENTRIES or _long(member, SET_MAX_LISTPACK_VALUE):
+                self._data = set(data)
+            return True
+        if member in data:
+            return False
+        data.add(member)
+        return True
+
+    def remove(self, member):
+        if member not in self:
+            return False
+        data = self._data
+        if type(data) is tuple:
+            i = data.index(member)
+            self._data = data[:i] + data[i + 1:]
+        else:
+            data.remove(member)
+        return True
+
+    def elements(self):
+        return self._data if type(self._data) is not array else ()
+
+
+class ZSetValue(object):
+    """Members ordered by score, then by member.
+
+    Entries are (score, member) tuples kept sorted; the full encoding adds a dict from
+    member to score so lookups by member don't scan. Ties on score are ordered by the
+    member's str(), so members of different types never get compared directly.
+    """
+    __slots__ = ('_entries', '_scores')
+
+    def __init__(self, pairs=()):
+        self._entries = []
+        self._scores = None     # member -> score, once past the listpack size.
+        for member, score in pairs:
+            self.add(member, score)
+
+    @staticmethod
+    def _order(entry):
+        return entry[0], str(entry[1])
+
+    @property
+    def encoding(self):
+        return 'listpack' if self._scores is None else 'sortedarray'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + sys.getsizeof(self._entries)
+        size += sum([sys.getsizeof(entry) for entry in self._entries])
+        if self._scores is not None:
+            size += sys.getsizeof(self._scores)
+        return size
+
+    def score(self, member):
+        if self._scores is not None:
+            return self._scores.get(member)
+        for score, m in self._entries:
+            if m == member:
+                return score
+        return None
+
+    def _index(self, member, score):
+        entries = self._entries
+        i = bisect_left(entries, (score, str(member)), key=self._order)
+        while entries[i][1] != member:     # ties in str() order; members are unique.
+            i += 1
+        return i
+
+    def add(self, member, score):
+        """Add member or move it to score; returns True if it is a new member."""
+        old = self.score(member)
+        if old is not None:
+            if old == score:
+                return False
+            del self._entries[self._index(member, old)]
+        insort(self._entries, (score, member), key=self._order)
+        if self._scores is not None:
+            self._scores[member] = score
+        elif len(self._entries) > ZSET_MAX_LISTPACK_ENTRIES or _long(member, ZSET_MAX_LISTPACK_VALUE):
+            self._scores = {m: s for s, m in self._entries}
+        return old is None
+
+    def remove(self, member):
+        score = self.score(member)
+        if score is None:
+            return False
+        del self._entries[self._index(member, score)]
+        if self._scores is not None:
+            del self._scores[member]
+        return True
+
+    def rank(self, member):
+        score = self.score(member)
+        return None if score is None else self._index(member, score)
+
+    def rangebyscore(self, low, high, lowexclusive=False, highexclusive=False):
+        """The (score, member) entries with low <= score <= high, in order."""
+        entries = self._entries
+        score = self._score
+        start = (bisect_right if lowexclusive else bisect_left)(entries, low, key=score)
+        end = (bisect_left if highexclusive else bisect_right)(entries, high, key=score)
+        return entries[start:end]
+
+    @staticmethod
+    def _score(entry):
+        return entry[0]
+
+    def __iter__(self):
+        return (member for score, member in self._entries)
+
+    def items(self):
+        return ((member, score) for score, member in self._entries)
+
+    def elements(self):
+        return [item for entry in self._entries for item in entry]
+
+
+COLLECTION_TYPES = (HashValue, SetValue, ZSetValue)
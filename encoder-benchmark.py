@@ -0,0 +1,85 @@
+"""
+Microbenchmark the reply encoder, per type.
+
+Compares ProtocolHandler._write (cached headers, appending into one reused
+bytearray) with the BytesIO/f-string encoder it replaced, which is kept below.
+Runs in-process, no server needed.
+"""
+import argparse
+import time
+from collections import deque
+from io import BytesIO
+
+from protocol import ProtocolHandler, Error, CommandError
+
+
+def legacy_write(buf, data):
+    if isinstance(data, bytes):
+        buf.write(f'+{len(data)}\r\n'.encode('utf-8'))
+        buf.write(data)
+        buf.write("\r\n".encode('utf-8'))
+    elif isinstance(data, str):
+        buf.write(f'${len(data)}\r\n{data}\r\n'.encode('utf-8'))
+    elif isinstance(data, int):
+        buf.write(f':{data}\r\n'.encode('utf-8'))
+    elif isinstance(data, float):
+        buf.write(f'?{data}\r\n'.encode('utf-8'))
+    elif isinstance(data, Error):
+        buf.write(f'-{data.message}\r\n'.encode('utf-8'))
+    elif isinstance(data, (list, tuple, deque)):
+        buf.write(f'*{len(data)}\r\n'.encode('utf-8'))
+        for item in data:
+            legacy_write(buf, item)
+    elif isinstance(data, dict):
+        buf.write(f'%{len(data)}\r\n'.encode('utf-8'))
+        for key in data:
+            legacy_write(buf, key)
+            legacy_write(buf, data[key])
+    elif data is None:
+        buf.write('$-1\r\n'.encode('utf-8'))
+    else:
+        raise CommandError('unrecognized type: %s' % type(data))
+
+
+def legacy_encode(data):
+    buf = BytesIO()
+    legacy_write(buf, data)
+    tosend = buf.getvalue()
+    tosend.decode('utf-8', 'replace')   # the old write_response decoded every reply for logging.debug.
+    return tosend
+
+
+SAMPLES = {
+    'int': 42,
+    'null': None,
+    'float': 3.14159,
+    'str': 'value-1234',
+    'bytes': b'\x00' * 64,
+    'error': Error('Unrecognized command: FOO'),
+    'mget(100 str)': [f'value-{i}' for i in range(100)],
+    'lrange(1000 mixed)': [i if i % 2 else f'v{i}' for i in range(1000)],
+    'dict(50)': {f'k{i}': [i, 1.5, None] for i in range(50)},
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", help='encodings per sample', type=int, default=20000)
+    args = parser.parse_args()
+
+    protocol = ProtocolHandler()
+    buf = bytearray()
+
+    print(f"{'type':>20} {'legacy':>10} {'current':>10} {'speedup':>8}   (us/reply)")
+    for name, data in SAMPLES.items():
+        starttime = time.perf_counter()
+        for _ in range(args.n):
+            legacy_encode(data)
+        legacy = (time.perf_counter() - starttime) / args.n * 1e6
+
+        starttime = time.perf_counter()
+        for _ in range(args.n):
+            protocol._write(buf, data)
+            buf.clear()
+        current = (time.perf_counter() - starttime) / args.n * 1e6
+        print(f"{name:>20} {legacy:>10.3f} {current:>10.3f} {legacy / current:>7.1f}x")
@@ -0,0 +1,103 @@
+"""
+Server-side functions: Python callables run inside the server, in one round trip.
+
+A functions module is loaded at startup (`server.py --functions myfuncs.py`). Each
+public function defined in it is registered under its name and under the SHA1 of its
+source, and is called as
+
+    def enqueue(redis, keys, args):
+        if (redis.llen(keys[0]) or 0) >= int(args[1]):
+            return 0
+        redis.rpush(keys[0], args[0])
+        redis.expire(keys[0], 3600)
+        return 1
+
+by `FCALL enqueue 1 jobs job-17 1000`, or by `EVALSHA <sha1> 1 jobs job-17 1000`.
+
+A function runs atomically: the commands it calls don't yield, so no other client
+runs until it returns. `redis` only exposes the server's own commands, through
+redis.call('LLEN', key) or redis.llen(key); blocking commands and the ones that
+fork or run other functions are refused. Its writes are logged to the append-only
+file as the commands it ran, wrapped in MULTI/EXEC, so replay doesn't need the module.
+"""
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import marshal
+import os
+
+from protocol import CommandError
+
+
+def _digest(func):
+    try:
+        source = inspect.getsource(func).encode('utf-8')
+    except (OSError, TypeError):
+        source = marshal.dumps(func.__code__)
+    return hashlib.sha1(source).hexdigest()
+
+
+def _loadmodule(name):
+    """Import a functions module from a .py path or a dotted module name."""
+    if name.endswith('.py') or os.path.sep in name:
+        modulename = os.path.splitext(os.path.basename(name))[0]
+        spec = importlib.util.spec_from_file_location(modulename, name)
+        if spec is None:
+            raise ImportError(f"Can not load functions from {name}")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(name)
+
+
+class FunctionLibrary(object):
+    """The registered functions, by name and by digest."""
+    def __init__(self, module=None):
+        self.byname = {}
+        self.bydigest = {}
+        self.digests = {}   # name -> digest, for FUNCTION LIST.
+        if module is not None:
+            self.load(module)
+
+    def load(self, module):
+        if isinstance(module, str):
+            module = _loadmodule(module)
+        for name, func in vars(module).items():
+            if name.startswith('_') or not inspect.isfunction(func) or func.__module__ != module.__name__:
+                continue
+            self.register(name, func)
+
+    def register(self, name, func):
+        digest = _digest(func)
+        self.byname[name] = func
+        self.bydigest[digest] = func
+        self.digests[name] = digest
+        return digest
+
+    def __len__(self):
+        return len(self.byname)
+
+
+class FunctionContext(object):
+    """What a function sees of the server: its commands, and nothing else.
+
+    redis.call('SET', key, value) and redis.set(key, value) are the same call. A command
+    that fails raises CommandError inside the function, which may catch it.
+    """
+    __slots__ = ('_server',)
+
+    def __init__(self, server):
+        self._server = server
+
+    def call(self, command, *args):
+        command = command.upper()
+        server = self._server
+        if command not in server._commands or command in server.FUNCTION_DENIED_COMMANDS:
+            raise CommandError(f"{command} is not allowed from functions")
+        return server._functioncall([command] + list(args))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name.upper() not in self._server._commands:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
@@ -0,0 +1,174 @@
+"""
+Latency instrumentation: per-command histograms, the slow log and latency events.
+
+Histogram is HDR-style: log-linear buckets with 32 sub-buckets per power of two, so
+any value is counted within 1/32 (~3%) of what it was, recording is a table lookup
+(a bit_length() past 131 µs) and a list increment, and percentiles are read by
+walking the buckets. The server appends each command's duration to a plain list and
+extend()s the histogram from it now and then, which keeps the per-command cost to
+a list.append.
+
+SlowLog keeps the last commands that ran longer than a threshold, as Redis' SLOWLOG.
+LatencyMonitor keeps, per event (a slow command, an expire cycle, the event loop
+running late...), the latest and worst spikes over a threshold and a short history,
+as Redis' LATENCY LATEST / HISTORY.
+"""
+import time
+from array import array
+from collections import deque
+
+
+_SUB_BITS = 5
+_SUB = 1 << _SUB_BITS   # sub-buckets per power of two.
+
+
+def _bucket(value):
+    if value < _SUB:
+        return value
+    shift = value.bit_length() - _SUB_BITS - 1
+    return (shift << _SUB_BITS) + (value >> shift)
+
+
+def _highest(index):
+    """The largest value counted in bucket index."""
+    if index < _SUB:
+        return index
+    shift = (index >> _SUB_BITS) - 1
+    return (((index - (shift << _SUB_BITS)) + 1) << shift) - 1
+
+
+_LIMIT = (1 << 48) - 1     # the largest value told apart: 78 hours in nanoseconds.
+
+# The bucket of every value from _TABLE_START to _TABLE_END (131 µs), by value >> 3: values
+# that far up have shift >= 3, so the 3 bits dropped never pick the bucket. 32 KB.
+_TABLE_SHIFT = 3
+_TABLE_START = 1 << (_TABLE_SHIFT + _SUB_BITS + 1)
+_TABLE_END = 1 << 17
+_TABLE = array('H', [_bucket(value << _TABLE_SHIFT) for value in range(_TABLE_END >> _TABLE_SHIFT)])
+
+
+class Histogram(object):
+    """Counts of non-negative integer values (nanoseconds here) in log-linear buckets."""
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (_bucket(_LIMIT) + 1)     # ~1400 buckets, allocated once.
+        self.total = 0
+
+    @property
+    def count(self):
+        # Summed when read rather than kept up to date by record(), which runs once per command.
+        return sum(self.counts)
+
+    def record(self, value):
+        if _TABLE_START <= value < _TABLE_END:
+            self.counts[_TABLE[value >> _TABLE_SHIFT]] += 1
+        else:
+            self.counts[_bucket(value) if value < _LIMIT else -1] += 1
+        self.total += value
+
+    def extend(self, values):
+        """record() each of values."""
+        counts = self.counts
+        for value in values:
+            if _TABLE_START <= value < _TABLE_END:
+                counts[_TABLE[value >> _TABLE_SHIFT]] += 1
+            else:
+                counts[_bucket(value) if value < _LIMIT else -1] += 1
+        self.total += sum(values)
+
+    def merge(self, other):
+        """Add other's samples to this histogram (e.g. gathered from several processes)."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        return self
+
+    def percentile(self, percent):
+        """The value percent% of the recorded values are at or below (to bucket precision)."""
+        count = self.count
+        if not count:
+            return 0
+        rank = max(1, -(-count * percent // 100))    # ceil, in integers.
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return _highest(i)
+        return _LIMIT
+
+
+class SlowLog(object):
+    """The last maxlen commands slower than threshold nanoseconds (a negative threshold logs none)."""
+    MAX_ARGS = 32
+    MAX_ARG_LENGTH = 128
+
+    def __init__(self, threshold, maxlen=128):
+        self.threshold = threshold
+        self.entries = deque(maxlen=maxlen)
+        self._nextid = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, args, duration):
+        shown = [self._shorten(arg) for arg in args[:self.MAX_ARGS]]
+        if len(args) > self.MAX_ARGS:
+            shown[-1] = f"... ({len(args) - self.MAX_ARGS + 1} more arguments)"
+        self.entries.appendleft([self._nextid, int(time.time()), duration // 1000, shown])
+        self._nextid += 1
+
+    def _shorten(self, arg):
+        if isinstance(arg, (str, bytes)) and len(arg) > self.MAX_ARG_LENGTH:
+            return arg[:self.MAX_ARG_LENGTH] + (f"... ({len(arg) - self.MAX_ARG_LENGTH} more bytes)"
+                                                if isinstance(arg, str) else b'...')
+        return arg
+
+    def get(self, count=10):
+        """The newest count entries: [id, unix time, microseconds, arguments]."""
+        if count < 0:
+            return list(self.entries)
+        return [entry for entry, _ in zip(self.entries, range(count))]
+
+    def reset(self):
+        self.entries.clear()
+
+
+class LatencyMonitor(object):
+    """Spikes of threshold milliseconds or more, per event (a threshold of 0 records none)."""
+    HISTORY = 160
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._events = {}   # event -> [latest time, latest ms, max ms, deque of (time, ms)]
+
+    def add(self, event, milliseconds):
+        if not self.threshold or milliseconds < self.threshold:
+            return
+        now = int(time.time())
+        milliseconds = int(milliseconds)
+        entry = self._events.get(event)
+        if entry is None:
+            entry = self._events[event] = [now, milliseconds, milliseconds, deque(maxlen=self.HISTORY)]
+        entry[0], entry[1] = now, milliseconds
+        entry[2] = max(entry[2], milliseconds)
+        history = entry[3]
+        if history and history[-1][0] == now:   # one sample per second, the worst of it.
+            history[-1] = (now, max(history[-1][1], milliseconds))
+        else:
+            history.append((now, milliseconds))
+
+    def latest(self):
+        """[event, time of the latest spike, its ms, the worst ms] for every event."""
+        return [[event, entry[0], entry[1], entry[2]] for event, entry in self._events.items()]
+
+    def history(self, event):
+        entry = self._events.get(event)
+        return [] if entry is None else [list(sample) for sample in entry[3]]
+
+    def reset(self, *events):
+        """Forget the given events (all of them if none); returns how many were dropped."""
+        if not events:
+            count = len(self._events)
+            self._events.clear()
+            return count
+        return sum(self._events.pop(event, None) is not None for event in events)
@@ -0,0 +1,88 @@
+"""
+Lazy freeing: big values leave the keyspace at once and are freed a chunk at a time.
+
+CPython frees a container as soon as its last reference goes, all in one call: dropping
+a list of millions of items, or the whole keyspace on FLUSHALL, holds up every client
+until it is done. UNLINK, FLUSH/FLUSHALL ASYNC, expiry and eviction hand such values
+to a LazyFreer instead. The server calls free() with a time budget in between commands
+(from a greenlet under gevent, a loop callback under asyncio), and each call takes
+items out of the queued containers until the budget is spent. An item that is a big
+container itself, like a list in a detached keyspace, is queued in turn.
+"""
+import time
+from collections import deque
+
+
+LAZYFREE_THRESHOLD = 64     # items; smaller values are freed at once, as in Redis.
+_CHUNK = 256                # items taken out between two looks at the clock.
+# Freed in one block (or never this big here): no need to look any closer.
+_ATOMIC = (int, float, str, bytes, bytearray, tuple, type(None))
+
+
+def isbig(value):
+    """Whether freeing value at once would cost more than LAZYFREE_THRESHOLD items."""
+    if isinstance(value, _ATOMIC):
+        return False
+    try:
+        return len(value) > LAZYFREE_THRESHOLD
+    except TypeError:
+        return False
+
+
+class LazyFreer(object):
+    """The values waiting to be freed, oldest first."""
+    def __init__(self):
+        self._queue = deque()
+        self.freed = 0      # values freed so far, as Redis' lazyfreed_objects.
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, value, force=False):
+        """Queue value if it is big, or whatever its size with force; returns whether it was
+        (if not, the caller just drops it). A detached keyspace is forced: a few keys can
+        hold huge values, and its index does not even count them."""
+        if not (force or isbig(value)):
+            return False
+        self._queue.append(value)
+        return True
+
+    def free(self, budget):
+        """Free queued values for about budget seconds; returns whether some are left."""
+        deadline = time.monotonic() + budget
+        queue = self._queue
+        while queue:
+            value = queue.popleft()
+            if self._drain(value):
+                self.freed += 1
+            else:
+                queue.appendleft(value)
+            if time.monotonic() >= deadline:
+                break
+        return bool(queue)
+
+    def _drain(self, value):
+        """Take up to _CHUNK items out of value; returns whether it is empty now."""
+        queue = self._queue
+        if isinstance(value, dict):
+            for _ in range(min(_CHUNK, len(value))):
+                key, item = value.popitem()
+                if isbig(item):
+                    queue.append(item)
+            return not value
+        if isinstance(value, (list, deque, set)):
+            for _ in range(min(_CHUNK, len(value))):
+                item = value.pop()
+                if isbig(item):
+                    queue.append(item)
+            return not value
+        # Anything else (HashValue, ZSetValue, StreamValue, a KeyspaceIndex...) holds its
+        # items in containers of its own: queue those, and the shell goes when it is dropped.
+        # Small ones too, as they may hold big ones (a stream's groups and their PELs).
+        slots = getattr(type(value), '__slots__', None)
+        members = ([getattr(value, name, None) for name in slots] if slots is not None
+                   else list(getattr(value, '__dict__', {}).values()))
+        for member in members:
+            if (isinstance(member, (dict, list, deque, set)) and member) or isbig(member):
+                queue.append(member)
+        return True
@@ -0,0 +1,50 @@
+"""
+Benchmark the list engine: pop/push latency against queue length.
+
+Compares the ListValue deque with the plain python list the server used before
+(insert(0, v) / pop(0)). Runs in-process, no server needed.
+"""
+import argparse
+import time
+
+from protocol import ListValue
+
+
+def old_lpush(values, value):
+    values.insert(0, value)
+
+
+def old_lpop(values):
+    return values.pop(0)
+
+
+def new_lpush(values, value):
+    values.push_left((value,))
+
+
+def new_lpop(values):
+    return values.popleft()
+
+
+def timeit(func, values, n, *args):
+    starttime = time.perf_counter()
+    for _ in range(n):
+        func(values, *args)
+    return (time.perf_counter() - starttime) / n * 1e6   # microseconds per op.
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", help='operations timed per queue length', type=int, default=1000)
+    parser.add_argument("-s", help='comma separated queue lengths', default="1000,10000,100000,1000000")
+    args = parser.parse_args()
+
+    print(f"{'length':>10} {'list LPOP':>12} {'deque LPOP':>12} {'list LPUSH':>12} {'deque LPUSH':>12}   (us/op)")
+    for size in [int(s) for s in args.s.split(",")]:
+        oldlist = list(range(size + args.n))
+        newlist = ListValue(range(size + args.n))
+        oldpop = timeit(old_lpop, oldlist, args.n)
+        newpop = timeit(new_lpop, newlist, args.n)
+        oldpush = timeit(old_lpush, oldlist, args.n, 'x')
+        newpush = timeit(new_lpush, newlist, args.n, 'x')
+        print(f"{size:>10} {oldpop:>12.3f} {newpop:>12.3f} {oldpush:>12.3f} {newpush:>12.3f}")
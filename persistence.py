@@ -0,0 +1,516 @@
+"""
+Persistence for the miniredis Server: the append-only command log (AOF) and
+point-in-time binary snapshots (SAVE/BGSAVE).
+
+Mutating commands are appended in their wire encoding, so replaying the file is
+just parsing it with RespParser and running every frame through the server.
+"""
+import os, time, threading
+import logging
+import mmap, struct, zlib
+
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:     # fsync then simply runs on the calling thread.
+    get_hub = None
+
+from protocol import RespParser, NEED_MORE, ProtocolHandler, ListValue
+from datatypes import HashValue, SetValue, ZSetValue
+from streams import StreamValue
+from probabilistic import HyperLogLog, BloomFilter
+
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+
+def _fsync(fd):
+    # Run fsync in gevent's native thread pool so the event loop keeps serving clients.
+    # Outside a monkey-patched (gevent) server there is no hub to keep free.
+    if get_hub is not None and is_module_patched('socket'):
+        return get_hub().threadpool.apply(os.fsync, (fd,))
+    return os.fsync(fd)
+
+
+class AppendOnlyFile(object):
+    """The command log.
+
+    append() only encodes into an in-memory buffer. flush() writes the buffer out;
+    the server calls it before it sends a batch of replies. Under 'always' flush()
+    also fsyncs, and callers that arrive while an fsync is in progress wait for it and
+    are then covered by one shared write+fsync (group commit). Under 'everysec' a
+    background thread fsyncs once a second, under 'no' the OS decides.
+    """
+    def __init__(self, filename, fsync='everysec'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"appendfsync must be one of {FSYNC_POLICIES}")
+        self.filename = filename
+        self.fsync = fsync
+        self._protocol = ProtocolHandler()
+        self._lock = threading.Lock()
+        self._buf = bytearray()
+        self._appended = 0      # bytes ever appended.
+        self._written = 0       # bytes ever handed to the file.
+        self._synced = 0        # bytes ever made durable.
+        self._rewritebuf = None     # commands appended while a rewrite child runs.
+        self._rewritepid = None
+        self.rewrites = 0
+        self._file = open(filename, 'ab')
+        if fsync == 'everysec':
+            threading.Thread(target=self._everysec, daemon=True).start()
+
+    def append(self, args):
+        start = len(self._buf)
+        self._protocol._write(self._buf, args)
+        self._appended += len(self._buf) - start
+        if self._rewritebuf is not None:
+            self._rewritebuf += self._buf[start:]
+
+    def flush(self):
+        target = self._appended
+        if self._written >= target and (self.fsync != 'always' or self._synced >= target):
+            return
+        with self._lock:
+            if self._buf:
+                data, self._buf = self._buf, bytearray()
+                end = self._written + len(data)
+                self._file.write(data)
+                self._file.flush()
+                self._written = end
+            if self.fsync == 'always' and self._synced < target:
+                end = self._written
+                _fsync(self._file.fileno())
+                self._synced = end
+
+    def _everysec(self):
+        # Only fsyncs: writes happen in flush() on the serving thread, so this thread
+        # never touches the buffer that append() fills.
+        while True:
+            time.sleep(1)
+            try:
+                if self._synced < self._written:
+                    end = self._written
+                    _fsync(self._file.fileno())
+                    self._synced = end
+            except (OSError, ValueError) as err:
+                logging.error(f"AOF fsync failed: {err}")
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def load(self, execute, chunksize=1 << 20):
+        """Replay the log through execute(frame). Returns the number of commands run.
+
+        A command cut short by a crash mid-write is dropped and the file truncated
+        back to the last complete one, so new appends start on a clean boundary.
+        Commands between MULTI and EXEC run only once their EXEC has been read; a
+        transaction without one is dropped and truncated the same way.
+        """
+        parser = RespParser()
+        count = 0
+        fed = 0
+        good = 0
+        transaction = None
+        with open(self.filename, 'rb') as fh:
+            while True:
+                chunk = fh.read(chunksize)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                fed += len(chunk)
+                frame = parser.gets()
+                while frame is not NEED_MORE:
+                    if frame == ['MULTI']:
+                        transaction = []
+                    elif transaction is None:
+                        execute(frame)
+                        count += 1
+                    elif frame == ['EXEC']:
+                        for queued in transaction:
+                            execute(queued)
+                        count += len(transaction)
+                        transaction = None
+                    else:
+                        transaction.append(frame)
+                    if transaction is None:
+                        good = fed - parser.buffered()
+                    frame = parser.gets()
+        if good < fed:
+            logging.warning(f"AOF {self.filename} ends with an incomplete command or transaction; "
+                            f"truncating {fed - good} bytes")
+            self._file.truncate(good)
+        return count
+
+    def rewrite(self, commands):
+        """Compact the log in a forked child from a copy-on-write view of the keyspace.
+
+        commands() yields the command tuples that rebuild the current dataset. The
+        child writes them to a temp file; meanwhile the parent keeps serving and
+        collects new commands in a rewrite buffer, which is appended to the temp file
+        before it atomically replaces the log.
+        """
+        if self._rewritepid is not None:
+            return False
+        self.flush()
+        tmpname = f"{self.filename}.rewrite.{os.getpid()}"
+        self._rewritebuf = bytearray()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._writecommands(tmpname, commands())
+                status = 0
+            except Exception:
+                logging.exception("AOF rewrite failed")
+            finally:
+                os._exit(status)
+        self._rewritepid = pid
+        threading.Thread(target=self._waitrewrite, args=(pid, tmpname), daemon=True).start()
+        return True
+
+    def _writecommands(self, filename, commands, chunksize=1 << 20):
+        buf = bytearray()
+        with open(filename, 'wb') as fh:
+            for args in commands:
+                self._protocol._write(buf, args)
+                if len(buf) >= chunksize:
+                    fh.write(buf)
+                    buf.clear()
+            fh.write(buf)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _waitrewrite(self, pid, tmpname):
+        _, status = os.waitpid(pid, 0)
+        try:
+            if status != 0:
+                logging.error(f"AOF rewrite child exited with status {status}")
+                return
+            with self._lock:
+                with open(tmpname, 'ab') as fh:
+                    fh.write(self._rewritebuf)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                # Everything still buffered for the old file is also in the rewrite buffer.
+                self._buf = bytearray()
+                self._file.close()
+                os.replace(tmpname, self.filename)
+                self._file = open(self.filename, 'ab')
+                self._written = self._synced = self._appended
+            self.rewrites += 1
+            logging.info(f"AOF rewrite of {self.filename} done")
+        finally:
+            self._rewritebuf = None
+            self._rewritepid = None
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+# Snapshot file layout:
+#   MAGIC, then records, each an opcode byte followed by its fields:
+#     OP_KEY  key value          OP_TTL  key int64-deadline
+#     OP_LISTLENGTH key int64    OP_EOF
+#   then the CRC32 of everything before it, as a little-endian uint32.
+# Keys and values use the tagged encoding below; every variable-size field is
+# length-prefixed, so loading never has to search for delimiters.
+MAGIC = b'MINIRDB1'
+OP_KEY, OP_TTL, OP_LISTLENGTH, OP_EOF = b'K', b'T', b'S', b'E'
+
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_INT64_MIN, _INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+
+def _encode(buf, value):
+    t = type(value)
+    if t is str:
+        value = value.encode('utf-8')
+        buf += b's'
+        buf += _U32.pack(len(value))
+        buf += value
+    elif t is int and _INT64_MIN <= value <= _INT64_MAX:
+        buf += b'i'
+        buf += _I64.pack(value)
+    elif t is bytes or t is bytearray:
+        buf += b'b'
+        buf += _U32.pack(len(value))
+        buf += value
+    elif value is None:
+        buf += b'N'
+    elif t is float:
+        buf += b'f'
+        buf += _F64.pack(value)
+    elif isinstance(value, ListValue):
+        buf += b'L'
+        buf += _I64.pack(-1 if value.maxlen is None else value.maxlen)
+        buf += _U32.pack(len(value))
+        for item in value:
+            _encode(buf, item)
+    elif isinstance(value, HashValue):
+        buf += b'H'
+        buf += _U32.pack(len(value))
+        for field, item in value.items():
+            _encode(buf, field)
+            _encode(buf, item)
+    elif isinstance(value, SetValue):
+        buf += b'U'
+        buf += _U32.pack(len(value))
+        for member in value:
+            _encode(buf, member)
+    elif isinstance(value, ZSetValue):
+        buf += b'Z'
+        buf += _U32.pack(len(value))
+        for member, score in value.items():
+            _encode(buf, member)
+            _encode(buf, score)
+    elif isinstance(value, StreamValue):
+        buf += b'X'
+        _encode(buf, value.dump())
+    elif isinstance(value, (HyperLogLog, BloomFilter)):
+        buf += b'P' if isinstance(value, HyperLogLog) else b'B'
+        _encode(buf, value.dump())
+    elif isinstance(value, (list, tuple)):
+        buf += b'l'
+        buf += _U32.pack(len(value))
+        for item in value:
+            _encode(buf, item)
+    elif isinstance(value, dict):
+        buf += b'd'
+        buf += _U32.pack(len(value))
+        for key, item in value.items():
+            _encode(buf, key)
+            _encode(buf, item)
+    elif isinstance(value, int):    # bools, and ints too big for int64.
+        value = str(int(value)).encode('ascii')
+        buf += b'I'
+        buf += _U32.pack(len(value))
+        buf += value
+    else:
+        raise ValueError(f"can't snapshot a value of type {type(value)}")
+
+
+def _decode(view, pos):
+    """Decode one value starting at view[pos]; returns (value, next position)."""
+    tag = view[pos]
+    pos += 1
+    if tag == 115:      # 's'
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        return str(view[pos:pos + n], 'utf-8'), pos + n
+    if tag == 105:      # 'i'
+        return _I64.unpack_from(view, pos)[0], pos + 8
+    if tag == 98:       # 'b'
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        return bytes(view[pos:pos + n]), pos + n
+    if tag == 78:       # 'N'
+        return None, pos
+    if tag == 102:      # 'f'
+        return _F64.unpack_from(view, pos)[0], pos + 8
+    if tag == 76 or tag == 108:    # 'L' ListValue, 'l' list
+        maxlen = None
+        if tag == 76:
+            maxlen, = _I64.unpack_from(view, pos)
+            pos += 8
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        items = []
+        append = items.append
+        for _ in range(n):
+            item, pos = _decode(view, pos)
+            append(item)
+        if tag == 76:
+            return ListValue(items, None if maxlen < 0 else maxlen), pos
+        return items, pos
+    if tag == 100:      # 'd'
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        result = {}
+        for _ in range(n):
+            key, pos = _decode(view, pos)
+            result[key], pos = _decode(view, pos)
+        return result, pos
+    if tag == 72 or tag == 90:     # 'H' hash, 'Z' sorted set: pairs.
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        pairs = []
+        for _ in range(n):
+            first, pos = _decode(view, pos)
+            second, pos = _decode(view, pos)
+            pairs.append((first, second))
+        return (HashValue(pairs) if tag == 72 else ZSetValue(pairs)), pos
+    if tag == 85:       # 'U' set
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        members = []
+        for _ in range(n):
+            member, pos = _decode(view, pos)
+            members.append(member)
+        return SetValue(members), pos
+    if tag == 88:       # 'X' stream
+        state, pos = _decode(view, pos)
+        return StreamValue.load(state), pos
+    if tag == 80 or tag == 66:     # 'P' HyperLogLog, 'B' Bloom filter
+        data, pos = _decode(view, pos)
+        return (HyperLogLog.load(data) if tag == 80 else BloomFilter.load(data)), pos
+    if tag == 73:       # 'I'
+        n, = _U32.unpack_from(view, pos)
+        pos += 4
+        return int(str(view[pos:pos + n], 'ascii')), pos + n
+    raise ValueError(f"corrupt snapshot: unknown value tag {tag!r} at offset {pos - 1}")
+
+
+def dump_snapshot(filename, kv, ttl, listlength, chunksize=1 << 20):
+    """Write the dataset to filename atomically (temp file + rename). Returns its size."""
+    tmpname = f"{filename}.tmp.{os.getpid()}"
+    crc = 0
+    size = 0
+    buf = bytearray(MAGIC)
+    try:
+        with open(tmpname, 'wb') as fh:
+            def spill():
+                nonlocal crc, size
+                crc = zlib.crc32(buf, crc)
+                size += len(buf)
+                fh.write(buf)
+                buf.clear()
+
+            for key, value in kv.items():
+                buf += OP_KEY
+                _encode(buf, key)
+                _encode(buf, value)
+                if len(buf) >= chunksize:
+                    spill()
+            for key, deadline in ttl.items():
+                buf += OP_TTL
+                _encode(buf, key)
+                buf += _I64.pack(deadline)
+            for key, length in listlength.items():
+                buf += OP_LISTLENGTH
+                _encode(buf, key)
+                buf += _I64.pack(length)
+            buf += OP_EOF
+            spill()
+            fh.write(_U32.pack(crc))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    return size + 4
+
+
+def load_snapshot(filename):
+    """Map the file and decode it in one pass. Returns (kv, ttl, listlength)."""
+    kv, ttl, listlength = {}, {}, {}
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < len(MAGIC) + 5:
+            raise ValueError(f"{filename} is too short to be a snapshot")
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                end = len(view) - 4
+                if bytes(view[:len(MAGIC)]) != MAGIC:
+                    raise ValueError(f"{filename} is not a snapshot file")
+                if zlib.crc32(view[:end]) != _U32.unpack_from(view, end)[0]:
+                    raise ValueError(f"{filename} failed its checksum")
+                pos = len(MAGIC)
+                while True:
+                    op = view[pos]
+                    pos += 1
+                    if op == 75:    # OP_KEY
+                        key, pos = _decode(view, pos)
+                        kv[key], pos = _decode(view, pos)
+                    elif op == 84:  # OP_TTL
+                        key, pos = _decode(view, pos)
+                        ttl[key], = _I64.unpack_from(view, pos)
+                        pos += 8
+                    elif op == 83:  # OP_LISTLENGTH
+                        key, pos = _decode(view, pos)
+                        listlength[key], = _I64.unpack_from(view, pos)
+                        pos += 8
+                    elif op == 69:  # OP_EOF
+                        break
+                    else:
+                        raise ValueError(f"corrupt snapshot: unknown record {op!r} at offset {pos - 1}")
+            finally:
+                view.release()
+    return kv, ttl, listlength
+
+
+class SnapshotFile(object):
+    """SAVE/BGSAVE bookkeeping around one snapshot file.
+
+    save() writes in the calling process. bgsave() forks: the child writes its
+    copy-on-write view of the dataset while the parent keeps serving, and a waiter
+    thread records the outcome once the child exits.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lastsave = int(time.time())
+        self.lastduration = -1      # seconds the last save took.
+        self.lastsize = -1          # bytes of the last saved file.
+        self.laststatus = 'ok'
+        self.loadduration = -1
+        self.changes = 0            # writes since the last successful save.
+        self._savepid = None
+
+    def in_progress(self):
+        return self._savepid is not None
+
+    def _saved(self, started, size, changes):
+        self.lastsave = int(time.time())
+        self.lastduration = time.time() - started
+        self.lastsize = size
+        self.laststatus = 'ok'
+        self.changes -= changes
+
+    def save(self, kv, ttl, listlength):
+        started = time.time()
+        changes = self.changes
+        try:
+            size = dump_snapshot(self.filename, kv, ttl, listlength)
+        except Exception:
+            self.laststatus = 'err'
+            raise
+        self._saved(started, size, changes)
+
+    def bgsave(self, kv, ttl, listlength):
+        if self._savepid is not None:
+            return False
+        started = time.time()
+        changes = self.changes
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                dump_snapshot(self.filename, kv, ttl, listlength)
+                status = 0
+            except Exception:
+                logging.exception("Background save failed")
+            finally:
+                os._exit(status)
+        self._savepid = pid
+        threading.Thread(target=self._waitsave, args=(pid, started, changes), daemon=True).start()
+        return True
+
+    def _waitsave(self, pid, started, changes):
+        try:
+            _, status = os.waitpid(pid, 0)
+            if status == 0:
+                self._saved(started, os.path.getsize(self.filename), changes)
+                logging.info(f"Background save to {self.filename} done")
+            else:
+                self.laststatus = 'err'
+                logging.error(f"Background save child exited with status {status}")
+        finally:
+            self._savepid = None
+
+    def load(self):
+        started = time.time()
+        result = load_snapshot(self.filename)
+        self.loadduration = time.time() - started
+        return result
@@ -0,0 +1,331 @@
+"""
+Probabilistic values: HyperLogLogs (PFADD/PFCOUNT/PFMERGE) and Bloom filters (BF.*).
+
+Both answer a question about a set without keeping its elements, in a fixed size
+however many go in: how many distinct elements there were, or whether one may have
+been seen (a Bloom filter never says no to an element it was given).
+
+HyperLogLog, as Redis does it: an element's 64-bit hash picks one of 16384 registers
+with its low 14 bits, and the register keeps the longest run of trailing zeros (plus
+one) seen in the other 50. The dense encoding packs the registers 6 bits each, in
+12KB, laid out as Redis lays them out. A new HyperLogLog starts sparse: a sorted
+array of register << 6 | value for the registers that are not zero, 4 bytes each,
+until it is past HLL_SPARSE_MAX_BYTES. The count is Ertl's improved estimator, as
+in Redis (standard error 0.81%), and is cached until the next change. Counting and
+merging unpack the registers a byte each with bytes.translate(), so no Python loop
+runs over all 16384 of them.
+
+Bloom filter: a bytearray of m bits, preallocated for a capacity and an error rate
+(m = -n ln p / ln(2)^2 bits, k = -log2 p hashes), with the k positions of an element
+derived from one 128-bit digest by double hashing. It doesn't grow: past its capacity
+the false-positive rate goes above the error rate it was made for.
+"""
+import math
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+
+
+HLL_P = 14
+HLL_REGISTERS = 1 << HLL_P
+HLL_Q = 64 - HLL_P
+HLL_DENSE_SIZE = HLL_REGISTERS * 6 // 8
+HLL_SPARSE_MAX_BYTES = 3000     # as Redis' hll-sparse-max-bytes.
+HLL_ALPHA_INF = 0.721347520444481703680
+# What GET returns and SET takes back, as Redis' HyperLogLog strings: magic,
+# encoding, 3 unused bytes, cached count (top bit set: stale), then the registers.
+_HLL_HEADER = struct.Struct('<4sB3xQ')
+_HLL_DENSE, _HLL_SPARSE = 0, 1
+_STALE = 1 << 63
+
+BF_ERROR_RATE = 0.01
+BF_CAPACITY = 10000         # a filter BF.ADD creates: 12KB of bits.
+BF_DUMP_CHUNK = 1 << 20     # bytes of bits per BF.SCANDUMP chunk.
+_BF_HEADER = struct.Struct('<dQQ')  # error rate, capacity, items added.
+
+
+def _itembytes(item):
+    if isinstance(item, bytes):
+        return item
+    if isinstance(item, bytearray):
+        return bytes(item)
+    return str(item).encode('utf-8')
+
+
+def _table(func):
+    return bytes([func(b) & 255 for b in range(256)])
+
+
+# Four 6-bit registers to three bytes and back. The parts a byte is made of never
+# overlap, so adding them (_addbytes) is the same as or-ing them.
+_R0, _R3 = _table(lambda b: b & 63), _table(lambda b: b >> 2)
+_R1LOW, _R1HIGH = _table(lambda b: b >> 6), _table(lambda b: (b & 15) << 2)
+_R2LOW, _R2HIGH = _table(lambda b: b >> 4), _table(lambda b: (b & 3) << 4)
+_B0HIGH, _B1LOW, _B1HIGH = _table(lambda b: b << 6), _table(lambda b: b >> 2), _table(lambda b: b << 4)
+_B2LOW, _B2HIGH = _table(lambda b: b >> 4), _table(lambda b: b << 2)
+
+
+def _addbytes(a, b):
+    """a + b byte by byte, for bytes whose sums stay below 256."""
+    return (int.from_bytes(a, 'little') + int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _unpack(dense):
+    """The registers of a dense HyperLogLog, one per byte."""
+    b0, b1, b2 = dense[0::3], dense[1::3], dense[2::3]
+    registers = bytearray(HLL_REGISTERS)
+    registers[0::4] = b0.translate(_R0)
+    registers[1::4] = _addbytes(b0.translate(_R1LOW), b1.translate(_R1HIGH))
+    registers[2::4] = _addbytes(b1.translate(_R2LOW), b2.translate(_R2HIGH))
+    registers[3::4] = b2.translate(_R3)
+    return registers
+
+
+def _pack(registers):
+    r0, r1, r2, r3 = registers[0::4], registers[1::4], registers[2::4], registers[3::4]
+    dense = bytearray(HLL_DENSE_SIZE)
+    dense[0::3] = _addbytes(r0, r1.translate(_B0HIGH))
+    dense[1::3] = _addbytes(r1.translate(_B1LOW), r2.translate(_B1HIGH))
+    dense[2::3] = _addbytes(r2.translate(_B2LOW), r3.translate(_B2HIGH))
+    return dense
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+def estimate(registers):
+    """The cardinality registers (one per byte) stand for."""
+    histogram = [registers.count(value) for value in range(HLL_Q + 2)]
+    m = HLL_REGISTERS
+    z = m * _tau((m - histogram[HLL_Q + 1]) / m)
+    for k in range(HLL_Q, 0, -1):
+        z = 0.5 * (z + histogram[k])
+    z += m * _sigma(histogram[0] / m)
+    return round(HLL_ALPHA_INF * m * m / z)
+
+
+def union(hyperloglogs):
+    """The registers of the union of hyperloglogs, one per byte."""
+    registers = bytearray(HLL_REGISTERS)
+    for hll in hyperloglogs:
+        hll.maxinto(registers)
+    return registers
+
+
+class HyperLogLog(object):
+    __slots__ = ('_sparse', '_dense', '_count')
+
+    def __init__(self):
+        self._sparse = array('I')   # register << 6 | value, sorted, for the registers not 0.
+        self._dense = None          # the packed registers, once converted.
+        self._count = 0             # None: changed since it was counted.
+
+    @property
+    def encoding(self):
+        return 'sparse' if self._dense is None else 'dense'
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._sparse if self._dense is None else self._dense)
+
+    def add(self, items):
+        """Count items in; returns whether a register changed (PFADD's reply)."""
+        changed = False
+        for item in items:
+            h = int.from_bytes(blake2b(_itembytes(item), digest_size=8).digest(), 'little')
+            rest = h >> HLL_P | 1 << HLL_Q      # the set bit bounds the run at HLL_Q + 1.
+            register, value = h & (HLL_REGISTERS - 1), (rest & -rest).bit_length()
+            if self._dense is None:
+                changed |= self._sparseset(register, value)
+            else:
+                changed |= self._denseset(register, value)
+        if changed:
+            self._count = None
+        return changed
+
+    def _sparseset(self, register, value):
+        entries = self._sparse
+        i = bisect_left(entries, register << 6)
+        if i < len(entries) and entries[i] >> 6 == register:
+            if entries[i] & 63 >= value:
+                return False
+            entries[i] = register << 6 | value
+            return True
+        entries.insert(i, register << 6 | value)
+        if len(entries) * entries.itemsize > HLL_SPARSE_MAX_BYTES:
+            self._dense = _pack(self.registers())
+            self._sparse = array('I')
+        return True
+
+    def _denseset(self, register, value):
+        dense = self._dense
+        offset = register * 6
+        i, shift = offset >> 3, offset & 7
+        current = dense[i] >> shift
+        if shift > 2:   # it runs on into the next byte.
+            current |= dense[i + 1] << (8 - shift)
+        if current & 63 >= value:
+            return False
+        dense[i] = (dense[i] & ~(63 << shift) | value << shift) & 255
+        if shift > 2:
+            dense[i + 1] = (dense[i + 1] & ~(63 >> (8 - shift)) | value >> (8 - shift)) & 255
+        return True
+
+    def registers(self):
+        if self._dense is not None:
+            return _unpack(self._dense)
+        registers = bytearray(HLL_REGISTERS)
+        for entry in self._sparse:
+            registers[entry >> 6] = entry & 63
+        return registers
+
+    def maxinto(self, registers):
+        """Raise registers (one per byte) to this HyperLogLog's where they are lower."""
+        if self._dense is None:
+            for entry in self._sparse:
+                if registers[entry >> 6] < entry & 63:
+                    registers[entry >> 6] = entry & 63
+        else:
+            registers[:] = bytes(map(max, registers, _unpack(self._dense)))
+
+    def merge(self, others):
+        """PFMERGE: become the union of self and others (dense, as in Redis)."""
+        registers = self.registers()
+        for other in others:
+            other.maxinto(registers)
+        self._dense = _pack(registers)
+        self._sparse = array('I')
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = estimate(self.registers())
+        return self._count
+
+    def dump(self):
+        if self._dense is not None:
+            encoding, registers = _HLL_DENSE, bytes(self._dense)
+        else:
+            entries = array('I', self._sparse)
+            if sys.byteorder != 'little':
+                entries.byteswap()
+            encoding, registers = _HLL_SPARSE, entries.tobytes()
+        count = _STALE if self._count is None else self._count
+        return _HLL_HEADER.pack(b'HYLL', encoding, count) + registers
+
+    @classmethod
+    def load(cls, data):
+        """The HyperLogLog dump() wrote; ValueError if data is anything else."""
+        if not isinstance(data, (bytes, bytearray)) or len(data) < _HLL_HEADER.size:
+            raise ValueError('not a HyperLogLog')
+        magic, encoding, count = _HLL_HEADER.unpack_from(data)
+        registers = data[_HLL_HEADER.size:]
+        hll = cls()
+        if magic != b'HYLL' or encoding not in (_HLL_DENSE, _HLL_SPARSE):
+            raise ValueError('not a HyperLogLog')
+        if encoding == _HLL_DENSE:
+            if len(registers) != HLL_DENSE_SIZE:
+                raise ValueError('not a HyperLogLog')
+            hll._dense = bytearray(registers)
+        else:
+            if len(registers) % hll._sparse.itemsize:
+                raise ValueError('not a HyperLogLog')
+            hll._sparse.frombytes(registers)
+            if sys.byteorder != 'little':
+                hll._sparse.byteswap()
+        hll._count = None if count & _STALE else count
+        return hll
+
+
+class BloomFilter(object):
+    __slots__ = ('bits', 'hashes', 'capacity', 'error_rate', 'items')
+
+    def __init__(self, error_rate=BF_ERROR_RATE, capacity=BF_CAPACITY):
+        if not 0 < error_rate < 1:
+            raise ValueError('error rate must be between 0 and 1')
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.bits = bytearray((nbits + 7) // 8)
+        self.hashes = max(1, math.ceil(-math.log2(error_rate)))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.items = 0      # adds that set a bit: an estimate of the distinct items in it.
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.bits)
+
+    def _positions(self, item):
+        digest = blake2b(_itembytes(item), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        nbits = len(self.bits) * 8
+        return [(h1 + i * h2) % nbits for i in range(self.hashes)]
+
+    def add(self, item):
+        """Set item's bits; returns whether one was not set yet (so item was surely new)."""
+        bits = self.bits
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.items += 1
+        return added
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & 1 << (position & 7):
+                return False
+        return True
+
+    def header(self):
+        return _BF_HEADER.pack(self.error_rate, self.capacity, self.items)
+
+    @classmethod
+    def fromheader(cls, data):
+        """An empty filter made like the one header() describes; ValueError if data isn't one."""
+        if not isinstance(data, (bytes, bytearray)) or len(data) != _BF_HEADER.size:
+            raise ValueError('not a Bloom filter header')
+        error_rate, capacity, items = _BF_HEADER.unpack(data)
+        bloom = cls(error_rate, capacity)
+        bloom.items = items
+        return bloom
+
+    def dump(self):
+        return self.header() + bytes(self.bits)
+
+    @classmethod
+    def load(cls, data):
+        bloom = cls.fromheader(data[:_BF_HEADER.size])
+        if len(data) - _BF_HEADER.size != len(bloom.bits):
+            raise ValueError('not a Bloom filter')
+        bloom.bits[:] = data[_BF_HEADER.size:]
+        return bloom
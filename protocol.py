@@ -1,144 +1,685 @@
-import threading, time, sys
+import threading, time, sys, os
+from time import perf_counter_ns
+import heapq, socket, random, tempfile
 
-from gevent import socket
+import gevent
+import gevent.event
+from gevent.local import local
 from gevent.pool import Pool
 from gevent.server import StreamServer
 
-from collections import namedtuple
-from io import BytesIO
+from collections import namedtuple, deque, OrderedDict
+from itertools import islice
 import logging
 
+from datatypes import HashValue, SetValue, ZSetValue, COLLECTION_TYPES, ENTRY_OVERHEAD
+from streams import StreamValue, ConsumerGroup, StreamRead, MINID, MAXID, formatid, parseid, nextid
+from probabilistic import HyperLogLog, BloomFilter, BF_DUMP_CHUNK, estimate, union
+from pubsub import Subscriber, PatternIndex, channelname, globregex
+from latency import Histogram, SlowLog, LatencyMonitor
+
 
 class CommandError(Exception): pass
+class WatchError(CommandError): pass    # EXEC found a WATCHed key changed; nothing ran.
 class Disconnect(Exception): pass
 
 Error = namedtuple('Error', ('message',))
 
 
-class ProtocolHandler(object):
+class ListValue(deque):
+    """The list type stored in Server._kv.
+
+    Backed by a deque so push and pop are O(1) at both ends. A SETLENGTH cap is
+    kept as the deque's maxlen: LPUSH on a full list drops items from the tail
+    inside deque itself, and RPUSH only appends what still fits, which is what the
+    old trimming loops did one pop at a time.
+    """
+
+    @classmethod
+    def capped(cls, items=(), limit=None):
+        """Build a list holding at most `limit` items, keeping the head."""
+        if limit is not None:
+            items = islice(items, limit)
+        return cls(items, limit)
+
+    def push_left(self, values):
+        self.extendleft(values)
+        return len(self)
+
+    def push_right(self, values):
+        if self.maxlen is not None:
+            values = values[:max(self.maxlen - len(self), 0)]
+        self.extend(values)
+        return len(self)
+
+
+NEED_MORE = object()    # RespParser.gets() result when no complete frame is buffered yet.
+
+
+class RespParser(object):
+    """Incremental parser for the wire protocol, working over one receive buffer.
+
+    feed() appends raw bytes as they arrive; gets() returns the next complete
+    frame or NEED_MORE. Frame boundaries are found with bytearray.find(), bulk
+    payloads are sliced once out of a memoryview, and a half-received array keeps
+    the elements parsed so far, so a big MSET arriving in many chunks is only
+    parsed once. '+' payloads stay bytes; '$' payloads are decoded straight from
+    the buffer because the protocol promises the caller a str for them.
+    """
     def __init__(self):
-        self.handlers = {
-            b'+': self.handle_bytes,
-            b'-': self.handle_error,
-            b':': self.handle_integer,
-            b'?': self.handle_float,
-            b'$': self.handle_string,
-            b'*': self.handle_array,
-            b'%': self.handle_dict}
-
-    def handle_request(self, socket_file):
-        first_byte = socket_file.read(1)
-        if not first_byte:
-            raise Disconnect()
-        #logging.warning(f"Received: {first_byte}")
+        self._buf = bytearray()
+        self._pos = 0
+        self._need = 0      # buffer length required before a pending bulk payload is complete.
+        self._stack = []    # [kind, items, expected] for each array/dict being filled.
+
+    def feed(self, data):
+        if self._pos and self._pos * 2 >= len(self._buf):
+            del self._buf[:self._pos]
+            self._need -= self._pos
+            self._pos = 0
+        self._buf += data
+
+    def buffered(self):
+        return len(self._buf) - self._pos
+
+    def gets(self):
+        buf = self._buf
+        if len(buf) < self._need:
+            return NEED_MORE
+        view = memoryview(buf)
         try:
-            # Delegate to the appropriate handler based on the first byte.
-            return self.handlers[first_byte](socket_file)
-        except KeyError:
-            raise CommandError('bad request')
-
-    def handle_bytes(self, socket_file):
-        length = int(socket_file.readline())
-        length += 2  # Include the trailing \r\n in count.
-        return socket_file.read(length)[:-2]
-
-    def handle_error(self, socket_file):
-        return Error(socket_file.readline())
-
-    def handle_integer(self, socket_file):
-        return int(socket_file.readline())
-
-    def handle_float(self, socket_file):
-        return float(socket_file.readline())
-
-    def handle_string(self, socket_file):
-        # First read the length ($<length>\r\n).
-        length = int(socket_file.readline())
-
-        if length == -1:
-            return None  # Special-case for NULLs.
-        length += 2  # Include the trailing \r\n in count.
-        return socket_file.read(length)[:-2].decode("utf-8")
-
-    def handle_array(self, socket_file):
-        num_elements = int(socket_file.readline())
-        #logging.warning(f"Received {num_elements} in handle_array")
-        return [self.handle_request(socket_file) for _ in range(num_elements)]
-    
-    def handle_dict(self, socket_file):
-        num_items = int(socket_file.readline())
-        elements = [self.handle_request(socket_file)
-                    for _ in range(num_items * 2)]
-        return dict(zip(elements[::2], elements[1::2]))
-
-    def write_response(self, socket_file, data):
-        buf = BytesIO()
-        self._write(buf, data)
-        buf.seek(0)
-        tosend = buf.getvalue()
+            return self._parse(buf, view)
+        finally:
+            view.release()
+
+    def _parse(self, buf, view):
+        pos = self._pos
+        stack = self._stack
+        while True:
+            end = buf.find(b'\r\n', pos + 1)
+            if end < 0:
+                return NEED_MORE
+            kind = buf[pos]
+            if kind == 36 or kind == 43:    # '$' string, '+' bytes.
+                length = int(buf[pos + 1:end])
+                if length == -1:
+                    value = None
+                    pos = end + 2
+                else:
+                    start = end + 2
+                    pos = start + length + 2
+                    if len(buf) < pos:
+                        self._need = pos
+                        return NEED_MORE
+                    if kind == 36:
+                        value = str(view[start:start + length], 'utf-8')
+                    else:
+                        value = bytes(view[start:start + length])
+            elif kind == 58:    # ':'
+                value = int(buf[pos + 1:end])
+                pos = end + 2
+            elif kind == 63:    # '?'
+                value = float(buf[pos + 1:end])
+                pos = end + 2
+            elif kind == 45:    # '-'
+                value = Error(str(view[pos + 1:end], 'utf-8'))
+                pos = end + 2
+            elif kind == 42 or kind == 37:  # '*' array, '%' dict.
+                count = int(buf[pos + 1:end])
+                pos = end + 2
+                if kind == 37:
+                    count *= 2
+                if count > 0:
+                    stack.append([kind, [], count])
+                    self._pos = pos
+                    continue
+                value = [] if kind == 42 else {}
+            else:
+                raise CommandError('bad request')
+
+            # A complete value: attach it to the enclosing arrays, closing those now full.
+            while stack:
+                frame = stack[-1]
+                frame[1].append(value)
+                if len(frame[1]) < frame[2]:
+                    break
+                stack.pop()
+                items = frame[1]
+                value = items if frame[0] == 42 else dict(zip(items[::2], items[1::2]))
+            self._pos = pos
+            self._need = 0
+            if not stack:
+                return value
+
+
+class SocketReader(object):
+    """Blocking frame reader: feeds a RespParser from a socket as frames are needed."""
+    def __init__(self, conn, bufsize=65536):
+        self._conn = conn
+        self._bufsize = bufsize
+        self._parser = RespParser()
+
+    def read_frame(self, on_wait=None):
+        """Return the next frame, calling on_wait() before each blocking recv()."""
+        frame = self._parser.gets()
+        while frame is NEED_MORE:
+            if on_wait is not None:
+                on_wait()
+            chunk = self._conn.recv(self._bufsize)
+            if not chunk:
+                raise Disconnect()
+            self._parser.feed(chunk)
+            frame = self._parser.gets()
+        return frame
+
+
+def sizeof(value):
+    """Approximate bytes held by value, including what its containers reference."""
+    t = type(value)
+    if t is str or t is bytes or t is int or t is float or value is None:
+        return sys.getsizeof(value)
+    if isinstance(value, (list, tuple, deque)):
+        return sys.getsizeof(value) + sum([sizeof(item) for item in value])
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum([sizeof(k) + sizeof(v) for k, v in value.items()])
+    if isinstance(value, COLLECTION_TYPES):
+        return sys.getsizeof(value) + sum([sizeof(item) for item in value.elements()])
+    return sys.getsizeof(value)
+
+
+LFU_INIT_VAL = 5        # LFU counter of a new key, so it isn't evicted before it had a chance.
+LFU_LOG_FACTOR = 10     # higher: the counter grows more slowly (logarithmic, saturates at 255).
+LFU_DECAY_TIME = 1      # minutes of no access that take 1 off the counter.
+
+
+class KeyspaceIndex(object):
+    """Approximate memory and access statistics per key, for maxmemory eviction.
+
+    Keys also sit in a dense array (swap-removed on delete), so sample() draws
+    random keys in O(1) and eviction never walks the keyspace. Per key it keeps
+    [slot, size, last access in ms, LFU counter, minute of the last LFU decay].
+    """
+    def __init__(self):
+        self.used = 0
+        self._keys = []
+        self._meta = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self.used = 0
+        self._keys = []
+        self._meta = {}
+
+    def set(self, key, size):
+        meta = self._meta.get(key)
+        if meta is None:
+            now = mstime()
+            self._meta[key] = [len(self._keys), size, now, LFU_INIT_VAL, now // 60000]
+            self._keys.append(key)
+        else:
+            self.used -= meta[1]
+            meta[1] = size
+        self.used += size
+
+    def adjust(self, key, delta):
+        meta = self._meta.get(key)
+        if meta is not None:
+            meta[1] += delta
+            self.used += delta
+
+    def size(self, key):
+        meta = self._meta.get(key)
+        return 0 if meta is None else meta[1]
+
+    def scan(self, cursor, count):
+        """Up to count keys of the dense array, walking down from its end: (cursor, keys).
+
+        The cursor is how many slots are still to visit (0 starts a scan, and comes back
+        when it is done). A delete moves the last key into the freed slot, so a key never
+        moves from the part still to visit into the part visited: like Redis' SCAN, every
+        key present for the whole scan is returned, whatever happened to the dict.
+        """
+        keys = self._keys
+        remaining = len(keys) if cursor == 0 else min(cursor, len(keys))
+        stop = max(remaining - count, 0)
+        return stop, keys[stop:remaining][::-1]
+
+    def remove(self, key):
+        meta = self._meta.pop(key, None)
+        if meta is None:
+            return
+        self.used -= meta[1]
+        last = self._keys.pop()
+        if last != key:
+            self._keys[meta[0]] = last
+            self._meta[last][0] = meta[0]
+
+    def touch(self, key):
+        meta = self._meta.get(key)
+        if meta is None:
+            return
+        now = mstime()
+        meta[2] = now
+        counter = self._decayed(meta, now // 60000)
+        if counter < 255:
+            base = counter - LFU_INIT_VAL
+            if base <= 0 or random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+                meta[3] = counter + 1
+
+    def _decayed(self, meta, minutes):
+        elapsed = minutes - meta[4]
+        if elapsed >= LFU_DECAY_TIME:
+            meta[3] = max(meta[3] - elapsed // LFU_DECAY_TIME, 0)
+            meta[4] = minutes
+        return meta[3]
+
+    def sample(self, count):
+        keys = self._keys
+        if not keys:
+            return []
+        return [keys[random.randrange(len(keys))] for _ in range(count)]
+
+    def lastaccess(self, key):
+        return self._meta[key][2]
+
+    def frequency(self, key):
+        return self._decayed(self._meta[key], mstime() // 60000)
+
+
+class BlockedClient(object):
+    """A client parked in BLPOP/BRPOP/BGET/XREAD... on one or more keys.
+
+    Whoever makes one of its keys ready pops the value on its behalf, stores it in
+    key/value and sets wakeup, so a woken client never has to race for the value.
+    """
+    __slots__ = ('command', 'keys', 'move', 'wakeup', 'key', 'value')
+
+    def __init__(self, command, keys, wakeup, move=None):
+        self.command = command
+        self.keys = keys
+        self.move = move        # BLMOVE: (destination, wherefrom, whereto); XREAD/XREADGROUP: its StreamRead.
+        self.wakeup = wakeup    # anything with set(): a gevent Event, or an asyncio future wrapper.
+        self.key = None
+        self.value = None
+
+
+# A reply that already went out through Subscriber.push(); there is nothing left to write.
+PUSHED = object()
+
+
+class Transaction(object):
+    """A connection's MULTI/WATCH state: the queued commands and the key versions it saw."""
+    __slots__ = ('queued', 'aborted', 'watched')
+
+    def __init__(self):
+        self.queued = None      # a list between MULTI and EXEC.
+        self.aborted = False    # a command failed to queue; EXEC will refuse.
+        self.watched = {}       # key -> its version when WATCHed.
+
+
+class SocketWriter(object):
+    """Buffered write side of a connection.
+
+    Replies are encoded straight into one bytearray that is reused for the life of
+    the connection and sent with a single sendall() on flush().
+
+    Pub/Sub messages come from other greenlets through push(). From the first push
+    on, a writer greenlet owns the socket and flush() hands it the replies too, so
+    both leave in the order they were produced and a publisher never waits on a slow
+    subscriber. Past pushlimit bytes queued, the client is disconnected.
+    """
+    def __init__(self, conn, protocol, highwater=65536, pushlimit=32 * 1024 * 1024):
+        self._conn = conn
+        self._protocol = protocol
+        self._highwater = highwater
+        self.buffer = bytearray()
+        self.pushlimit = pushlimit
+        self._pushed = None     # deque of bytes objects, shared with other subscribers' queues.
+        self._pushedbytes = 0
+        self._overflowed = False
+        self._wakeup = None
+        self._drainer = None
+
+    def write(self, data):
+        start = len(self.buffer)
         try:
-            logging.debug(tosend.decode('utf-8'))
-        except UnicodeDecodeError:
-            logging.debug("contains byte info that can't be decode to utf-8")
-            pass
-        socket_file.write(tosend)
-        socket_file.flush()
+            self._protocol._write(self.buffer, data)
+        except Exception:
+            del self.buffer[start:]     # never leave half a reply in the stream.
+            raise
+        if len(self.buffer) >= self._highwater:
+            self.flush()
 
+    def flush(self):
+        if self._pushed is not None:
+            if self.buffer:
+                self._queue(bytes(self.buffer))
+                self.buffer.clear()
+            return
+        if self.buffer:
+            self._conn.sendall(self.buffer)
+            if len(self.buffer) > self._highwater:
+                self.buffer = bytearray()   # don't keep a huge reply's memory around.
+            else:
+                self.buffer.clear()
+
+    def push(self, data, limit=None):
+        """Queue bytes to send after everything written so far; never blocks.
+
+        Past limit bytes queued (pushlimit by default) the client is disconnected.
+        """
+        if self._pushed is None:
+            self._pushed = deque()
+            self._wakeup = gevent.event.Event()
+            self._drainer = gevent.spawn(self._drain)
+        if self.buffer:
+            self._queue(bytes(self.buffer))
+            self.buffer.clear()
+        self._queue(data, limit)
+
+    def _queue(self, data, limit=None):
+        if self._overflowed:
+            return
+        self._pushed.append(data)
+        self._pushedbytes += len(data)
+        self._wakeup.set()
+        if self._pushedbytes > (limit or self.pushlimit):
+            self._overflowed = True
+            logging.warning(f'Closing a client that fell {self._pushedbytes} bytes behind on its output')
+            try:
+                self._conn.shutdown(socket.SHUT_RDWR)   # its connection greenlet sees EOF and cleans up.
+            except OSError:
+                pass
 
-    """Write the commands recursively, to a buffer (a BytesIO)."""
-    def _write(self, buf, data):
-        # if isinstance(data, str):
-        #     data = data.encode('utf-8')   # this is for python2. in python3, all data are in utf-8.
+    def _drain(self):
+        pushed = self._pushed
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while pushed:
+                chunks = [pushed.popleft() for _ in range(min(len(pushed), _IOV_MAX))]
+                try:
+                    _sendmsgall(self._conn, chunks)
+                except OSError:
+                    return
+                self._pushedbytes -= sum([len(chunk) for chunk in chunks])
 
-        if isinstance(data, bytes):
-            buf.write(f'+{len(data)}\r\n'.encode('utf-8'))
-            buf.write(data)
-            buf.write("\r\n".encode('utf-8'))
-        elif isinstance(data, str):
-            buf.write(f'${len(data)}\r\n{data}\r\n'.encode('utf-8'))
-        elif isinstance(data, int):
-            buf.write(f':{data}\r\n'.encode('utf-8') )
-        elif isinstance(data, float):
-            buf.write(f'?{data}\r\n'.encode('utf-8'))
-        elif isinstance(data, Error):
-            buf.write(f'-{Error.message}\r\n'.encode('utf-8') )
-        elif isinstance(data, (list, tuple)):
-            buf.write(f'*{len(data)}\r\n'.encode('utf-8'))
+    def close(self):
+        if self._drainer is not None:
+            self._drainer.kill(block=False)
+
+
+_IOV_MAX = 1024
+
+
+def _sendmsgall(conn, chunks):
+    """sendall() for a list of buffers, gathered by sendmsg() instead of joined."""
+    views = deque([memoryview(chunk) for chunk in chunks])
+    while views:
+        sent = conn.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.popleft())
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+# Precomputed reply fragments; anything past _CACHED is formatted on demand.
+_CACHED = 1024
+_CRLF = b'\r\n'
+_NULL = b'$-1\r\n'
+_INTEGERS = [b':%d\r\n' % i for i in range(_CACHED)]
+_STRING_HEADERS = [b'$%d\r\n' % i for i in range(_CACHED)]
+_BYTES_HEADERS = [b'+%d\r\n' % i for i in range(_CACHED)]
+_ARRAY_HEADERS = [b'*%d\r\n' % i for i in range(_CACHED)]
+_DICT_HEADERS = [b'%%%d\r\n' % i for i in range(_CACHED)]
+
+
+def mstime():
+    """Wall clock in milliseconds; key deadlines are stored as absolute mstime() values."""
+    return int(time.time() * 1000)
+
+
+class ProtocolHandler(object):
+    def handle_request(self, reader, on_wait=None):
+        return reader.read_frame(on_wait)
+
+    def write_response(self, writer, data, flush=True):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            start = len(writer.buffer)
+            writer.write(data)
+            logging.debug(bytes(writer.buffer[start:]).decode('utf-8', 'replace'))
+        else:
+            writer.write(data)
+        if flush:
+            writer.flush()
+
+    """Write the commands recursively, appending to a buffer (a bytearray)."""
+    def _write(self, buf, data):
+        t = type(data)
+        if t is str:
+            data = data.encode('utf-8')
+            n = len(data)
+            buf += _STRING_HEADERS[n] if n < _CACHED else b'$%d\r\n' % n
+            buf += data
+            buf += _CRLF
+        elif t is int:
+            buf += _INTEGERS[data] if 0 <= data < _CACHED else b':%d\r\n' % data
+        elif data is None:
+            buf += _NULL
+        elif t is bytes or t is bytearray:
+            n = len(data)
+            buf += _BYTES_HEADERS[n] if n < _CACHED else b'+%d\r\n' % n
+            buf += data
+            buf += _CRLF
+        elif t is float:
+            buf += b'?%r\r\n' % data
+        elif t is Error:
+            buf += b'-%s\r\n' % str(data.message).replace('\r\n', ' ').encode('utf-8')
+        elif isinstance(data, (list, tuple, deque)):
+            n = len(data)
+            buf += _ARRAY_HEADERS[n] if n < _CACHED else b'*%d\r\n' % n
+            write = self._write
             for item in data:
-                self._write(buf, item)
+                if type(item) is str:     # the common MGET/LRANGE case, inlined.
+                    item = item.encode('utf-8')
+                    n = len(item)
+                    buf += _STRING_HEADERS[n] if n < _CACHED else b'$%d\r\n' % n
+                    buf += item
+                    buf += _CRLF
+                else:
+                    write(buf, item)
         elif isinstance(data, dict):
-            buf.write(f'%{len(data)}\r\n'.encode('utf-8') )
+            n = len(data)
+            buf += _DICT_HEADERS[n] if n < _CACHED else b'%%%d\r\n' % n
             for key in data:
                 self._write(buf, key)
                 self._write(buf, data[key])
-        elif data is None:
-            buf.write('$-1\r\n'.encode('utf-8'))
+        elif isinstance(data, bool):
+            buf += _INTEGERS[int(data)]
+        elif isinstance(data, int):
+            buf += b':%d\r\n' % data
+        elif isinstance(data, float):
+            buf += b'?%r\r\n' % data
+        elif isinstance(data, str):
+            self._write(buf, str(data))
+        elif isinstance(data, bytes):
+            self._write(buf, bytes(data))
+        elif isinstance(data, HashValue):
+            self._write(buf, dict(data.items()))
+        elif isinstance(data, (SetValue, ZSetValue)):
+            self._write(buf, list(data))
+        elif isinstance(data, StreamValue):
+            self._write(buf, list(data.entries()))
+        elif isinstance(data, (HyperLogLog, BloomFilter)):
+            self._write(buf, data.dump())
         else:
             raise CommandError('unrecognized type: %s' % type(data))
 
 
 class Server(object):
-    def __init__(self, host='127.0.0.1', port=31337, max_clients=64):
+    BACKEND = 'gevent'
+    # Commands that change the dataset; they are logged to the AOF as received unless the
+    # command rewrites its own entry through _rewritecommand() (see get_response).
+    WRITE_COMMANDS = {'SET', 'DELETE', 'UNLINK', 'FLUSH', 'MSET', 'LPUSH', 'RPUSH', 'LPOP', 'RPOP', 'BLPOP', 'BRPOP',
+                      'EXPIRE', 'PEXPIRE', 'PEXPIREAT', 'PERSIST', 'FLUSHALL', 'BGET', 'SETLENGTH',
+                      'LMOVE', 'BLMOVE', 'RPOPLPUSH', 'BRPOPLPUSH', 'LTRIM', 'LREM',
+                      'HSET', 'HDEL', 'HINCRBY', 'SADD', 'SREM', 'ZADD', 'ZREM',
+                      'XADD', 'XTRIM', 'XGROUP', 'XREADGROUP', 'XACK', 'XCLAIM',
+                      'PFADD', 'PFMERGE', 'BF.RESERVE', 'BF.ADD', 'BF.MADD', 'BF.LOADCHUNK'}
+    # Commands that may wait for another client's write before they answer, and how
+    # long they wait when the request gives no timeout.
+    BLOCKING_COMMANDS = {'BLPOP', 'BRPOP', 'BGET', 'BLMOVE', 'BRPOPLPUSH', 'XREAD', 'XREADGROUP'}
+    BLOCKING_TIMEOUTS = {'BLPOP': 60, 'BRPOP': 30, 'BGET': 30}
+    # Write commands that can grow memory; refused once over maxmemory and nothing can be evicted.
+    DENYOOM_COMMANDS = {'SET', 'MSET', 'LPUSH', 'RPUSH', 'HSET', 'HINCRBY', 'SADD', 'ZADD', 'XADD',
+                        'PFADD', 'PFMERGE', 'BF.RESERVE', 'BF.ADD', 'BF.MADD', 'BF.LOADCHUNK'}
+    MAXMEMORY_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'volatile-ttl')
+    # Handled per connection, around the command table (see _execute).
+    TRANSACTION_COMMANDS = ('MULTI', 'EXEC', 'DISCARD', 'WATCH', 'UNWATCH')
+    # Run a registered function (see functions.py); its writes are logged as the commands it ran.
+    FUNCTION_COMMANDS = {'FCALL', 'EVALSHA'}
+    # What a function may not call: it would wait, fork, or run another function.
+    FUNCTION_DENIED_COMMANDS = BLOCKING_COMMANDS | FUNCTION_COMMANDS | {'FUNCTION', 'SAVE', 'BGSAVE', 'BGREWRITEAOF'}
+    # Handled per connection like TRANSACTION_COMMANDS; once subscribed, a connection
+    # only takes these and SUBSCRIBED_COMMANDS.
+    PUBSUB_COMMANDS = ('SUBSCRIBE', 'UNSUBSCRIBE', 'PSUBSCRIBE', 'PUNSUBSCRIBE')
+    SUBSCRIBED_COMMANDS = {'PING'}
+    # Reads whose keys CLIENT TRACKING remembers (what Client's cache holds), and the
+    # channel the invalidations are published on to the REDIRECT connection.
+    TRACKED_COMMANDS = {'GET', 'MGET'}
+    INVALIDATE_CHANNEL = '__redis__:invalidate'
+    REPL_BACKLOG_SIZE = 1024 * 1024
+    LAZYFREE_BUDGET = 0.001    # seconds of freeing between two turns of the other clients.
+    READONLY_ERROR = "READONLY You can't write against a read only replica."
+
+    def __init__(self, host='127.0.0.1', port=31337, max_clients=64, appendonly=None, appendfsync='everysec',
+                 dbfilename='dump.mrdb', maxmemory=0, maxmemory_policy='noeviction', maxmemory_samples=5,
+                 listener=None, ttlthread=True, functions=None, pubsub_buffer_limit=32 * 1024 * 1024,
+                 latency_tracking=True, slowlog_log_slower_than=10000, slowlog_max_len=128,
+                 latency_monitor_threshold=100, replicaof=None, repl_backlog_size=REPL_BACKLOG_SIZE,
+                 repl_buffer_limit=256 * 1024 * 1024):
+        if maxmemory_policy not in self.MAXMEMORY_POLICIES:
+            raise ValueError(f"maxmemory_policy must be one of {self.MAXMEMORY_POLICIES}")
         self._pool = Pool(max_clients)
         self._server = StreamServer(
-            (host, port),
+            listener if listener is not None else (host, port),    # a pre-bound socket may be given.
             self.connection_handler,
             spawn=self._pool)
 
         self._protocol = ProtocolHandler()
         self._kv = {}
-        self._queue = {}    # for callback.
-        self._ttl = {}
+        self._blocked = {}  # key -> OrderedDict of the BlockedClients waiting on it, oldest first.
+        self._handoffs = []     # pops done for blocked clients, logged after the running command.
+        self._local = local()   # per connection greenlet: the socket, to notice a blocked client leaving.
+        self._versions = {}     # WATCHed key -> [version, number of watchers]; bumped by _touch().
+        self._inexec = False    # running an EXEC: blocking commands must not wait.
+        self._ttl = {}      # key -> absolute deadline, in mstime() milliseconds.
+        self._expiryheap = []   # (deadline, key); entries whose deadline no longer matches _ttl are stale.
+        self._expirywakeup = threading.Event()
         self._listlength = {}   # for SETLENGTH
+        self._propagateargs = None   # what the running write command will log.
+        self._propagating = False    # writes go to an append-only file or replicas; see _updatepropagating.
+        self._index = KeyspaceIndex()
+        self._maxmemory = int(maxmemory)
+        self._maxmemorypolicy = maxmemory_policy
+        self._maxmemorysamples = int(maxmemory_samples)
+        self._trackaccess = maxmemory_policy in ('allkeys-lru', 'allkeys-lfu')
+        self._evicted = 0
+        from lazyfree import LazyFreer
+        self._lazyfreer = LazyFreer()
+        self._lazyfreeing = False   # a background free is scheduled; see _lazyfree().
+        # INFO counters; all O(1) to read.
+        self._starttime = time.time()
+        self._connectedclients = 0
+        self._totalconnections = 0
+        self._blockedclients = 0
+        self._commandsprocessed = 0
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._opssamples = deque(maxlen=16)     # ops/sec over the last 16 sample periods.
+        self._lastsample = (time.monotonic(), 0)
+        # Latency: per-command histograms (ns), the slow log (threshold in µs, as Redis'
+        # slowlog-log-slower-than) and spikes of latency_monitor_threshold ms or more.
+        self._latencytracking = latency_tracking
+        self._histograms = {}
+        # Per command, the durations not in its histogram yet: a request only appends its
+        # own (through _recorders, the lists' bound append), and _foldlatencies() counts
+        # them in bulk every ACTIVE_EXPIRE_PERIOD and before the histograms are read.
+        self._latencies = {}
+        self._recorders = {}
+        self._slowlog = SlowLog(int(slowlog_log_slower_than) * 1000, int(slowlog_max_len))
+        self._latencymonitor = LatencyMonitor(int(latency_monitor_threshold))
+        # The shortest run (ns) the slow log or the latency monitor wants to see: every other
+        # command is done with them after one comparison.
+        self._latencyalarm = min([threshold for threshold, on in (
+            (self._slowlog.threshold, self._slowlog.threshold >= 0),
+            (self._latencymonitor.threshold * 1000000, self._latencymonitor.threshold > 0)) if on],
+            default=float('inf'))
+        from functions import FunctionLibrary
+        self._functions = FunctionLibrary(functions)
+        self._functionpending = False   # the running function's MULTI is still to be logged.
+        self._functionmulti = False     # ... or it was, and its EXEC is due when it returns.
+        self._channels = {}     # channel -> set of Subscribers
+        self._patterns = PatternIndex()
+        self._pubsublimit = int(pubsub_buffer_limit)    # bytes a subscriber may fall behind.
+        # Client-side caching: connections that asked CLIENT ID, and for every key a
+        # tracking connection read, the ids its invalidations go to (see _touch).
+        self._clients = {}      # client id -> Subscriber
+        self._nextclientid = 0
+        self._tracked = {}      # key -> set of client ids
+        self._trackingclients = 0
+        # Replication (see replication.py): the backlog exists once a replica attached, or
+        # on a replica; _primary is the link to the primary while this is a replica.
+        self._backlog = None
+        self._primary = None
+        self._replbacklogsize = int(repl_backlog_size)
+        self._replbufferlimit = int(repl_buffer_limit)
+        self._fullsyncs = 0
+        self._partialsyncs = 0
+        self._partialsyncerrors = 0
 
         self._commands = self.get_commands()
         self.info = f"Server open in {host}:{port}"
-        th = threading.Thread(target=self._checkttl)
-        th.start()
+
+        from persistence import SnapshotFile
+        self._snapshot = SnapshotFile(dbfilename)
+        self._aof = None
+        if appendonly:
+            from persistence import AppendOnlyFile
+            aof = AppendOnlyFile(appendonly, appendfsync)
+            starttime = time.time()
+            loaded = aof.load(self._replay)     # self._aof is still None: replayed commands aren't re-logged.
+            self._aof = aof
+            logging.warning(f"Loaded {loaded} commands from {appendonly} in {time.time() - starttime:.3f} seconds")
+        elif os.path.exists(dbfilename):
+            self._loaddataset(*self._snapshot.load())
+            logging.warning(f"Loaded {len(self._kv)} keys from {dbfilename} in {self._snapshot.loadduration:.3f} seconds")
+        self._updatepropagating()
+        if ttlthread:   # otherwise whoever drives the server calls _activeexpire() itself.
+            th = threading.Thread(target=self._checkttl, daemon=True)
+            th.start()
+        if replicaof is not None:
+            self.replicaof(*replicaof)
+
+    def _loaddataset(self, kv, ttl, listlength):
+        self._kv, self._ttl, self._listlength = kv, ttl, listlength
+        self._index = KeyspaceIndex()
+        for key, value in self._kv.items():
+            self._index.set(key, sizeof(key) + sizeof(value))
+        self._expiryheap = [(deadline, key) for key, deadline in self._ttl.items()]
+        heapq.heapify(self._expiryheap)
+        self._expirywakeup.set()
 
     def help(self):
         output = f"{self.info}\r\n"
-        output += "Available commands:" + ",".join([f"[{command}]" for command in self.get_commands()])
+        commands = (list(self.get_commands()) + list(self.TRANSACTION_COMMANDS) + list(self.PUBSUB_COMMANDS)
+                    + ['PSYNC', 'CLIENT'])
+        output += "Available commands:" + ",".join([f"[{command}]" for command in commands])
         return output
 
     def get_commands(self):
@@ -146,6 +687,7 @@ class Server(object):
             'GET': self.get,
             'SET': self.set,
             'DELETE': self.delete,
+            'UNLINK': self.unlink,
             'FLUSH': self.flush,
             'MGET': self.mget,
             'MSET': self.mset,
@@ -157,39 +699,423 @@ class Server(object):
             'BRPOP': self.brpop,
             'LLEN': self.llen,
             'EXPIRE': self.expire,
+            'PEXPIRE': self.pexpire,
             'TTL': self.ttl,
+            'PTTL': self.pttl,
             'PERSIST': self.persist,
             'FLUSHALL': self.flushall,
             'INFO': self.info,
             'BGET': self.bget,
-            'SETLENGTH': self.setlength
+            'SETLENGTH': self.setlength,
+            'PEXPIREAT': self.pexpireat,
+            'BGREWRITEAOF': self.bgrewriteaof,
+            'SAVE': self.save,
+            'BGSAVE': self.bgsave,
+            'LASTSAVE': self.lastsave,
+            'LMOVE': self.lmove,
+            'BLMOVE': self.blmove,
+            'RPOPLPUSH': self.rpoplpush,
+            'BRPOPLPUSH': self.brpoplpush,
+            'LRANGE': self.lrange,
+            'LTRIM': self.ltrim,
+            'LREM': self.lrem,
+            'HSET': self.hset,
+            'HGET': self.hget,
+            'HDEL': self.hdel,
+            'HLEN': self.hlen,
+            'HINCRBY': self.hincrby,
+            'HGETALL': self.hgetall,
+            'SADD': self.sadd,
+            'SREM': self.srem,
+            'SCARD': self.scard,
+            'SISMEMBER': self.sismember,
+            'SMEMBERS': self.smembers,
+            'SINTER': self.sinter,
+            'ZADD': self.zadd,
+            'ZREM': self.zrem,
+            'ZCARD': self.zcard,
+            'ZSCORE': self.zscore,
+            'ZRANK': self.zrank,
+            'ZRANGEBYSCORE': self.zrangebyscore,
+            'XADD': self.xadd,
+            'XLEN': self.xlen,
+            'XRANGE': self.xrange,
+            'XREVRANGE': self.xrevrange,
+            'XTRIM': self.xtrim,
+            'XGROUP': self.xgroup,
+            'XREAD': self.xread,
+            'XREADGROUP': self.xreadgroup,
+            'XACK': self.xack,
+            'XCLAIM': self.xclaim,
+            'XPENDING': self.xpending,
+            'XINFO': self.xinfo,
+            'PFADD': self.pfadd,
+            'PFCOUNT': self.pfcount,
+            'PFMERGE': self.pfmerge,
+            'BF.RESERVE': self.bfreserve,
+            'BF.ADD': self.bfadd,
+            'BF.MADD': self.bfmadd,
+            'BF.EXISTS': self.bfexists,
+            'BF.MEXISTS': self.bfmexists,
+            'BF.CARD': self.bfcard,
+            'BF.INFO': self.bfinfo,
+            'BF.SCANDUMP': self.bfscandump,
+            'BF.LOADCHUNK': self.bfloadchunk,
+            'FCALL': self.fcall,
+            'EVALSHA': self.evalsha,
+            'FUNCTION': self.function,
+            'PUBLISH': self.publish,
+            'PUBSUB': self.pubsub,
+            'PING': self.ping,
+            'SCAN': self.scan,
+            'KEYS': self.keys,
+            'TYPE': self.keytype,
+            'MEMORY': self.memory,
+            'SLOWLOG': self.slowlog,
+            'LATENCY': self.latency,
+            'REPLICAOF': self.replicaof,
         }
 
-    def connection_handler(self, conn, address):
+    def connection_handler(self, conn, address, respond=None):
         logging.info('Connection received from: %s:%s' % address)
-        # Convert "conn" (a socket object) into a file-like object.
-        socket_file = conn.makefile('rwb')
+        respond = respond or self.get_response
+        # Replies go into a buffered file and are flushed only when the reader runs out of
+        # complete requests and is about to block, so a pipelined batch costs one write.
+        reader = SocketReader(conn)
+        socket_file = SocketWriter(conn, self._protocol, pushlimit=self._pubsublimit)
+        self._local.conn = conn
+        transaction = Transaction()
+        subscriber = Subscriber(socket_file.push)
+        self._connectedclients += 1
+        self._totalconnections += 1
+        try:
+            self._serve(address, respond, reader, socket_file, transaction, subscriber)
+        finally:
+            self._connectedclients -= 1
+            self._unwatch(transaction)
+            self._unsubscribeall(subscriber)
+            self._forgetclient(subscriber)
+            if self._backlog is not None:
+                self._backlog.replicas.pop(subscriber, None)
+            socket_file.close()
+
+    def _serve(self, address, respond, reader, socket_file, transaction, subscriber):
+        def beforeflush():
+            if self._aof is not None:
+                self._aof.flush()   # replies never go out before their writes reach the log.
+            socket_file.flush()
 
         # Process client requests until client disconnects.
         while True:
             try:
-                data = self._protocol.handle_request(socket_file)
-                logging.debug(f"In Server.connection_handler() Server Received {len(data)} . The Data is {data}")
+                data = self._protocol.handle_request(reader, on_wait=beforeflush)
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug(f"In Server.connection_handler() Server Received {len(data)} . The Data is {data}")
             except Disconnect:
                 logging.info('Client went away: %s:%s' % address)
                 break
+            except OSError as err:
+                logging.info('Connection error from %s:%s: %s' % (address + (err,)))
+                break
+            except (CommandError, ValueError) as err:
+                logging.warning('Protocol error from %s:%s: %s' % (address + (err,)))
+                self._protocol.write_response(socket_file, Error(f"Protocol error. {err}"))
+                break
 
             try:
-                resp = self.get_response(data)
+                resp = self._execute(transaction, data, respond, subscriber)
+            except Disconnect:
+                logging.info('Client went away while blocked: %s:%s' % address)
+                break
+            if resp is PUSHED:
+                continue
+
+            try:
+                try:
+                    self._protocol.write_response(socket_file, resp, flush=False)
+                except CommandError as exc:
+                    self._protocol.write_response(socket_file, Error(exc.args[0]), flush=False)
+            except OSError:
+                logging.info('Client went away: %s:%s' % address)
+                break
+
+    def _execute(self, transaction, data, respond=None, subscriber=None):
+        """Answer one request of a connection, queuing it instead while in MULTI."""
+        command = data[0] if isinstance(data, list) and data else None
+        if command in self.PUBSUB_COMMANDS:
+            if subscriber is None or transaction.queued is not None:
+                return Error(f'{command} is not allowed in this context')
+            try:
+                return self._pubsubcommand(subscriber, command, data[1:])
             except CommandError as exc:
-                logging.exception('Command error')
-                resp = Error(exc.args[0])
-            except TypeError as err:
-                resp = Error(f"Wrong format. {err}")
-            except Exception as err:
-                resp = Error(f"Unknown error. {err}")
+                return Error(exc.args[0])
+        if command == 'PSYNC':
+            if subscriber is None or transaction.queued is not None or subscriber:
+                return Error('PSYNC is not allowed in this context')
+            try:
+                return self._psync(subscriber, data[1:])
+            except CommandError as exc:
+                return Error(exc.args[0])
+        if subscriber and command not in self.SUBSCRIBED_COMMANDS:
+            return Error(f"Can't execute '{command}': only (P)SUBSCRIBE / (P)UNSUBSCRIBE / PING are allowed "
+                         "in this context")
+        if command == 'CLIENT':
+            if subscriber is None or transaction.queued is not None:
+                return Error('CLIENT is not allowed in this context')
+            try:
+                return self._clientcommand(subscriber, data[1:])
+            except CommandError as exc:
+                return Error(exc.args[0])
+        if command in self.TRANSACTION_COMMANDS:
+            try:
+                return self._transactioncommand(transaction, command, data[1:], respond)
+            except CommandError as exc:
+                return Error(exc.args[0])
+        if transaction.queued is None:
+            if subscriber is None or subscriber.redirect is None or command not in self.TRACKED_COMMANDS:
+                return self._reply(data, respond)
+            resp = self._reply(data, respond)
+            if type(resp) is not Error:
+                self._track(subscriber.redirect, data[1:])
+            return resp
+        if command not in self._commands:
+            transaction.aborted = True
+            return Error('Unrecognized command: %s' % command)
+        transaction.queued.append(data)
+        return 'QUEUED'
+
+    def _transactioncommand(self, transaction, command, args, respond):
+        if command == 'MULTI':
+            if transaction.queued is not None:
+                raise CommandError('MULTI calls can not be nested')
+            transaction.queued = []
+            return 'OK'
+        if command == 'WATCH':
+            if transaction.queued is not None:
+                raise CommandError('WATCH inside MULTI is not allowed')
+            if not args:
+                raise CommandError('WATCH needs a key')
+            for key in args:
+                if key not in transaction.watched:
+                    entry = self._versions.get(key)
+                    if entry is None:
+                        entry = self._versions[key] = [0, 0]
+                    entry[1] += 1
+                    transaction.watched[key] = entry[0]
+            return 'OK'
+        if command == 'UNWATCH':
+            self._unwatch(transaction)
+            return 'OK'
+        if transaction.queued is None:
+            raise CommandError(f'{command} without MULTI')
+        queued, transaction.queued = transaction.queued, None
+        aborted, transaction.aborted = transaction.aborted, False
+        changed = any(self._versions[key][0] != seen for key, seen in transaction.watched.items())
+        self._unwatch(transaction)
+        if command == 'DISCARD':
+            return 'OK'
+        if aborted:
+            raise CommandError('EXECABORT Transaction discarded because of previous errors.')
+        if changed:
+            return None     # a watched key changed since WATCH: nothing runs.
+        return self._exec(queued, respond)
+
+    def _exec(self, queued, respond=None):
+        """Run a transaction's commands back to back; nothing else runs in between."""
+        writes = self._propagating and any(data[0] in self.WRITE_COMMANDS or data[0] in self.FUNCTION_COMMANDS
+                                               for data in queued)
+        if writes:
+            self._propagate(('MULTI',))     # the log replays it all or nothing.
+        self._inexec = True
+        try:
+            return [self._reply(data, respond) for data in queued]
+        finally:
+            self._inexec = False
+            if writes:
+                self._propagate(('EXEC',))
+
+    def _unwatch(self, transaction):
+        for key in transaction.watched:
+            entry = self._versions[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._versions[key]
+        transaction.watched = {}
+
+    def _touch(self, key):
+        """key was modified: a transaction WATCHing it will not run, and caches of it are invalidated."""
+        entry = self._versions.get(key)
+        if entry is not None:
+            entry[0] += 1
+        if self._tracked:
+            clientids = self._tracked.pop(key, None)
+            if clientids:
+                self._invalidate(clientids, [key])
+
+    def _touchall(self):
+        for entry in self._versions.values():
+            entry[0] += 1
+        self._tracked.clear()
+        if self._trackingclients:
+            self._invalidate(self._clients, None)   # None: drop every key.
+
+    # Client-side caching, as Redis' CLIENT TRACKING in its RESP2 form: a tracking
+    # connection's GET/MGET keys are remembered until they change, and then an
+    # invalidation is published to the connection it REDIRECTs to. Like Redis' default
+    # mode, a key is reported once and forgotten; reading it again tracks it again.
+    def _clientcommand(self, subscriber, args):
+        """CLIENT ID | CLIENT TRACKING ON REDIRECT client-id | CLIENT TRACKING OFF | CLIENT GETREDIR"""
+        subcommand = str(args[0]).upper() if args else None
+        if subcommand == 'ID':
+            if subscriber.id is None:   # ids are handed out on demand, not to every connection.
+                self._nextclientid += 1
+                subscriber.id = self._nextclientid
+                self._clients[subscriber.id] = subscriber
+            return subscriber.id
+        if subcommand == 'GETREDIR':
+            return -1 if subscriber.redirect is None else subscriber.redirect
+        if subcommand != 'TRACKING':
+            raise CommandError(f'Unknown CLIENT subcommand: {subcommand}')
+        mode = [str(arg).upper() for arg in args[1:3]]
+        if mode == ['OFF'] and len(args) == 2:
+            if subscriber.redirect is not None:
+                subscriber.redirect = None
+                self._trackingclients -= 1
+            return 'OK'
+        if mode != ['ON', 'REDIRECT'] or len(args) != 4:
+            raise CommandError('CLIENT TRACKING takes ON REDIRECT client-id, or OFF: invalidations go to '
+                               f'the client-id connection, subscribed to {self.INVALIDATE_CHANNEL}')
+        try:
+            clientid = int(args[3])
+        except (TypeError, ValueError):
+            raise CommandError('client-id must be an integer')
+        if clientid not in self._clients:
+            raise CommandError('The client ID you want redirect to does not exist')
+        if subscriber.redirect is None:
+            self._trackingclients += 1
+        subscriber.redirect = clientid
+        return 'OK'
+
+    def _track(self, clientid, keys):
+        tracked = self._tracked
+        for key in keys:
+            clientids = tracked.get(key)
+            if clientids is None:
+                tracked[key] = {clientid}
+            else:
+                clientids.add(clientid)
+
+    def _invalidate(self, clientids, keys):
+        """Publish ['message', INVALIDATE_CHANNEL, keys] to the clients that still listen for it."""
+        data = self._encodepush(['message', self.INVALIDATE_CHANNEL, keys])
+        for clientid in tuple(clientids):
+            subscriber = self._clients.get(clientid)
+            if subscriber is not None and self.INVALIDATE_CHANNEL in subscriber.channels:
+                subscriber.push(data)
+
+    def _forgetclient(self, subscriber):
+        """The connection closed. Keys it tracked stay in _tracked until they change, as in Redis."""
+        if subscriber.redirect is not None:
+            subscriber.redirect = None
+            self._trackingclients -= 1
+        if subscriber.id is not None:
+            del self._clients[subscriber.id]
+
+    def _pubsubcommand(self, subscriber, command, args):
+        """(P)SUBSCRIBE and (P)UNSUBSCRIBE push one [kind, name, count] reply per name, like Redis."""
+        pattern = command in ('PSUBSCRIBE', 'PUNSUBSCRIBE')
+        kind = command.lower()
+        names = [channelname(name) for name in args]
+        if command in ('SUBSCRIBE', 'PSUBSCRIBE'):
+            if not names:
+                raise CommandError(f'{command} needs a channel')
+            for name in names:
+                if pattern and name not in subscriber.patterns:
+                    subscriber.patterns.add(name)
+                    self._patterns.add(name, subscriber)
+                elif not pattern and name not in subscriber.channels:
+                    subscriber.channels.add(name)
+                    self._channels.setdefault(name, set()).add(subscriber)
+                subscriber.push(self._encodepush([kind, name, len(subscriber)]))
+            return PUSHED
+        names = names or sorted(subscriber.patterns if pattern else subscriber.channels)
+        if not names:
+            subscriber.push(self._encodepush([kind, None, len(subscriber)]))
+        for name in names:
+            self._unsubscribe(subscriber, name, pattern)
+            subscriber.push(self._encodepush([kind, name, len(subscriber)]))
+        return PUSHED
+
+    def _unsubscribe(self, subscriber, name, pattern):
+        if pattern:
+            if name in subscriber.patterns:
+                subscriber.patterns.discard(name)
+                self._patterns.remove(name, subscriber)
+        elif name in subscriber.channels:
+            subscriber.channels.discard(name)
+            subscribers = self._channels[name]
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._channels[name]
+
+    def _unsubscribeall(self, subscriber):
+        for name in list(subscriber.channels):
+            self._unsubscribe(subscriber, name, False)
+        for name in list(subscriber.patterns):
+            self._unsubscribe(subscriber, name, True)
+
+    def _encodepush(self, message):
+        buf = bytearray()
+        self._protocol._write(buf, message)
+        return bytes(buf)
+
+    def _reply(self, data, respond=None):
+        """Run one request; failures become Error replies. Shared by every network backend."""
+        self._commandsprocessed += 1
+        if not self._latencytracking:
+            return self._respond(data, respond)
+        start = perf_counter_ns()
+        resp = self._respond(data, respond)
+        elapsed = perf_counter_ns() - start
+        try:
+            self._recorders[data[0]](elapsed)
+        except (KeyError, IndexError, TypeError):
+            self._recordlatency(data, elapsed)
+            return resp
+        if elapsed >= self._latencyalarm:
+            self._recordslow(data, elapsed)
+        return resp
 
-            self._protocol.write_response(socket_file, resp)
+    def _respond(self, data, respond):
+        try:
+            return (respond or self.get_response)(data)
+        except Disconnect:
+            raise
+        except CommandError as exc:
+            logging.exception('Command error')
+            return Error(exc.args[0])
+        except TypeError as err:
+            return Error(f"Wrong format. {err}")
+        except Exception as err:
+            return Error(f"Unknown error. {err}")
+
+    def _recordlatency(self, data, elapsed):
+        """_reply() for a command without a histogram yet. Blocking commands never get one:
+        they time the wait."""
+        command = data[0] if type(data) is list and data else None
+        if command not in self._commands or command in self.BLOCKING_COMMANDS:
+            return
+        self._histograms[command] = Histogram()
+        self._latencies[command] = latencies = [elapsed]
+        self._recorders[command] = latencies.append
+        if elapsed >= self._latencyalarm:
+            self._recordslow(data, elapsed)
+
+    def _recordslow(self, data, elapsed):
+        if elapsed >= self._slowlog.threshold >= 0:
+            self._slowlog.add(data, elapsed)
+        if elapsed >= self._latencymonitor.threshold * 1000000 > 0:
+            self._latencymonitor.add('command', elapsed / 1e6)
 
     def run(self):
         self._server.serve_forever()
@@ -208,206 +1134,2137 @@ class Server(object):
         if command not in self._commands:
             raise CommandError('Unrecognized command: %s' % command)
 
-        return self._commands[command](*data[1:])
+        if command not in self.WRITE_COMMANDS:
+            return self._commands[command](*data[1:])
+        if self._primary is not None:
+            raise CommandError(self.READONLY_ERROR)
+        if self._maxmemory and self._index.used > self._maxmemory and command in self.DENYOOM_COMMANDS:
+            if not self._freememory():
+                raise CommandError("OOM command not allowed when used memory > 'maxmemory'.")
+        self._snapshot.changes += 1
+        if not self._propagating:
+            return self._commands[command](*data[1:])
+
+        self._propagateargs = data
+        result = self._commands[command](*data[1:])
+        if self._propagateargs is not None:
+            self._feed(self._propagateargs)
+            self._propagateargs = None
+        if self._handoffs:
+            self._flushhandoffs()
+        return result
+
+    def _rewritecommand(self, *args):
+        """Log args instead of the running command (None: log nothing).
+
+        For commands whose literal form would not replay to the same state: relative
+        TTLs become absolute, and blocking pops are logged as the pop that happened.
+        A blocking command must call it after it wakes up, since other commands ran
+        while it waited.
+        """
+        if self._propagating:
+            self._propagateargs = args or None
+
+    def _propagate(self, args):
+        """Log a write the server made on its own, outside any client command."""
+        if self._propagating:
+            self._feed(args)
+
+    def _propagatehandoff(self, args):
+        """Log a pop made for a blocked client; it goes after the command that caused it."""
+        if self._propagating:
+            self._handoffs.append(args)
+
+    def _flushhandoffs(self):
+        for args in self._handoffs:
+            self._feed(args)
+        self._handoffs = []
+
+    def _updatepropagating(self):
+        # Writes are propagated when something listens: the append-only file, or replicas.
+        # A replica only passes on its primary's stream (see _applyreplicated).
+        self._propagating = (self._aof is not None or self._backlog is not None) and self._primary is None
+
+    def _feed(self, args):
+        """Send a write to the append-only file and to the replicas."""
+        if self._aof is not None:
+            self._aof.append(args)
+        if self._backlog is not None:
+            self._backlog.append(args)
+
+    def _replay(self, data):
+        try:
+            self._commands[data[0]](*data[1:])
+        except Exception as err:
+            logging.warning(f"AOF replay of {data[0]} failed: {err}")
+
+    def _dumpcommands(self):
+        """Yield commands that rebuild the current dataset; used for AOF rewrites."""
+        for key, value in self._kv.items():
+            if isinstance(value, COLLECTION_TYPES):
+                yield from self._collectioncommands(key, value)
+            elif isinstance(value, StreamValue):
+                yield from self._streamcommands(key, value)
+            elif isinstance(value, HyperLogLog):
+                yield ('SET', key, value.dump())    # PF* commands take it back as it is.
+            elif isinstance(value, BloomFilter):
+                yield ('BF.LOADCHUNK', key, 1, value.header())
+                for i in range(0, len(value.bits), BF_DUMP_CHUNK):
+                    yield ('BF.LOADCHUNK', key, i // BF_DUMP_CHUNK + 2, bytes(value.bits[i:i + BF_DUMP_CHUNK]))
+            else:
+                yield ('SET', key, value)
+        for key, deadline in self._ttl.items():
+            yield ('PEXPIREAT', key, deadline)
+        for key, length in self._listlength.items():
+            yield ('SETLENGTH', key, length)
+
+    def _collectioncommands(self, key, value, chunk=512):
+        """HSET/SADD/ZADD commands that rebuild a collection, chunk entries at a time."""
+        if isinstance(value, HashValue):
+            command, items = 'HSET', [item for pair in value.items() for item in pair]
+        elif isinstance(value, SetValue):
+            command, items = 'SADD', list(value)
+        else:
+            command, items = 'ZADD', [item for member, score in value.items() for item in (score, member)]
+        width = 1 if command == 'SADD' else 2
+        for start in range(0, len(items), chunk * width):
+            yield (command, key) + tuple(items[start:start + chunk * width])
+
+    @staticmethod
+    def _streamcommands(key, stream):
+        """XADD/XGROUP/XCLAIM commands that rebuild a stream with its groups and pending entries."""
+        for sid, fields in stream.entries():
+            yield ('XADD', key, sid) + tuple(fields)
+        if not len(stream):
+            # Redis' way to keep the last ID of an emptied stream: add an entry and trim it.
+            yield ('XADD', key, 'MAXLEN', 0, formatid(stream.lastid), 'x', 'y')
+        for name, group in stream.groups.items():
+            yield ('XGROUP', 'CREATE', key, name, formatid(group.lastid))
+            for consumer in group.consumers:
+                yield ('XGROUP', 'CREATECONSUMER', key, name, consumer)
+            for sid, (consumer, delivered, deliveries) in group.pending.items():
+                yield ('XCLAIM', key, name, consumer, 0, formatid(sid),
+                       'TIME', delivered, 'RETRYCOUNT', deliveries, 'FORCE', 'JUSTID')
+
+    def bgrewriteaof(self):
+        if self._aof is None:
+            raise CommandError('Append only file is not enabled')
+        if not self._aof.rewrite(self._dumpcommands):
+            raise CommandError('Background append only file rewriting already in progress')
+        return 'Background append only file rewriting started'
+
+    # Keyspace primitives: every key written or removed goes through these so memory
+    # accounting (and what builds on it) stays correct.
+    def _store(self, key, value):
+        self._kv[key] = value
+        self._index.set(key, sizeof(key) + sizeof(value))
+        if self._versions or self._tracked:
+            self._touch(key)
+
+    def _unlink(self, key):
+        """Remove key with its TTL; returns the value it held, or None."""
+        if key in self._ttl:
+            del self._ttl[key]
+        self._index.remove(key)
+        if self._versions or self._tracked:
+            self._touch(key)
+        return self._kv.pop(key, None)
+
+    def _resize(self, key, delta):
+        self._index.adjust(key, delta)
+        if self._versions or self._tracked:
+            self._touch(key)
+
+    def _lazyfree(self, value, force=False):
+        """Let go of a value taken out of the keyspace: a big one is freed in the background."""
+        if self._lazyfreer.add(value, force) and not self._lazyfreeing:
+            self._lazyfreeing = True
+            self._startlazyfree()
+
+    def _startlazyfree(self):
+        threading.Thread(target=self._lazyfreeloop, daemon=True).start()
+
+    def _lazyfreeloop(self):
+        # A greenlet: between two chunks, every other connection gets its turn. A zero
+        # sleep would not do, as gevent runs it again before polling the sockets.
+        while self._lazyfreer.free(self.LAZYFREE_BUDGET):
+            time.sleep(self.LAZYFREE_BUDGET / 10)
+        self._lazyfreeing = False
+
+    def _freememory(self):
+        """Evict keys per maxmemory_policy until under maxmemory. False if that isn't possible."""
+        started = time.monotonic()
+        try:
+            while self._index.used > self._maxmemory:
+                key = self._evictioncandidate()
+                if key is None:
+                    return False
+                self._lazyfree(self._unlink(key))
+                self._propagate(('DELETE', key))
+                self._evicted += 1
+            return True
+        finally:
+            self._latencymonitor.add('eviction-cycle', (time.monotonic() - started) * 1000)
+
+    def _evictioncandidate(self):
+        policy = self._maxmemorypolicy
+        if policy == 'volatile-ttl':
+            # The expiry heap already orders keys by deadline; drop stale entries on the way.
+            heap = self._expiryheap
+            while heap:
+                deadline, key = heap[0]
+                if self._ttl.get(key) == deadline:
+                    return key
+                heapq.heappop(heap)
+            return None
+        candidates = self._index.sample(self._maxmemorysamples)
+        if not candidates:
+            return None
+        if policy == 'allkeys-lru':
+            return min(candidates, key=self._index.lastaccess)
+        if policy == 'allkeys-lfu':
+            return min(candidates, key=lambda k: (self._index.frequency(k), self._index.lastaccess(k)))
+        return None
 
     #Below are REDIS commands in server.
     def get(self, key):
-        return self._kv.get(key)
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if self._trackaccess:
+            self._index.touch(key)
+        value = self._kv.get(key)
+        if value is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return value
 
-    def set(self, key, value):
-        self._kv[key] = value
+    def set(self, key, value, *options):
+        deadline = None
+        if options:
+            option = str(options[0]).upper() if len(options) == 2 else None
+            if option not in ('EX', 'PX', 'PXAT'):
+                raise CommandError('SET options must be EX seconds, PX milliseconds or PXAT timestamp')
+            amount = int(options[1])
+            deadline = {'EX': mstime() + amount * 1000, 'PX': mstime() + amount, 'PXAT': amount}[option]
+            self._rewritecommand('SET', key, value, 'PXAT', deadline)
+
+        self._store(key, value)
         #print(f"SET: {key}, {type(self._kv[key])}, {sys.getsizeof(self._kv[key])} value={value}\n")
+        if deadline is not None:
+            self._setdeadline(key, deadline)
+        elif key in self._ttl:
+            del self._ttl[key]      # a plain SET makes the key persistent again.
 
-        self.releaseblock(key)
+        if key in self._blocked:
+            self._serveblocked(key)
         return 1
 
     def delete(self, key):
+        if key in self._ttl and self._expireifneeded(key):
+            return 0
         if key in self._kv:
-            del self._kv[key]
+            self._unlink(key)
             return 1
         return 0
 
-    def flush(self):
+    def unlink(self, *keys):
+        """UNLINK key [key ...]: DELETE, but a big value is freed in the background. Returns the count removed."""
+        removed = 0
+        for key in keys:
+            if key in self._ttl and self._expireifneeded(key):
+                continue
+            if key in self._kv:
+                self._lazyfree(self._unlink(key))
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _isasync(mode):
+        mode = None if mode is None else str(mode).upper()
+        if mode not in (None, 'SYNC', 'ASYNC'):
+            raise CommandError('The flush mode must be ASYNC or SYNC')
+        return mode == 'ASYNC'
+
+    def flush(self, mode=None):
+        """FLUSH [ASYNC|SYNC]; ASYNC frees the dropped keys in the background."""
         kvlen = len(self._kv)
-        self._kv.clear()
+        if self._isasync(mode):
+            self._detachkeyspace()
+        else:
+            self._kv.clear()
+            self._ttl.clear()
+            self._expiryheap = []
+            self._index.clear()
+        self._touchall()
         return kvlen
 
+    def _detachkeyspace(self):
+        """Start over with an empty keyspace, and free the old one in the background."""
+        old = [self._kv, self._ttl, self._expiryheap, self._index]
+        self._kv, self._ttl, self._expiryheap = {}, {}, []
+        self._index = KeyspaceIndex()
+        for value in old:
+            self._lazyfree(value, force=True)
+
     def mget(self, *keys):
-        return [self._kv.get(key) for key in keys]
+        if self._ttl:
+            for key in keys:
+                if key in self._ttl:
+                    self._expireifneeded(key)
+        if self._trackaccess:
+            for key in keys:
+                self._index.touch(key)
+        values = [self._kv.get(key) for key in keys]
+        misses = values.count(None)
+        self._misses += misses
+        self._hits += len(values) - misses
+        return values
 
     def mset(self, *items):
-        data = zip(items[::2], items[1::2])
+        data = list(zip(items[::2], items[1::2]))
         for key, value in data:
-            self._kv[key] = value
-            self.releaseblock(key)
-        return len(list(data))
-
-    def releaseblock(self, key):
-        if key in self._queue and self._queue[key]:
-            releaseblockevent = self._queue[key].pop()
-            while releaseblockevent:
-                if releaseblockevent.is_set():
-                       # this event is already timeout. no one is waiting for it. ignore. pop the next.
-                    if self._queue[key]:
-                        releaseblockevent = self._queue[key].pop()
-                    else:   # the _queue[key] is empty, then ignore.
-                        break
-                else:
-                    releaseblockevent.set()
+            self._store(key, value)
+            if key in self._ttl:
+                del self._ttl[key]
+            if key in self._blocked:
+                self._serveblocked(key)
+        return len(data)
+
+    # Blocking commands. A client that finds nothing is registered on each of its keys in
+    # _blocked, FIFO. Writes that make a key ready call _serveblocked(), which pops for the
+    # oldest waiter and hands it the value; timeouts and disconnects unregister at once.
+    def _blockingargs(self, command, args):
+        """Return (keys, timeout in seconds or None for ever, move) from a blocking request."""
+        if self._primary is not None:
+            raise CommandError(self.READONLY_ERROR)
+        if command in ('BLMOVE', 'BRPOPLPUSH'):
+            if len(args) != (5 if command == 'BLMOVE' else 3):
+                raise CommandError(f'wrong number of arguments for {command}')
+            if command == 'BLMOVE':
+                move = (args[1],) + self._movedirections(args[2], args[3])
+            else:
+                move = (args[1], 'RIGHT', 'LEFT')
+            keys = [args[0]]
+        elif not args:
+            raise CommandError(f'{command} needs a key')
+        elif len(args) == 1:
+            return list(args), self.BLOCKING_TIMEOUTS[command], None
+        else:
+            keys, move = list(args[:-1]), None
+        try:
+            timeout = float(args[-1])
+        except (TypeError, ValueError):
+            raise CommandError('timeout is not a float or out of range')
+        if timeout < 0:
+            raise CommandError('timeout is negative')
+        return keys, timeout or None, move
+
+    def _blockingresult(self, keys, key, value):
+        # One key replies with the value, as BLPOP always has; several say which key it came from.
+        return value if len(keys) == 1 else [key, value]
+
+    def _takeready(self, command, keys, move=None):
+        """What a blocking command gets without waiting: (key, value, what to log) or None."""
+        for key in keys:
+            if command == 'BGET':
+                if key in self._ttl:
+                    self._expireifneeded(key)
+                if key in self._kv:
+                    return key, self._kv[key], None
+            else:
+                values = self._getlist(key)
+                if values:
+                    if move is not None:
+                        return (key, self._move(key, values, *move), ('LMOVE', key) + move)
+                    if command == 'BLPOP':
+                        return key, self._popped(key, values.popleft()), ('LPOP', key)
+                    return key, self._popped(key, values.pop()), ('RPOP', key)
+        return None
+
+    def _block(self, command, keys, wakeup, move=None):
+        client = BlockedClient(command, keys, wakeup, move)
+        self._blockedclients += 1
+        for key in keys:
+            waiters = self._blocked.get(key)
+            if waiters is None:
+                waiters = self._blocked[key] = OrderedDict()
+            waiters[client] = None
+        return client
+
+    def _unblock(self, client):
+        if client in self._blocked.get(client.keys[0], ()):
+            self._blockedclients -= 1
+        for key in client.keys:
+            waiters = self._blocked.get(key)
+            if waiters is not None:
+                waiters.pop(client, None)
+                if not waiters:
+                    del self._blocked[key]
+
+    def _serveblocked(self, key):
+        """Hand what key now holds to the clients blocked on it, oldest first."""
+        waiters = self._blocked.get(key)
+        if waiters and type(self._kv.get(key)) is StreamValue:
+            self._servestreamreads(key, waiters)
+            waiters = self._blocked.get(key)
+        while waiters:
+            client = next(iter(waiters))
+            if client.command in self.STREAM_READ_COMMANDS:
+                # It waits for stream entries; those after it may take what key holds.
+                client = next((client for client in waiters if client.command not in self.STREAM_READ_COMMANDS), None)
+                if client is None:
                     break
+            if client.command == 'BGET':
+                if key not in self._kv:
+                    break
+                self._unblock(client)
+                value = self._unlink(key)   # a woken BGET takes the value away.
+                self._propagatehandoff(('DELETE', key))
+            else:
+                values = self._getlist(key)
+                if not values:
+                    break
+                # Unregistered first: a move may push back onto this very key.
+                self._unblock(client)
+                if client.move is not None and not self._islist(client.move[0]):
+                    client.wakeup.set()     # its destination stopped being a list; it gets nil.
+                    continue
+                _, value, logged = self._takeready(client.command, [key], client.move)
+                self._propagatehandoff(logged)
+                self._servemoved(client.move)
+            client.key = key
+            client.value = value
+            client.wakeup.set()
+
+    def _servemoved(self, move):
+        # After a move is logged, not before: the destination's waiters pop what it pushed.
+        if move is not None and move[0] in self._blocked:
+            self._serveblocked(move[0])
+
+    def _waitforhandoff(self, client, timeout):
+        """Park the calling greenlet until client is served or timeout passes.
+
+        Also watches the client's socket, so a client that hangs up is unregistered at
+        once (Disconnect) instead of holding its place, and values, until its timeout.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            client.wakeup.wait(timeout)
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        readable = gevent.event.Event()
+        watcher = gevent.get_hub().loop.io(conn.fileno(), 1)
+        watcher.start(readable.set)
+        try:
+            gevent.wait([client.wakeup, readable], timeout=timeout, count=1)
+            if client.wakeup.is_set() or not readable.is_set():
+                return
+            watcher.stop()
+            try:
+                hungup = not conn.recv(1, socket.MSG_PEEK)
+            except OSError:
+                hungup = True
+            if hungup:
+                raise Disconnect()
+            # Requests pipelined behind this one; they are answered after it.
+            client.wakeup.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        finally:
+            watcher.stop()
+            watcher.close()
+
+    def _blockingcommand(self, command, args):
+        keys, timeout, move = self._blockingargs(command, args)
+        if move is not None and not self._islist(move[0]):
+            raise CommandError('WRONGTYPE destination holds a value that is not a list')
+        ready = self._takeready(command, keys, move)
+        if ready is not None:
+            self._rewritecommand(*(ready[2] or ()))
+            self._servemoved(move)
+            return self._blockingresult(keys, ready[0], ready[1])
+
+        if self._inexec:
+            self._rewritecommand()
+            return None     # inside EXEC nothing else can run, so there is nothing to wait for.
+        client = self._block(command, keys, gevent.event.Event(), move)
+        try:
+            self._waitforhandoff(client, timeout)
+        finally:
+            self._unblock(client)
+            # Whatever was handed over was logged by the write that did it.
+            self._rewritecommand()
+        if client.key is None:
+            return None
+        return self._blockingresult(keys, client.key, client.value)
 
-    def lpush(self, *items):
-        key = items[0]
-        if key not in self._kv:
-            self._kv[key] = []
-        if not isinstance(self._kv[key], list):
+    def _countlookup(self, value):
+        """keyspace_hits/misses, for the lookups of read commands."""
+        if value is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+
+    def _getlist(self, key, create=False):
+        """Return the ListValue at key, or None if missing (and not created) or not a list."""
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if self._trackaccess:
+            self._index.touch(key)
+        value = self._kv.get(key)
+        if not create:
+            self._countlookup(value)
+        if value is None:
+            if not create:
+                return None
+            value = ListValue(maxlen=self._listlength.get(key))
+            self._store(key, value)
+        elif type(value) is list:  # a plain list stored through SET/MSET.
+            value = ListValue.capped(value, self._listlength.get(key))
+            self._store(key, value)
+        elif not isinstance(value, ListValue):
             logging.warning(f"Element {key} is not a list")
             return None
-        for value in items[1:]:
-            self._kv[key].insert(0, value)
-
-        if key in self._listlength:
-            while len(self._kv[key]) > self._listlength[key]:
-                self._kv[key].pop(-1)
+        return value
 
-        self.releaseblock(key)
-        return len(self._kv[key])
+    def _pushed(self, key, values, before, pushed):
+        """Account for a push of `pushed` onto a list that held `before` items."""
+        delta = sum([sizeof(item) for item in pushed]) + 8 * len(pushed)
+        dropped = before + len(pushed) - len(values)
+        if dropped > 0 and before:
+            # Items a SETLENGTH cap pushed out; charge them at the list's average item size.
+            delta -= dropped * (self._index.size(key) - sizeof(key) - sys.getsizeof(values)) // before
+        self._resize(key, delta)
+
+    def _popped(self, key, value):
+        self._resize(key, -sizeof(value) - 8)
+        return value
 
-    def rpush(self, *items):
+    def lpush(self, *items):
         key = items[0]
-        if key not in self._kv:
-            self._kv[key] = []
-        if not isinstance(self._kv[key], list):
-            logging.warning(f"Element {key} is not a list")
+        values = self._getlist(key, create=True)
+        if values is None:
             return None
-        for value in items[1:]:
-            self._kv[key].append(value)
+        before = len(values)
+        length = values.push_left(items[1:])
+        self._pushed(key, values, before, items[1:])
 
-        if key in self._listlength:
-            while len(self._kv[key]) > self._listlength[key]:
-                self._kv[key].pop()
+        if key in self._blocked:
+            self._serveblocked(key)
+        return length
 
-        self.releaseblock(key)
-        return len(self._kv[key])
-
-    def lpop(self, key):
-        if key not in self._kv:
+    def rpush(self, *items):
+        key = items[0]
+        values = self._getlist(key, create=True)
+        if values is None:
             return None
-        if not isinstance(self._kv[key], list):
-            logging.warning(f"Element {key} is not a list")
+        before = len(values)
+        length = values.push_right(items[1:])
+        self._pushed(key, values, before, items[1:])
+
+        if key in self._blocked:
+            self._serveblocked(key)
+        return length
+
+    def _popcount(self, key, count, popone):
+        """LPOP/RPOP key count: up to count items, in pop order; None if there is no list."""
+        count = int(count)
+        if count < 0:
+            raise CommandError('value is out of range, must be positive')
+        values = self._getlist(key)
+        if values is None:
             return None
-        try:
-            value = self._kv[key].pop(0)
-        except IndexError:
+        pop = getattr(values, popone)
+        popped = [pop() for _ in range(min(count, len(values)))]
+        self._resize(key, -sum([sizeof(item) + 8 for item in popped]))
+        return popped
+
+    def lpop(self, key, count=None):
+        if count is not None:
+            return self._popcount(key, count, 'popleft')
+        values = self._getlist(key)
+        if not values:
             return None
-        return value
+        return self._popped(key, values.popleft())
 
-    def rpop(self, key):
-        if key not in self._kv:
-            return None
-        if not isinstance(self._kv[key], list):
-            logging.warning(f"Element {key} is not a list")
+    def rpop(self, key, count=None):
+        if count is not None:
+            return self._popcount(key, count, 'pop')
+        values = self._getlist(key)
+        if not values:
             return None
-        try:
-            value = self._kv[key].pop(-1)
-        except IndexError:
+        return self._popped(key, values.pop())
+
+    def _islist(self, key):
+        """True if key holds a list or nothing, i.e. a list may be pushed there."""
+        if key in self._ttl:
+            self._expireifneeded(key)
+        value = self._kv.get(key)
+        return value is None or isinstance(value, (ListValue, list))
+
+    @staticmethod
+    def _movedirections(wherefrom, whereto):
+        wherefrom, whereto = str(wherefrom).upper(), str(whereto).upper()
+        if wherefrom not in ('LEFT', 'RIGHT') or whereto not in ('LEFT', 'RIGHT'):
+            raise CommandError('wherefrom and whereto must be LEFT or RIGHT')
+        return wherefrom, whereto
+
+    def _move(self, source, values, destination, wherefrom, whereto):
+        """Pop one item off the non-empty list `values` at source and push it onto destination."""
+        value = self._popped(source, values.popleft() if wherefrom == 'LEFT' else values.pop())
+        target = self._getlist(destination, create=True)
+        before = len(target)
+        if whereto == 'LEFT':
+            target.push_left((value,))
+        else:
+            target.push_right((value,))
+        self._pushed(destination, target, before, (value,))
+        return value
+
+    def lmove(self, source, destination, wherefrom, whereto):
+        """Atomically move an item between lists; the building block of a reliable queue."""
+        wherefrom, whereto = self._movedirections(wherefrom, whereto)
+        values = self._getlist(source)
+        if not values:
             return None
+        if not self._islist(destination):
+            raise CommandError('WRONGTYPE destination holds a value that is not a list')
+        value = self._move(source, values, destination, wherefrom, whereto)
+        self._servemoved((destination,))
         return value
 
+    def rpoplpush(self, source, destination):
+        return self.lmove(source, destination, 'RIGHT', 'LEFT')
+
+    def blmove(self, *args):
+        """BLMOVE source destination LEFT|RIGHT LEFT|RIGHT timeout"""
+        return self._blockingcommand('BLMOVE', args)
+
+    def brpoplpush(self, *args):
+        return self._blockingcommand('BRPOPLPUSH', args)
+
+    @staticmethod
+    def _listrange(length, start, stop):
+        """Redis-style inclusive [start, stop], negative from the tail, clamped to the list."""
+        if start < 0:
+            start += length
+        if stop < 0:
+            stop += length
+        return max(start, 0), min(stop, length - 1)
+
+    def lrange(self, key, start, stop):
+        values = self._getlist(key)
+        if not values:
+            return []
+        n = len(values)
+        start, stop = self._listrange(n, int(start), int(stop))
+        if start > stop:
+            return []
+        if start > n - 1 - stop:
+            # The range is nearer the tail: walk the deque from that end instead.
+            return list(islice(reversed(values), n - 1 - stop, n - start))[::-1]
+        return list(islice(values, start, stop + 1))
+
+    def ltrim(self, key, start, stop):
+        values = self._getlist(key)
+        if not values:
+            return 1
+        n = len(values)
+        start, stop = self._listrange(n, int(start), int(stop))
+        if start > stop:
+            start, stop = n, n - 1  # nothing is kept.
+        removed = [values.popleft() for _ in range(start)]
+        removed += [values.pop() for _ in range(n - 1 - stop)]
+        self._resize(key, -sum([sizeof(item) + 8 for item in removed]))
+        return 1
+
+    def lrem(self, key, count, value):
+        """Remove count occurrences of value: from the head if count > 0, the tail if < 0, all if 0."""
+        count = int(count)
+        values = self._getlist(key)
+        if not values:
+            return 0
+        items = list(values) if count >= 0 else list(reversed(values))
+        limit = abs(count) or len(items)
+        kept = []
+        removed = 0
+        for item in items:
+            if removed < limit and item == value:
+                removed += 1
+            else:
+                kept.append(item)
+        if removed:
+            if count < 0:
+                kept.reverse()
+            values.clear()
+            values.extend(kept)
+            self._resize(key, -removed * (sizeof(value) + 8))
+        return removed
+
     def llen(self, key):
+        if key in self._ttl:
+            self._expireifneeded(key)
         if key not in self._kv:
             return None
         return len(self._kv[key])
 
-    def blpop(self, key, timeout=60):
-        if key not in self._kv:
-            self._kv[key] = []  #  even if this key doesn't exist, block pop still wait for this list.
+    def blpop(self, *args):
+        """BLPOP key [key ...] timeout; a lone key waits BLOCKING_TIMEOUTS['BLPOP']."""
+        return self._blockingcommand('BLPOP', args)
 
-        value = self.lpop(key)
-        if value:
-            return value
+    def brpop(self, *args):
+        return self._blockingcommand('BRPOP', args)
 
-        waittogetvalue = threading.Event()
-        if key not in self._queue:
-            self._queue[key] = []
-        self._queue[key].append(waittogetvalue)
+    # Hashes, sets and sorted sets; datatypes.py has their compact and full encodings.
+    WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
 
-        i = waittogetvalue.wait(timeout)
-        if waittogetvalue.is_set():
-            value = self.lpop(key)
-            if value:
-                return value
-            else:
-                logging.error("blpop(). The logic here should be able to retrieve a value. might need an atomic execution around here.")
+    def _getcollection(self, key, cls, create=False):
+        """Return the cls value at key, or None if missing (and not created)."""
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if self._trackaccess:
+            self._index.touch(key)
+        value = self._kv.get(key)
+        if not create:
+            self._countlookup(value)
+        if value is None:
+            if not create:
                 return None
-        else:
-            waittogetvalue.set()    # set it to abandon it, so the releaseblock() function will move on to next block in _queue
-            return None
-
-    def brpop(self, key, timeout=30):
-        if key not in self._kv:
-            self._kv[key] = []
-
-        value = self.rpop(key)
-        if value:
-            return value
+            value = cls()
+            self._store(key, value)
+        elif type(value) is not cls:
+            raise CommandError(self.WRONGTYPE)
+        return value
 
-        waittogetvalue = threading.Event()
-        if key not in self._queue:
-            self._queue[key] = []
-        self._queue[key].append(waittogetvalue)
+    def _collectionchanged(self, key, value, encoding, delta):
+        """Account for a write to a collection that had `encoding` before it."""
+        if not len(value):
+            self._unlink(key)   # like Redis, an emptied collection is no key at all.
+        elif value.encoding != encoding:
+            self._index.set(key, sizeof(key) + sizeof(value))  # converted: measure it once.
+            self._touch(key)
+        else:
+            self._resize(key, delta)
+
+    def hset(self, key, *items):
+        """HSET key field value [field value ...]; returns the number of new fields."""
+        if not items or len(items) % 2:
+            raise CommandError('HSET needs field value pairs')
+        values = self._getcollection(key, HashValue, create=True)
+        encoding = values.encoding
+        added = delta = 0
+        for field, value in zip(items[::2], items[1::2]):
+            if field in values:
+                delta += sizeof(value) - sizeof(values.get(field))
+            else:
+                added += 1
+                delta += sizeof(field) + sizeof(value) + ENTRY_OVERHEAD[encoding]
+            values.set(field, value)
+        self._collectionchanged(key, values, encoding, delta)
+        return added
+
+    def hget(self, key, field):
+        values = self._getcollection(key, HashValue)
+        return None if values is None else values.get(field)
+
+    def hdel(self, key, *fields):
+        values = self._getcollection(key, HashValue)
+        if values is None:
+            return 0
+        encoding = values.encoding
+        removed = delta = 0
+        for field in fields:
+            if field in values:
+                delta -= sizeof(field) + sizeof(values.get(field)) + ENTRY_OVERHEAD[encoding]
+                values.delete(field)
+                removed += 1
+        self._collectionchanged(key, values, encoding, delta)
+        return removed
+
+    def hlen(self, key):
+        values = self._getcollection(key, HashValue)
+        return 0 if values is None else len(values)
+
+    def hincrby(self, key, field, increment):
+        values = self._getcollection(key, HashValue)
+        current = 0 if values is None else values.get(field, 0)
+        try:
+            result = int(current) + int(increment)
+        except (TypeError, ValueError):
+            raise CommandError('hash value is not an integer')
+        self.hset(key, field, result)
+        return result
 
-        i = waittogetvalue.wait(timeout)
-        if waittogetvalue.is_set():
-            value = self.rpop(key)
-            if value:
-                return value
+    def hgetall(self, key):
+        values = self._getcollection(key, HashValue)
+        return {} if values is None else dict(values.items())
+
+    def sadd(self, key, *members):
+        if not members:
+            raise CommandError('SADD needs a member')
+        values = self._getcollection(key, SetValue, create=True)
+        encoding = values.encoding
+        added = delta = 0
+        for member in members:
+            if values.add(member):
+                added += 1
+                delta += sizeof(member) + ENTRY_OVERHEAD[encoding]
+        self._collectionchanged(key, values, encoding, delta)
+        return added
+
+    def srem(self, key, *members):
+        values = self._getcollection(key, SetValue)
+        if values is None:
+            return 0
+        encoding = values.encoding
+        removed = delta = 0
+        for member in members:
+            if values.remove(member):
+                removed += 1
+                delta -= sizeof(member) + ENTRY_OVERHEAD[encoding]
+        self._collectionchanged(key, values, encoding, delta)
+        return removed
+
+    def scard(self, key):
+        values = self._getcollection(key, SetValue)
+        return 0 if values is None else len(values)
+
+    def sismember(self, key, member):
+        values = self._getcollection(key, SetValue)
+        return int(values is not None and member in values)
+
+    def smembers(self, key):
+        values = self._getcollection(key, SetValue)
+        return [] if values is None else list(values)
+
+    def sinter(self, *keys):
+        sets = [self._getcollection(key, SetValue) for key in keys]
+        if not sets or None in sets:
+            return []
+        sets.sort(key=len)  # walk the smallest, probe the others.
+        smallest, others = sets[0], sets[1:]
+        return [member for member in smallest if all(member in other for other in others)]
+
+    @staticmethod
+    def _score(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise CommandError('value is not a valid float')
+
+    def zadd(self, key, *items):
+        """ZADD key score member [score member ...]; returns the number of new members."""
+        if not items or len(items) % 2:
+            raise CommandError('ZADD needs score member pairs')
+        pairs = [(member, self._score(score)) for score, member in zip(items[::2], items[1::2])]
+        values = self._getcollection(key, ZSetValue, create=True)
+        encoding = values.encoding
+        added = delta = 0
+        for member, score in pairs:
+            if values.add(member, score):
+                added += 1
+                delta += sizeof(member) + sizeof(score) + ENTRY_OVERHEAD[encoding]
+        self._collectionchanged(key, values, encoding, delta)
+        return added
+
+    def zrem(self, key, *members):
+        values = self._getcollection(key, ZSetValue)
+        if values is None:
+            return 0
+        encoding = values.encoding
+        removed = delta = 0
+        for member in members:
+            if values.remove(member):
+                removed += 1
+                delta -= sizeof(member) + sizeof(0.0) + ENTRY_OVERHEAD[encoding]
+        self._collectionchanged(key, values, encoding, delta)
+        return removed
+
+    def zcard(self, key):
+        values = self._getcollection(key, ZSetValue)
+        return 0 if values is None else len(values)
+
+    def zscore(self, key, member):
+        values = self._getcollection(key, ZSetValue)
+        return None if values is None else values.score(member)
+
+    def zrank(self, key, member):
+        values = self._getcollection(key, ZSetValue)
+        return None if values is None else values.rank(member)
+
+    def _scorebound(self, value):
+        # '(1.5' is exclusive; '-inf' and '+inf' are what float() makes of them.
+        if isinstance(value, str) and value.startswith('('):
+            return self._score(value[1:]), True
+        return self._score(value), False
+
+    def zrangebyscore(self, key, low, high, *options):
+        """ZRANGEBYSCORE key min max [WITHSCORES] [LIMIT offset count]"""
+        low, lowexclusive = self._scorebound(low)
+        high, highexclusive = self._scorebound(high)
+        withscores = False
+        offset, count = 0, None
+        options = list(options)
+        while options:
+            option = str(options.pop(0)).upper()
+            if option == 'WITHSCORES':
+                withscores = True
+            elif option == 'LIMIT' and len(options) >= 2:
+                offset, count = int(options.pop(0)), int(options.pop(0))
             else:
-                logging.error("brpop(). The logic here should be able to retrieve a value. might need an atomic execution around here.")
-                return None
-        else:
-            waittogetvalue.set()    # set it to abandon it, so the releaseblock() function will move on to next block in _queue
+                raise CommandError('syntax error')
+        values = self._getcollection(key, ZSetValue)
+        if values is None:
+            return []
+        entries = values.rangebyscore(low, high, lowexclusive, highexclusive)
+        entries = entries[offset:] if count is None or count < 0 else entries[offset:offset + count]
+        if withscores:
+            return [item for score, member in entries for item in (member, score)]
+        return [member for score, member in entries]
+
+    # Streams: append-only logs read by ID range, or through consumer groups that
+    # deliver each entry to one consumer and keep it pending until acknowledged.
+    # streams.py has the chunked storage. XREAD/XREADGROUP BLOCK wait like BLPOP does.
+    STREAM_READ_COMMANDS = ('XREAD', 'XREADGROUP')
+
+    def _streamid(self, value, seq=0):
+        try:
+            return parseid(value, seq)
+        except ValueError:
+            raise CommandError('Invalid stream ID specified as stream command argument')
+
+    def _streambound(self, value, end=False):
+        """An XRANGE/XPENDING bound: - and + for the ends, a '(' prefix for an exclusive one."""
+        value = str(value)
+        if value == '-':
+            return MINID
+        if value == '+':
+            return MAXID
+        seq = MAXID >> 64 if end else 0     # ms alone: all of that ms.
+        if value.startswith('('):
+            sid = self._streamid(value[1:], seq)
+            if sid == (MINID if end else MAXID):
+                raise CommandError('invalid start or end ID for an exclusive range')
+            return sid - 1 if end else sid + 1
+        return self._streamid(value, seq)
+
+    @staticmethod
+    def _streamcount(value):
+        try:
+            count = int(value)
+        except (TypeError, ValueError):
+            raise CommandError('value is not an integer or out of range')
+        return count if count > 0 else None
+
+    def _maxlenargs(self, args, i):
+        """MAXLEN [=|~] threshold at args[i]: (threshold, approximate, index after it)."""
+        approximate = False
+        if i < len(args) and str(args[i]) in ('=', '~'):
+            approximate = str(args[i]) == '~'
+            i += 1
+        if i >= len(args):
+            raise CommandError('syntax error')
+        try:
+            maxlen = int(args[i])
+        except (TypeError, ValueError):
+            raise CommandError('value is not an integer or out of range')
+        if maxlen < 0:
+            raise CommandError('The MAXLEN argument must be >= 0.')
+        return maxlen, approximate, i + 1
+
+    def _getstream(self, key):
+        return self._getcollection(key, StreamValue)
+
+    def _getgroup(self, key, group, command):
+        stream = self._getstream(key)
+        if stream is None or group not in stream.groups:
+            raise CommandError(f"NOGROUP No such key '{key}' or consumer group '{group}' in {command}")
+        return stream, stream.groups[group]
+
+    def _streamchanged(self, key, stream, before):
+        self._resize(key, sys.getsizeof(stream) - before)
+
+    def _trimstream(self, key, stream, maxlen, approximate):
+        """Trim and say how: as an exact MAXLEN, so a replica, whose chunks may not line
+        up with ours, trims to the very same entries."""
+        before = sys.getsizeof(stream)
+        removed = stream.trim(maxlen, approximate)
+        if removed:
+            self._streamchanged(key, stream, before)
+        return removed, ('MAXLEN', '=', len(stream))
+
+    def xadd(self, key, *args):
+        """XADD key [NOMKSTREAM] [MAXLEN [=|~] threshold] *|id field value [field value ...]"""
+        nomkstream, maxlen, approximate, i = False, None, False, 0
+        while i < len(args):
+            option = str(args[i]).upper()
+            if option == 'NOMKSTREAM':
+                nomkstream, i = True, i + 1
+            elif option == 'MAXLEN':
+                maxlen, approximate, i = self._maxlenargs(args, i + 1)
+            else:
+                break
+        fields = args[i + 1:]
+        if not fields or len(fields) % 2:
+            raise CommandError('wrong number of arguments for XADD')
+        if key in self._ttl:
+            self._expireifneeded(key)
+        stream = self._kv.get(key)
+        if stream is not None and type(stream) is not StreamValue:
+            raise CommandError(self.WRONGTYPE)
+        if stream is None and nomkstream:
             return None
+        sid = self._newstreamid(args[i], MINID if stream is None else stream.lastid)
+        try:
+            if stream is None:
+                stream = StreamValue()
+                stream.add(sid, fields)
+                self._store(key, stream)
+            else:
+                before = sys.getsizeof(stream)
+                stream.add(sid, fields)
+                self._streamchanged(key, stream, before)
+        except ValueError as err:
+            raise CommandError(f'unsupported field or value: {err}')
+        # A SETLENGTH cap on the key acts as a standing MAXLEN ~.
+        if maxlen is None and key in self._listlength:
+            maxlen, approximate = self._listlength[key], True
+        trimming = ()
+        if maxlen is not None:
+            _, trimming = self._trimstream(key, stream, maxlen, approximate)
+        # Logged with the ID it got (* would make another one on replay).
+        self._rewritecommand('XADD', key, *trimming, formatid(sid), *fields)
+        if key in self._blocked:
+            self._serveblocked(key)
+        return formatid(sid)
+
+    def _newstreamid(self, value, lastid):
+        """The ID an XADD with * (or ms-*, or an explicit ID) gives its entry after lastid."""
+        value = str(value)
+        if value == '*':
+            return nextid(lastid, mstime())
+        if value.endswith('-*'):
+            sid = self._streamid(value[:-2])
+            if sid >> 64 == lastid >> 64:
+                sid = lastid + 1
+                if not sid & MAXID >> 64:
+                    raise CommandError('The ID specified in XADD is equal or smaller than the target stream top item')
+        else:
+            sid = self._streamid(value)
+        if sid == MINID:
+            raise CommandError('The ID specified in XADD must be greater than 0-0')
+        if sid <= lastid:
+            raise CommandError('The ID specified in XADD is equal or smaller than the target stream top item')
+        return sid
+
+    def xlen(self, key):
+        stream = self._getstream(key)
+        return 0 if stream is None else len(stream)
+
+    def xrange(self, key, start, end, *options):
+        """XRANGE key start end [COUNT count]; - and + are the first and last IDs."""
+        return self._xrange(key, self._streambound(start), self._streambound(end, True), options, False)
+
+    def xrevrange(self, key, end, start, *options):
+        """XREVRANGE key end start [COUNT count]: XRANGE, newest first."""
+        return self._xrange(key, self._streambound(start), self._streambound(end, True), options, True)
+
+    def _xrange(self, key, start, end, options, reverse):
+        count = None
+        if options:
+            if len(options) != 2 or str(options[0]).upper() != 'COUNT':
+                raise CommandError('syntax error')
+            count = self._streamcount(options[1])
+            if count is None:
+                return []
+        stream = self._getstream(key)
+        if stream is None:
+            return []
+        return stream.revrange(end, start, count) if reverse else stream.range(start, end, count)
+
+    def xtrim(self, key, *args):
+        """XTRIM key MAXLEN [=|~] threshold; returns how many entries went."""
+        if not args or str(args[0]).upper() != 'MAXLEN':
+            raise CommandError('syntax error')
+        maxlen, approximate, i = self._maxlenargs(args, 1)
+        if i != len(args):
+            raise CommandError('syntax error')
+        stream = self._getstream(key)
+        if stream is None:
+            return 0
+        removed, trimming = self._trimstream(key, stream, maxlen, approximate)
+        self._rewritecommand('XTRIM', key, *trimming)
+        return removed
+
+    def xgroup(self, subcommand, key, *args):
+        """XGROUP CREATE key group id|$ [MKSTREAM] | SETID key group id|$ | DESTROY key group
+        | CREATECONSUMER key group consumer | DELCONSUMER key group consumer"""
+        subcommand = str(subcommand).upper()
+        if subcommand == 'CREATE' and len(args) in (2, 3):
+            if len(args) == 3 and str(args[2]).upper() != 'MKSTREAM':
+                raise CommandError('syntax error')
+            stream = self._getstream(key)
+            if stream is None:
+                if len(args) == 2:
+                    raise CommandError('The XGROUP subcommand requires the key to exist. Note that for CREATE '
+                                       'you may want to use the MKSTREAM option to create an empty stream automatically.')
+                stream = self._getcollection(key, StreamValue, create=True)
+            group, lastid = args[0], self._groupstart(stream, args[1])
+            if group in stream.groups:
+                raise CommandError('BUSYGROUP Consumer Group name already exists')
+            before = sys.getsizeof(stream)
+            stream.groups[group] = ConsumerGroup(lastid)
+            self._streamchanged(key, stream, before)
+            # $ is logged as the ID it stood for.
+            self._rewritecommand('XGROUP', 'CREATE', key, group, formatid(lastid), *args[2:])
+            return 'OK'
+        if subcommand == 'SETID' and len(args) == 2:
+            stream, group = self._getgroup(key, args[0], 'XGROUP')
+            group.lastid = self._groupstart(stream, args[1])
+            self._resize(key, 0)
+            self._rewritecommand('XGROUP', 'SETID', key, args[0], formatid(group.lastid))
+            return 'OK'
+        if subcommand == 'DESTROY' and len(args) == 1:
+            stream = self._getstream(key)
+            if stream is None or args[0] not in stream.groups:
+                return 0
+            before = sys.getsizeof(stream)
+            self._lazyfree(stream.groups.pop(args[0]))
+            self._streamchanged(key, stream, before)
+            return 1
+        if subcommand in ('CREATECONSUMER', 'DELCONSUMER') and len(args) == 2:
+            stream, group = self._getgroup(key, args[0], 'XGROUP')
+            before = sys.getsizeof(stream)
+            if subcommand == 'CREATECONSUMER':
+                if args[1] in group.consumers:
+                    return 0
+                group.consumer(args[1], mstime())
+                result = 1
+            else:
+                result = group.delconsumer(args[1])
+            self._streamchanged(key, stream, before)
+            return result
+        raise CommandError('XGROUP takes CREATE, SETID, DESTROY, CREATECONSUMER or DELCONSUMER, '
+                           'with their arguments')
+
+    def _groupstart(self, stream, value):
+        # $: only entries added from now on.
+        return stream.lastid if str(value) == '$' else self._streamid(value)
+
+    def xread(self, *args):
+        """XREAD [COUNT count] [BLOCK ms] STREAMS key [key ...] id [id ...]; $ is the last ID now."""
+        return self._streamread('XREAD', args)
+
+    def xreadgroup(self, *args):
+        """XREADGROUP GROUP group consumer [COUNT count] [BLOCK ms] [NOACK] STREAMS key [key ...] id [id ...]
+
+        > reads entries never delivered to the group, which are then pending for the
+        consumer until XACK; an ID reads the consumer's own pending entries after it.
+        """
+        return self._streamread('XREADGROUP', args)
+
+    def _streamreadargs(self, command, args):
+        """Parse XREAD/XREADGROUP into a StreamRead."""
+        read = StreamRead(command)
+        i = 0
+        if command == 'XREADGROUP':
+            if len(args) < 3 or str(args[0]).upper() != 'GROUP':
+                raise CommandError('Missing GROUP option for XREADGROUP')
+            read.group, read.consumer, i = args[1], args[2], 3
+        while i < len(args):
+            option = str(args[i]).upper()
+            if option == 'STREAMS':
+                break
+            if option == 'NOACK' and read.group is not None:
+                read.noack, i = True, i + 1
+            elif option in ('COUNT', 'BLOCK') and i + 1 < len(args):
+                if option == 'COUNT':
+                    read.count = self._streamcount(args[i + 1])
+                else:
+                    try:
+                        block = int(args[i + 1])
+                    except (TypeError, ValueError):
+                        raise CommandError('timeout is not an integer or out of range')
+                    if block < 0:
+                        raise CommandError('timeout is negative')
+                    read.block = block / 1000
+                i += 2
+            else:
+                raise CommandError('syntax error')
+        streams = args[i + 1:]
+        if not streams or len(streams) % 2:
+            raise CommandError(f"Unbalanced '{command.lower()}' list of streams: for each stream key "
+                               "an ID or '$' must be specified.")
+        n = len(streams) // 2
+        read.keys = list(streams[:n])
+        for key, value in zip(read.keys, streams[n:]):
+            value = str(value)
+            if read.group is not None and value == '>':
+                read.ids.append(None)
+            elif read.group is None and value == '$':
+                stream = self._kv.get(key)
+                read.ids.append(stream.lastid if type(stream) is StreamValue else MINID)
+            else:
+                read.ids.append(self._streamid(value))
+        return read
+
+    def _streamready(self, read):
+        """What read gets now: [[key, entries], ...] or None."""
+        result = []
+        for key, sid in zip(read.keys, read.ids):
+            stream = self._getstream(key)
+            if read.group is None:
+                if stream is not None:
+                    entries = stream.range(sid + 1, MAXID, read.count)
+                    if entries:
+                        result.append([key, entries])
+                continue
+            if stream is None or read.group not in stream.groups:
+                raise CommandError(f"NOGROUP No such key '{key}' or consumer group '{read.group}' "
+                                   "in XREADGROUP with GROUP option")
+            entries = self._readgroup(key, stream, read, sid)
+            if entries or sid is not None:  # a pending history is replied even if empty.
+                result.append([key, entries])
+        return result or None
+
+    def _readgroup(self, key, stream, read, sid):
+        group = stream.groups[read.group]
+        before = sys.getsizeof(stream)
+        if sid is None:
+            entries = group.deliver(stream, read.consumer, read.count, read.noack, mstime())
+        else:
+            entries = group.history(stream, read.consumer, sid, read.count, mstime())
+        if entries or sys.getsizeof(stream) != before:
+            self._streamchanged(key, stream, before)
+        return entries
+
+    @staticmethod
+    def _readgroupcommand(read, keys, ids, count):
+        # How an XREADGROUP is logged: without BLOCK, as its replay must not wait.
+        return (('XREADGROUP', 'GROUP', read.group, read.consumer) + (('COUNT', count) if count else ())
+                + (('NOACK',) if read.noack else ()) + ('STREAMS',) + tuple(keys) + tuple(ids))
+
+    def _streamread(self, command, args):
+        read = self._streamreadargs(command, args)
+        result = self._streamready(read)
+        if read.group is not None:
+            self._rewritecommand(*self._readgroupcommand(
+                read, read.keys, ['>' if sid is None else formatid(sid) for sid in read.ids], read.count))
+        # Only a read that found nothing new (so XREADGROUP with > only) waits.
+        if result is not None or read.block is None or self._inexec:
+            return result
+        client = self._block(command, read.keys, gevent.event.Event(), read)
+        try:
+            self._waitforhandoff(client, read.block or None)
+        finally:
+            self._unblock(client)
+            # What it was handed was logged by the XADD that did it.
+            self._rewritecommand()
+        return client.value
+
+    def _servestreamreads(self, key, waiters):
+        """Hand the new entries of the stream at key to the XREAD/XREADGROUP clients waiting on it."""
+        stream = self._kv[key]
+        for client in [client for client in waiters if client.command in self.STREAM_READ_COMMANDS]:
+            read = client.move
+            if read.group is None:
+                entries = stream.range(read.ids[read.keys.index(key)] + 1, MAXID, read.count)
+            elif read.group in stream.groups:
+                entries = self._readgroup(key, stream, read, None)
+            else:
+                entries = None  # the group was destroyed meanwhile; it waits on.
+            if not entries:
+                continue
+            self._unblock(client)
+            if read.group is not None:
+                self._propagatehandoff(self._readgroupcommand(read, [key], ['>'], len(entries)))
+            client.key = key
+            client.value = [[key, entries]]
+            client.wakeup.set()
+
+    def xack(self, key, group, *ids):
+        """XACK key group id [id ...]: the entries were processed; returns how many were pending."""
+        if not ids:
+            raise CommandError('wrong number of arguments for XACK')
+        ids = [self._streamid(sid) for sid in ids]
+        stream = self._getstream(key)
+        if stream is None or group not in stream.groups:
+            return 0
+        before = sys.getsizeof(stream)
+        acked = stream.groups[group].ack(ids)
+        if acked:
+            self._streamchanged(key, stream, before)
+        return acked
+
+    def xclaim(self, key, group, consumer, minidle, *args):
+        """XCLAIM key group consumer min-idle-time id [id ...] [IDLE ms] [TIME ms-unix-time]
+        [RETRYCOUNT count] [FORCE] [JUSTID]: take over entries other consumers left pending."""
+        try:
+            minidle = max(int(minidle), 0)
+        except (TypeError, ValueError):
+            raise CommandError('Invalid min-idle-time argument for XCLAIM')
+        ids, i = [], 0
+        while i < len(args) and str(args[i]).upper() not in ('IDLE', 'TIME', 'RETRYCOUNT', 'FORCE', 'JUSTID'):
+            ids.append(self._streamid(args[i]))
+            i += 1
+        if not ids:
+            raise CommandError('wrong number of arguments for XCLAIM')
+        now = mstime()
+        delivered, retrycount, force, justid = now, None, False, False
+        while i < len(args):
+            option = str(args[i]).upper()
+            if option in ('FORCE', 'JUSTID'):
+                force, justid = force or option == 'FORCE', justid or option == 'JUSTID'
+                i += 1
+            elif option in ('IDLE', 'TIME', 'RETRYCOUNT') and i + 1 < len(args):
+                try:
+                    value = int(args[i + 1])
+                except (TypeError, ValueError):
+                    raise CommandError(f'Invalid {option} option argument for XCLAIM')
+                if option == 'IDLE':
+                    delivered = now - value
+                elif option == 'TIME':
+                    delivered = value
+                else:
+                    retrycount = value
+                i += 2
+            else:
+                raise CommandError(f'Unrecognized XCLAIM option {args[i]!r}')
+        stream, consumergroup = self._getgroup(key, group, 'XCLAIM')
+        before = sys.getsizeof(stream)
+        delivered = min(delivered, now)
+        claimed, changed = consumergroup.claim(stream, consumer, minidle, ids, now, delivered,
+                                               retrycount, force, justid)
+        self._streamchanged(key, stream, before)
+        if not changed:
+            self._rewritecommand()
+            return claimed
+        # Logged as what it did: the IDs it changed, delivered at an absolute time.
+        options = ('TIME', delivered)
+        if retrycount is not None:
+            options += ('RETRYCOUNT', retrycount)
+        options += ('FORCE',) * force + ('JUSTID',) * justid
+        self._rewritecommand('XCLAIM', key, group, consumer, 0, *[formatid(sid) for sid in changed], *options)
+        return claimed
+
+    def xpending(self, key, group, *args):
+        """XPENDING key group [[IDLE min-idle-time] start end count [consumer]]"""
+        stream, consumergroup = self._getgroup(key, group, 'XPENDING')
+        if not args:
+            return consumergroup.summary()
+        args, minidle = list(args), 0
+        if str(args[0]).upper() == 'IDLE' and len(args) > 1:
+            minidle = self._streamcount(args[1]) or 0
+            args = args[2:]
+        if len(args) not in (3, 4):
+            raise CommandError('syntax error')
+        count = self._streamcount(args[2])
+        if count is None:
+            return []
+        return consumergroup.pendingrange(self._streambound(args[0]), self._streambound(args[1], True), count,
+                                          mstime(), args[3] if len(args) == 4 else None, minidle)
+
+    def xinfo(self, subcommand, key, *args):
+        """XINFO STREAM key | GROUPS key | CONSUMERS key group"""
+        subcommand = str(subcommand).upper()
+        if subcommand == 'CONSUMERS' and len(args) == 1:
+            _, group = self._getgroup(key, args[0], 'XINFO')
+            now = mstime()
+            return [{'name': name, 'pending': len(consumer.pending), 'idle': now - consumer.seen}
+                    for name, consumer in group.consumers.items()]
+        if subcommand not in ('STREAM', 'GROUPS') or args:
+            raise CommandError('XINFO takes STREAM key, GROUPS key or CONSUMERS key group')
+        stream = self._getstream(key)
+        if stream is None:
+            raise CommandError('no such key')
+        if subcommand == 'GROUPS':
+            return [{'name': name, 'consumers': len(group.consumers), 'pending': len(group.pending),
+                     'last-delivered-id': formatid(group.lastid)}
+                    for name, group in stream.groups.items()]
+        first, last = stream.range(MINID, MAXID, 1), stream.revrange(MAXID, MINID, 1)
+        return {'length': len(stream), 'chunks': stream.chunks(), 'last-generated-id': formatid(stream.lastid),
+                'groups': len(stream.groups), 'first-entry': first[0] if first else None,
+                'last-entry': last[0] if last else None}
+
+    # HyperLogLogs and Bloom filters: a fixed size for any number of elements, see
+    # probabilistic.py. The PF/BF commands that add take many elements per call.
+    def _gethll(self, key, create=False):
+        """Return the HyperLogLog at key, or None if missing (and not created).
+
+        A string that is a HyperLogLog dump (GET's reply, or what an AOF rewrite SETs)
+        turns back into one, as in Redis, where HyperLogLogs are strings.
+        """
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if self._trackaccess:
+            self._index.touch(key)
+        value = self._kv.get(key)
+        if not create:
+            self._countlookup(value)
+        if value is None:
+            if not create:
+                return None
+            value = HyperLogLog()
+            self._store(key, value)
+        elif type(value) is not HyperLogLog:
+            try:
+                value = HyperLogLog.load(value)
+            except ValueError:
+                raise CommandError('WRONGTYPE Key is not a valid HyperLogLog string value.')
+            self._kv[key] = value
+            self._index.set(key, sizeof(key) + sizeof(value))
+        return value
 
-    def _checkttl(self):    #
-        while(True):
-            todelete = []
-            for key in self._ttl:
-                self._ttl[key] -= 1
-                if self._ttl[key] < 0:
-                    todelete.append(key)
+    def pfadd(self, key, *elements):
+        """PFADD key [element ...]: 1 if the count may have changed (or the key is new), else 0."""
+        if key in self._ttl:
+            self._expireifneeded(key)
+        created = key not in self._kv
+        hll = self._gethll(key, create=True)
+        before = sys.getsizeof(hll)
+        changed = hll.add(elements)
+        if changed:
+            self._resize(key, sys.getsizeof(hll) - before)
+        return int(changed or created)
+
+    def pfcount(self, *keys):
+        """PFCOUNT key [key ...]: the approximate number of distinct elements (of the union)."""
+        if not keys:
+            raise CommandError('wrong number of arguments for PFCOUNT')
+        if len(keys) == 1:
+            hll = self._gethll(keys[0])
+            return 0 if hll is None else hll.count()
+        return estimate(union([hll for hll in map(self._gethll, keys) if hll is not None]))
+
+    def pfmerge(self, destination, *sources):
+        """PFMERGE destkey [sourcekey ...]: destkey becomes the union of itself and the sources."""
+        hlls = [hll for hll in map(self._gethll, sources) if hll is not None]
+        target = self._gethll(destination, create=True)
+        before = sys.getsizeof(target)
+        target.merge([hll for hll in hlls if hll is not target])
+        self._resize(destination, sys.getsizeof(target) - before)
+        return 'OK'
+
+    def _getbloom(self, key, create=False):
+        return self._getcollection(key, BloomFilter, create)
+
+    def bfreserve(self, key, error_rate, capacity):
+        """BF.RESERVE key error_rate capacity: an empty filter; BF.ADD makes one with the defaults."""
+        try:
+            bloom = BloomFilter(float(error_rate), int(capacity))
+        except ValueError as err:
+            raise CommandError(str(err))
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if key in self._kv:
+            raise CommandError('item exists')
+        self._store(key, bloom)
+        return 'OK'
+
+    def bfadd(self, key, item):
+        """BF.ADD key item: 1 if item is surely new, 0 if it may have been added before."""
+        return self.bfmadd(key, item)[0]
+
+    def bfmadd(self, key, *items):
+        """BF.MADD key item [item ...]: BF.ADD's reply for every item, in one round trip."""
+        if not items:
+            raise CommandError('wrong number of arguments for BF.MADD')
+        bloom = self._getbloom(key, create=True)
+        added = [int(bloom.add(item)) for item in items]
+        if any(added):
+            self._resize(key, 0)    # preallocated: a write, but no growth.
+        return added
+
+    def bfexists(self, key, item):
+        """BF.EXISTS key item: 0 if item was never added, 1 if it probably was."""
+        return self.bfmexists(key, item)[0]
+
+    def bfmexists(self, key, *items):
+        if not items:
+            raise CommandError('wrong number of arguments for BF.MEXISTS')
+        bloom = self._getbloom(key)
+        return [int(bloom is not None and item in bloom) for item in items]
+
+    def bfcard(self, key):
+        """BF.CARD key: how many added items set a bit, about the number of distinct ones."""
+        bloom = self._getbloom(key)
+        return 0 if bloom is None else bloom.items
+
+    def bfinfo(self, key):
+        bloom = self._getbloom(key)
+        if bloom is None:
+            raise CommandError('not found')
+        return {'Capacity': bloom.capacity, 'Size': sys.getsizeof(bloom), 'Number of filters': 1,
+                'Number of items inserted': bloom.items, 'Expansion rate': None,
+                'Error rate': bloom.error_rate, 'Hash functions': bloom.hashes}
+
+    def bfscandump(self, key, iterator):
+        """BF.SCANDUMP key iterator: [next iterator, chunk]; start at 0, stop at [0, b''].
+
+        The first chunk is the filter's header, then its bits BF_DUMP_CHUNK bytes at a
+        time; BF.LOADCHUNK with each pair rebuilds the filter.
+        """
+        bloom = self._getbloom(key)
+        if bloom is None:
+            raise CommandError('not found')
+        iterator = int(iterator)
+        if iterator == 0:
+            return [1, bloom.header()]
+        start = (iterator - 1) * BF_DUMP_CHUNK
+        chunk = bytes(bloom.bits[start:start + BF_DUMP_CHUNK])
+        return [iterator + 1, chunk] if chunk else [0, b'']
+
+    def bfloadchunk(self, key, iterator, data):
+        """BF.LOADCHUNK key iterator chunk: restore what BF.SCANDUMP returned."""
+        iterator = int(iterator)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if iterator == 1:
+            try:
+                bloom = BloomFilter.fromheader(data)
+            except ValueError as err:
+                raise CommandError(str(err))
+            if key in self._kv:
+                self._lazyfree(self._unlink(key))
+            self._store(key, bloom)
+            return 'OK'
+        bloom = self._getbloom(key)
+        if bloom is None:
+            raise CommandError('not found')
+        start = (iterator - 2) * BF_DUMP_CHUNK
+        if iterator < 2 or start + len(data) > len(bloom.bits):
+            raise CommandError('invalid chunk')
+        bloom.bits[start:start + len(data)] = data
+        self._resize(key, 0)
+        return 'OK'
+
+    # Functions: Python callables registered from the --functions module, run in one round trip.
+    def fcall(self, name, numkeys, *keysandargs):
+        """FCALL function numkeys [key ...] [arg ...]"""
+        func = self._functions.byname.get(name)
+        if func is None:
+            raise CommandError(f'Function not found: {name}')
+        return self._runfunction(name, func, numkeys, keysandargs)
+
+    def evalsha(self, digest, numkeys, *keysandargs):
+        """EVALSHA sha1 numkeys [key ...] [arg ...]; the digests are in FUNCTION LIST."""
+        func = self._functions.bydigest.get(str(digest).lower())
+        if func is None:
+            raise CommandError('NOSCRIPT No matching function. Use FUNCTION LIST.')
+        return self._runfunction(func.__name__, func, numkeys, keysandargs)
+
+    def function(self, subcommand='LIST'):
+        """FUNCTION LIST: name -> digest of every registered function."""
+        if str(subcommand).upper() != 'LIST':
+            raise CommandError(f'Unknown FUNCTION subcommand: {subcommand}')
+        return dict(self._functions.digests)
+
+    @staticmethod
+    def _functionkeys(data):
+        """The keys of an FCALL/EVALSHA request, or () if numkeys is no good."""
+        try:
+            numkeys = int(data[2])
+        except (IndexError, ValueError):
+            return ()
+        return data[3:3 + numkeys] if numkeys >= 0 else ()
 
-            for key in todelete:
-                del self._ttl[key]
-                del self._kv[key]
+    def _runfunction(self, name, func, numkeys, keysandargs):
+        try:
+            numkeys = int(numkeys)
+        except ValueError:
+            raise CommandError('numkeys must be an integer')
+        if not 0 <= numkeys <= len(keysandargs):
+            raise CommandError("Number of keys can't be greater than number of args")
+        from functions import FunctionContext
+        # Nothing yields while it runs, so it is atomic; the log gets the writes it made
+        # between MULTI and EXEC, unless an EXEC around it already wraps them.
+        self._functionpending = self._propagating and not self._inexec
+        try:
+            return func(FunctionContext(self), list(keysandargs[:numkeys]), list(keysandargs[numkeys:]))
+        except CommandError:
+            raise
+        except Exception as exc:
+            logging.exception(f'Function {name} failed')
+            raise CommandError(f'Error running function {name}: {exc}')
+        finally:
+            if self._functionmulti:
+                self._propagate(('EXEC',))
+            self._functionpending = self._functionmulti = False
+
+    def _functioncall(self, data):
+        """A command run by a function, through the same path as a client's."""
+        if self._functionpending and data[0] in self.WRITE_COMMANDS:
+            self._propagate(('MULTI',))
+            self._functionpending, self._functionmulti = False, True
+        return Server.get_response(self, data)
+
+    # Pub/Sub: SUBSCRIBE and friends change connection state, see _pubsubcommand().
+    def publish(self, channel, message):
+        """PUBLISH channel message; returns how many subscribers it was sent to.
+
+        The message is encoded once per channel or pattern matched, and that one bytes
+        object is queued for every subscriber's socket.
+        """
+        channel = channelname(channel)
+        receivers = 0
+        subscribers = self._channels.get(channel)
+        if subscribers:
+            data = self._encodepush(['message', channel, message])
+            for subscriber in tuple(subscribers):
+                subscriber.push(data)
+            receivers = len(subscribers)
+        for pattern, subscribers in list(self._patterns.match(channel)):
+            data = self._encodepush(['pmessage', pattern, channel, message])
+            for subscriber in tuple(subscribers):
+                subscriber.push(data)
+            receivers += len(subscribers)
+        return receivers
+
+    def pubsub(self, subcommand, *args):
+        """PUBSUB CHANNELS [pattern] | NUMSUB [channel ...] | NUMPAT"""
+        subcommand = str(subcommand).upper()
+        if subcommand == 'CHANNELS':
+            if not args:
+                return sorted(self._channels)
+            regex = globregex(channelname(args[0]))
+            return sorted(channel for channel in self._channels if regex.match(channel))
+        if subcommand == 'NUMSUB':
+            return {channel: len(self._channels.get(channelname(channel), ())) for channel in args}
+        if subcommand == 'NUMPAT':
+            return len(self._patterns)
+        raise CommandError(f'Unknown PUBSUB subcommand: {subcommand}')
+
+    def ping(self, message=None):
+        return 'PONG' if message is None else message
+
+    # Replication: a primary streams its writes (what _feed() sends to the append-only
+    # file) to its replicas, after a snapshot for the first sync. See replication.py.
+    def replicaof(self, host, port=None):
+        """REPLICAOF host port: become a read-only replica of host:port. REPLICAOF NO ONE: stop."""
+        from replication import PrimaryLink
+        if str(host).upper() == 'NO' and str(port).upper() == 'ONE':
+            if self._primary is not None:
+                self._primary.stop()
+                self._primary = None
+                # Keep the data and the stream offset; replicas of the old primary can resume from us.
+                if self._backlog is not None:
+                    self._backlog.newhistory()
+                self._updatepropagating()
+                logging.warning("Replication stopped: this server is a primary now")
+            return 'OK'
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            raise CommandError('REPLICAOF needs host and port, or NO ONE')
+        if self._primary is not None:
+            if (self._primary.host, self._primary.port) == (host, port):
+                return 'OK'
+            self._primary.stop()
+        if self._backlog is not None and self._backlog.replicas:
+            # Their data would fork from ours: they get an error and retry, which we then refuse.
+            error = self._encodepush(Error('replication source changed'))
+            for subscriber in self._backlog.replicas:
+                subscriber.push(error)
+            self._backlog.replicas.clear()
+        self._primary = PrimaryLink(self, host, port)
+        self._updatepropagating()
+        self._startlink()
+        return 'OK'
+
+    def _startlink(self):
+        self._primary.start()
+
+    def _callsoon(self, func, *args):
+        """Run func(*args) where commands run. Greenlets (PrimaryLink's thread, under gevent) can just call it."""
+        func(*args)
+
+    def _waitchild(self, pid, callback, *args):
+        """Call callback(*args, status) where commands run, once the forked child pid exits."""
+        def wait():
+            _, status = os.waitpid(pid, 0)
+            self._callsoon(callback, *args, status)
+        threading.Thread(target=wait, daemon=True).start()
+
+    def _psync(self, subscriber, args):
+        """PSYNC replid offset: turn this connection into a replica's stream."""
+        from replication import ReplicationBacklog
+        from persistence import dump_snapshot
+        if self._primary is not None:
+            raise CommandError("PSYNC refused: this server is a replica; sync from its primary")
+        if len(args) != 2:
+            raise CommandError('PSYNC needs a replication id and an offset')
+        try:
+            offset = int(args[1])
+        except ValueError:
+            raise CommandError('PSYNC offset must be an integer')
+        if self._backlog is None:
+            self._backlog = ReplicationBacklog(self._replbacklogsize, limit=self._replbufferlimit)
+            self._updatepropagating()
+        backlog = self._backlog
+        missed = backlog.since(str(args[0]), offset)
+        if missed is not None:
+            subscriber.push(self._encodepush(['CONTINUE', backlog.replid]), backlog.limit)
+            if missed:
+                subscriber.push(missed, backlog.limit)
+            backlog.replicas[subscriber] = None
+            self._partialsyncs += 1
+            return PUSHED
+        if args[0] != '?':
+            self._partialsyncerrors += 1
+        # A forked child writes the snapshot as of now; the stream after it waits in pending.
+        backlog.replicas[subscriber] = []
+        fd, filename = tempfile.mkstemp(prefix='miniredis-sync-')
+        os.close(fd)
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                dump_snapshot(filename, self._kv, self._ttl, self._listlength)
+                status = 0
+            except Exception:
+                logging.exception("Snapshot for a replica failed")
+            finally:
+                os._exit(status)
+        self._fullsyncs += 1
+        self._waitchild(pid, self._fullsyncdone, subscriber, filename, backlog.replid, backlog.offset)
+        return PUSHED
+
+    def _fullsyncdone(self, subscriber, filename, replid, offset, status):
+        try:
+            backlog = self._backlog
+            pending = backlog.replicas.get(subscriber) if backlog is not None else None
+            if pending is None:
+                return      # the replica went away meanwhile, or we became a replica.
+            if status != 0 or backlog.replid != replid:
+                del backlog.replicas[subscriber]
+                subscriber.push(self._encodepush(Error('full sync failed')))
+                return
+            with open(filename, 'rb') as fh:
+                snapshot = fh.read()
+            subscriber.push(self._encodepush(['FULLRESYNC', replid, offset, snapshot]), backlog.limit)
+            for data in pending:
+                subscriber.push(data, backlog.limit)
+            backlog.replicas[subscriber] = None
+        finally:
+            os.remove(filename)
+
+    def _replicasynced(self, link, kv, ttl, listlength, replid, offset):
+        """The primary's snapshot arrived: it replaces the dataset, and the stream resumes from offset."""
+        from replication import ReplicationBacklog
+        if link is not self._primary:
+            return      # REPLICAOF changed while it was on its way.
+        self._loaddataset(kv, ttl, listlength)
+        self._touchall()
+        self._backlog = ReplicationBacklog(self._replbacklogsize, replid, offset, self._replbufferlimit)
+        if self._aof is not None and not self._aof.rewrite(self._dumpcommands):
+            logging.error("Replica's append-only file is stale: a rewrite was already running during the full sync")
+
+    def _replicacontinued(self, link, replid):
+        if link is not self._primary:
+            return
+        if self._backlog.replid != replid:
+            self._backlog.newhistory(replid)    # the primary was promoted since.
 
-            time.sleep(60)
+    def _applyreplicated(self, link, frames):
+        """Run the primary's write commands, and pass them on to our append-only file."""
+        if link is not self._primary:
+            return
+        for data in frames:
+            if data[0] not in ('MULTI', 'EXEC'):
+                self._replay(data)
+            self._feed(data)
+
+    # Expiration: _ttl holds each key's absolute deadline and _expiryheap orders them, so
+    # neither the lazy check on access nor the active sweep ever scans the whole table.
+    ACTIVE_EXPIRE_PERIOD = 0.1     # seconds between active expiry cycles, at most.
+    ACTIVE_EXPIRE_BUDGET = 0.025   # seconds of work one cycle may use (25% of a period).
+
+    def _setdeadline(self, key, deadline):
+        self._ttl[key] = deadline
+        if self._versions or self._tracked:
+            self._touch(key)
+        heapq.heappush(self._expiryheap, (deadline, key))
+        if self._expiryheap[0][1] == key:
+            self._expirywakeup.set()    # earlier than what the sweeper sleeps towards.
+        # Stale heap entries pile up when keys are re-expired; rebuild once they dominate.
+        if len(self._expiryheap) > 2 * len(self._ttl) + 1024:
+            self._expiryheap = [(when, k) for k, when in self._ttl.items()]
+            heapq.heapify(self._expiryheap)
+
+    def _expireifneeded(self, key, now=None):
+        """Delete key if its deadline passed. Returns True if it was expired."""
+        deadline = self._ttl.get(key)
+        if deadline is None or deadline > (now if now is not None else mstime()):
+            return False
+        self._lazyfree(self._unlink(key))
+        self._expired += 1
+        return True
+
+    def _activeexpire(self):
+        """Expire due keys in deadline order until none are due or the time budget is spent.
+
+        Returns the seconds until the next deadline (capped at one period), or 0 if the
+        budget ran out with due keys left, so the caller comes back after a pause.
+        """
+        heap = self._expiryheap
+        started = time.monotonic()
+        self._sampleops(started)
+        now = mstime()
+        checked = 0
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._ttl.get(key) == deadline:
+                self._expireifneeded(key, now)
+            checked += 1
+            if checked % 64 == 0 and time.monotonic() - started > self.ACTIVE_EXPIRE_BUDGET:
+                self._latencymonitor.add('expire-cycle', (time.monotonic() - started) * 1000)
+                return 0
+        if checked:
+            self._latencymonitor.add('expire-cycle', (time.monotonic() - started) * 1000)
+        if not heap:
+            return self.ACTIVE_EXPIRE_PERIOD
+        return min(max((heap[0][0] - now) / 1000, 0.001), self.ACTIVE_EXPIRE_PERIOD)
+
+    def _sampleops(self, now):
+        """Every period, record the commands/sec since the last sample (instantaneous_ops_per_sec)
+        and count the latencies of those commands into their histograms."""
+        then, processed = self._lastsample
+        if now - then >= self.ACTIVE_EXPIRE_PERIOD:
+            self._opssamples.append((self._commandsprocessed - processed) / (now - then))
+            self._lastsample = (now, self._commandsprocessed)
+            self._foldlatencies()
+
+    def _foldlatencies(self):
+        for command, latencies in self._latencies.items():
+            if latencies:
+                self._histograms[command].extend(latencies)
+                latencies.clear()
+
+    def _checkttl(self):    # active expiry; sleeps until the earliest deadline.
+        while(True):
+            self._expirywakeup.clear()
+            wait = self._activeexpire()
+            if wait == 0:
+                # Over budget: leave the rest of the period to clients.
+                wait = self.ACTIVE_EXPIRE_PERIOD - self.ACTIVE_EXPIRE_BUDGET
+                due = time.monotonic() + wait
+                time.sleep(wait)
+            else:
+                due = time.monotonic() + wait
+                self._expirywakeup.wait(wait)
+            # Woken this late past its timer: something held the event loop that long.
+            self._latencymonitor.add('event-loop', (time.monotonic() - due) * 1000)
 
     def expire(self, key, timeout):
-        self._ttl[key] = int(timeout)
-        return timeout
+        return self.pexpire(key, int(timeout) * 1000)
 
-    def persist(self, key):
+    def pexpire(self, key, timeout):
+        return self.pexpireat(key, mstime() + int(timeout))
+
+    def pexpireat(self, key, deadline):
+        deadline = int(deadline)
+        self._rewritecommand('PEXPIREAT', key, deadline)
         if key in self._ttl:
+            self._expireifneeded(key)
+        if key not in self._kv:
+            self._rewritecommand()
+            return 0
+        self._setdeadline(key, deadline)
+        return 1
+
+    def persist(self, key):
+        if key in self._ttl and not self._expireifneeded(key):
             del self._ttl[key]
-        return None
+            self._touch(key)
+            return 1
+        return 0
 
     def ttl(self, key):
+        remaining = self.pttl(key)
+        if remaining < 0:
+            return remaining
+        return (remaining + 500) // 1000
+
+    def pttl(self, key):
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if key not in self._kv:
+            return -2
         if key not in self._ttl:
             return -1
-        return self._ttl[key]
-
-    def info(self):
-        result = "key, type, size\n"
-        for k in sorted(self._kv):
-            result += f"{k}, {type(self._kv[k])}, {sys.getsizeof(self._kv[k])}\n"
-        return result
-
-    def flushall(self):
-        self._kv = {}
-        self._queue = {}    # for callback.
-        self._ttl = {}
+        return max(self._ttl[key] - mstime(), 0)
+
+    def info(self, section=None):
+        """INFO [section]: counters kept as the server runs, so it costs the same on any keyspace.
+
+        Use SCAN to list keys, and TYPE / MEMORY USAGE to look at one.
+        """
+        sections = {'server': self._serverinfo, 'clients': self._clientsinfo, 'memory': self._memoryinfo,
+                    'persistence': self._persistenceinfo, 'stats': self._statsinfo,
+                    'replication': self._replicationinfo, 'keyspace': self._keyspaceinfo}
+        if section is None or str(section).lower() == 'default':
+            return "\r\n".join(build() for build in sections.values())
+        # Per-command sections list every command run so far: only when asked for.
+        sections.update({'commandstats': self._commandstatsinfo, 'latencystats': self._latencystatsinfo})
+        if str(section).lower() in ('all', 'everything'):
+            return "\r\n".join(build() for build in sections.values())
+        build = sections.get(str(section).lower())
+        if build is None:
+            raise CommandError(f'Unknown INFO section: {section}')
+        return build()
+
+    def _serverinfo(self):
+        lines = ["# Server",
+                 f"backend:{self.BACKEND}",
+                 f"process_id:{os.getpid()}",
+                 f"uptime_in_seconds:{int(time.time() - self._starttime)}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def _clientsinfo(self):
+        lines = ["# Clients",
+                 f"connected_clients:{self._connectedclients}",
+                 f"blocked_clients:{self._blockedclients}",
+                 f"watching_keys:{len(self._versions)}",
+                 f"tracking_clients:{self._trackingclients}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def _statsinfo(self):
+        samples = self._opssamples
+        lines = ["# Stats",
+                 f"total_connections_received:{self._totalconnections}",
+                 f"total_commands_processed:{self._commandsprocessed}",
+                 f"instantaneous_ops_per_sec:{int(sum(samples) / len(samples)) if samples else 0}",
+                 f"keyspace_hits:{self._hits}",
+                 f"keyspace_misses:{self._misses}",
+                 f"expired_keys:{self._expired}",
+                 f"evicted_keys:{self._evicted}",
+                 f"pubsub_channels:{len(self._channels)}",
+                 f"pubsub_patterns:{len(self._patterns)}",
+                 f"tracking_total_keys:{len(self._tracked)}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def _replicationinfo(self):
+        backlog = self._backlog
+        lines = ["# Replication"]
+        if self._primary is not None:
+            link = self._primary
+            lines += ["role:slave",
+                      f"master_host:{link.host}",
+                      f"master_port:{link.port}",
+                      f"master_link_status:{link.status}",
+                      f"master_last_io_seconds_ago:{int(time.time() - link.lastio)}",
+                      f"slave_repl_offset:{link.offset}"]
+        else:
+            replicas = backlog.replicas.values() if backlog is not None else ()
+            lines += ["role:master",
+                      f"connected_slaves:{len(replicas)}",
+                      f"slaves_syncing:{sum(1 for pending in replicas if pending is not None)}"]
+        lines += [f"master_replid:{backlog.replid if backlog is not None else ''}",
+                  f"master_replid2:{(backlog.replid2 or '') if backlog is not None else ''}",
+                  f"master_repl_offset:{backlog.offset if backlog is not None else 0}",
+                  f"repl_backlog_active:{int(backlog is not None)}",
+                  f"repl_backlog_size:{self._replbacklogsize}",
+                  f"repl_backlog_histlen:{len(backlog) if backlog is not None else 0}",
+                  f"sync_full:{self._fullsyncs}",
+                  f"sync_partial_ok:{self._partialsyncs}",
+                  f"sync_partial_err:{self._partialsyncerrors}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def _keyspaceinfo(self):
+        lines = ["# Keyspace"]
+        if self._kv:
+            lines.append(f"db0:keys={len(self._kv)},expires={len(self._ttl)}")
+        return "\r\n".join(lines) + "\r\n"
+
+    def _commandstatsinfo(self):
+        lines = ["# Commandstats"]
+        self._foldlatencies()
+        for command, histogram in sorted(self._histograms.items()):
+            usec, calls = histogram.total // 1000, histogram.count
+            lines.append(f"cmdstat_{command.lower()}:calls={calls},usec={usec},"
+                         f"usec_per_call={usec / calls:.2f}")
+        return "\r\n".join(lines) + "\r\n"
+
+    def _latencystatsinfo(self):
+        lines = ["# Latencystats"]
+        self._foldlatencies()
+        for command, histogram in sorted(self._histograms.items()):
+            p50, p99, p999 = (histogram.percentile(p) / 1000 for p in (50, 99, 99.9))
+            lines.append(f"latency_percentiles_usec_{command.lower()}:p50={p50:.3f},p99={p99:.3f},p99.9={p999:.3f}")
+        return "\r\n".join(lines) + "\r\n"
+
+    # Where the time goes: every command's duration lands in its histogram (unless
+    # latency_tracking is off), the slow ones in the slow log, and spikes of commands,
+    # expire / eviction cycles and a late event loop in the latency monitor.
+    def slowlog(self, subcommand, *args):
+        """SLOWLOG GET [count] | LEN | RESET"""
+        subcommand = str(subcommand).upper()
+        if subcommand == 'GET':
+            return self._slowlog.get(int(args[0]) if args else 10)
+        if subcommand == 'LEN':
+            return len(self._slowlog)
+        if subcommand == 'RESET':
+            self._slowlog.reset()
+            return 'OK'
+        raise CommandError(f'Unknown SLOWLOG subcommand: {subcommand}')
+
+    def latency(self, subcommand, *args):
+        """LATENCY LATEST | HISTORY event | RESET [event ...] | HISTOGRAM [command ...]"""
+        subcommand = str(subcommand).upper()
+        if subcommand == 'LATEST':
+            return self._latencymonitor.latest()
+        if subcommand == 'HISTORY':
+            if len(args) != 1:
+                raise CommandError('LATENCY HISTORY needs an event')
+            return self._latencymonitor.history(str(args[0]))
+        if subcommand == 'RESET':
+            return self._latencymonitor.reset(*(str(event) for event in args))
+        if subcommand == 'HISTOGRAM':
+            self._foldlatencies()
+            commands = [str(command).upper() for command in args] or sorted(self._histograms)
+            result = {}
+            for command in commands:
+                histogram = self._histograms.get(command)
+                if histogram is not None:
+                    result[command] = {'calls': histogram.count,
+                                       'p50': histogram.percentile(50) / 1000,
+                                       'p99': histogram.percentile(99) / 1000,
+                                       'p999': histogram.percentile(99.9) / 1000}
+            return result
+        raise CommandError(f'Unknown LATENCY subcommand: {subcommand}')
+
+    # Looking at the keyspace without stalling other clients: SCAN walks it a few keys
+    # per call (see KeyspaceIndex.scan); KEYS is here for small keyspaces and debugging.
+    def _visible(self, key, value, now, regex=None, typename=None):
+        deadline = self._ttl.get(key)
+        if deadline is not None and deadline <= now:
+            return False    # expired, not yet collected.
+        if regex is not None and not regex.match(channelname(key)):
+            return False
+        return typename is None or self._typename(value) == typename
+
+    def scan(self, cursor, *options):
+        """SCAN cursor [MATCH pattern] [COUNT count] [TYPE type] -> [next cursor, keys]"""
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            raise CommandError('invalid cursor')
+        if cursor < 0:
+            raise CommandError('invalid cursor')
+        regex, count, typename = None, 10, None
+        options = list(options)
+        while options:
+            option = str(options.pop(0)).upper()
+            if not options:
+                raise CommandError('syntax error')
+            value = options.pop(0)
+            if option == 'MATCH':
+                regex = globregex(channelname(value))
+            elif option == 'COUNT':
+                count = int(value)
+                if count < 1:
+                    raise CommandError('COUNT must be positive')
+            elif option == 'TYPE':
+                typename = str(value).lower()
+            else:
+                raise CommandError('syntax error')
+        cursor, keys = self._index.scan(cursor, count)
+        now = mstime()
+        kv = self._kv
+        return [cursor, [key for key in keys if self._visible(key, kv[key], now, regex, typename)]]
+
+    def keys(self, pattern='*'):
+        """KEYS pattern: every matching key at once. O(n) in one command; SCAN is the gentle way."""
+        regex = None if pattern == '*' else globregex(channelname(pattern))
+        now = mstime()
+        return [key for key, value in self._kv.items() if self._visible(key, value, now, regex)]
+
+    @staticmethod
+    def _typename(value):
+        if isinstance(value, ListValue):
+            return 'list'
+        if isinstance(value, HashValue):
+            return 'hash'
+        if isinstance(value, SetValue):
+            return 'set'
+        if isinstance(value, ZSetValue):
+            return 'zset'
+        if isinstance(value, StreamValue):
+            return 'stream'
+        if isinstance(value, BloomFilter):
+            return 'MBbloom--'  # RedisBloom's name for it; a HyperLogLog is a string, as in Redis.
+        return 'string'
+
+    def keytype(self, key):
+        """TYPE key: string, list, hash, set, zset, stream, MBbloom--, or none."""
+        if key in self._ttl:
+            self._expireifneeded(key)
+        value = self._kv.get(key)
+        return 'none' if value is None else self._typename(value)
+
+    def memory(self, subcommand, key=None):
+        """MEMORY USAGE key: the bytes the key is accounted for (as used by maxmemory)."""
+        if str(subcommand).upper() != 'USAGE' or key is None:
+            raise CommandError('MEMORY needs USAGE key')
+        if key in self._ttl:
+            self._expireifneeded(key)
+        if key not in self._kv:
+            return None
+        return self._index.size(key)
+
+    def _memoryinfo(self):
+        lines = ["# Memory",
+                 f"used_memory:{self._index.used}",
+                 f"maxmemory:{self._maxmemory}",
+                 f"maxmemory_policy:{self._maxmemorypolicy}",
+                 f"evicted_keys:{self._evicted}",
+                 f"lazyfree_pending_objects:{len(self._lazyfreer)}",
+                 f"lazyfreed_objects:{self._lazyfreer.freed}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def _persistenceinfo(self):
+        snapshot = self._snapshot
+        lines = ["# Persistence",
+                 f"rdb_filename:{snapshot.filename}",
+                 f"rdb_changes_since_last_save:{snapshot.changes}",
+                 f"rdb_bgsave_in_progress:{int(snapshot.in_progress())}",
+                 f"rdb_last_save_time:{snapshot.lastsave}",
+                 f"rdb_last_bgsave_status:{snapshot.laststatus}",
+                 f"rdb_last_save_duration_sec:{snapshot.lastduration:.3f}",
+                 f"rdb_last_save_size:{snapshot.lastsize}",
+                 f"rdb_last_load_duration_sec:{snapshot.loadduration:.3f}",
+                 f"aof_enabled:{int(self._aof is not None)}"]
+        if self._aof is not None:
+            lines += [f"aof_filename:{self._aof.filename}",
+                      f"aof_fsync:{self._aof.fsync}",
+                      f"aof_rewrite_in_progress:{int(self._aof._rewritepid is not None)}",
+                      f"aof_rewrites:{self._aof.rewrites}"]
+        return "\r\n".join(lines) + "\r\n"
+
+    def save(self):
+        if self._snapshot.in_progress():
+            raise CommandError('Background save already in progress')
+        self._snapshot.save(self._kv, self._ttl, self._listlength)
+        return 'OK'
+
+    def bgsave(self):
+        if not self._snapshot.bgsave(self._kv, self._ttl, self._listlength):
+            raise CommandError('Background save already in progress')
+        return 'Background saving started'
+
+    def lastsave(self):
+        return self._snapshot.lastsave
+
+    def flushall(self, mode=None):
+        """FLUSHALL [ASYNC|SYNC]; ASYNC frees the dropped keys in the background."""
+        if self._isasync(mode):
+            self._detachkeyspace()
+        else:
+            self._kv = {}
+            self._ttl = {}
+            self._expiryheap = []
+            self._index.clear()
         self._listlength = {}
+        self._touchall()
         return None
 
     def setlength(self, key, length):
@@ -415,73 +3272,228 @@ class Server(object):
         if length == 0:
             if key in self._listlength:
                 del self._listlength[key]
+            limit = None
+        else:
+            self._listlength[key] = length
+            limit = length
+
+        # Re-cap an existing list in one step; items past the limit go from the tail.
+        # A stream is left as it is: its next XADD trims it, as XADD MAXLEN ~ would.
+        values = self._kv.get(key)
+        if type(values) is list or (isinstance(values, ListValue) and values.maxlen != limit):
+            self._store(key, ListValue.capped(values, limit))
+
+    def bget(self, *args):
+        """Get key, or wait for it to be set and then take it (the key is deleted)."""
+        return self._blockingcommand('BGET', args)
+
+
+class Connection(object):
+    """One socket to the server, connected lazily and reconnected after a failure.
+
+    A connection is used by one caller at a time (the pool hands it out); its lock
+    covers the request/response round trip so ConnectionPool.disconnect() never
+    closes it in the middle of one.
+    """
+    def __init__(self, host, port, protocol, unixsocket=None):
+        self.host = host
+        self.port = port
+        self.unixsocket = unixsocket
+        self.lock = threading.Lock()
+        self.used = False   # True once a round trip completed on this socket.
+        self.tracking = None    # the client id this socket's CLIENT TRACKING redirects to.
+        self._protocol = protocol
+        self._socket = None
+        self._fh = None
+        self._reader = None
+
+    def connect(self):
+        if self._fh is None:
+            if self.unixsocket:
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    self._socket.connect(self.unixsocket)
+                except OSError:
+                    self._socket.close()
+                    raise
+            else:
+                self._socket = socket.create_connection((self.host, self.port))
+            self._fh = SocketWriter(self._socket, self._protocol)
+            self._reader = SocketReader(self._socket)
+            self.used = False
+
+    def disconnect(self):
+        sock = self._socket
+        self._fh = self._socket = self._reader = None
+        self.tracking = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def request(self, commands):
+        """Send all commands in one write, then read their replies in order."""
+        with self.lock:
+            self.connect()
+            # Encode the whole batch before sending any of it (so not through write(), which
+            # flushes at the highwater mark): if one argument cannot be encoded, nothing has
+            # gone out whose reply would be left on the socket for the next caller.
+            buf = self._fh.buffer
+            try:
+                for args in commands:
+                    self._protocol._write(buf, args)
+            except Exception:
+                buf.clear()
+                raise
+            try:
+                self._fh.flush()
+                replies = [self._protocol.handle_request(self._reader) for _ in commands]
+            except (OSError, Disconnect):
+                self.disconnect()
+                raise
+            self.used = True
+            return replies
+
+
+class ConnectionPool(object):
+    """A bounded pool of Connections shared by the threads using one Client.
+
+    Connections are created on demand up to max_connections; callers beyond that
+    wait for a checkin. Idle connections are reused LIFO so the hot ones stay warm.
+    """
+    def __init__(self, host='127.0.0.1', port=31337, max_connections=10, unixsocket=None):
+        self.host = host
+        self.port = port
+        self.unixsocket = unixsocket
+        self.max_connections = max_connections
+        self._protocol = ProtocolHandler()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []
+        self._created = 0
+
+    def _checkpid(self):
+        # A forked child must not share the parent's sockets; start a fresh pool.
+        if self.pid != os.getpid():
+            self._reset()
+
+    def get_connection(self):
+        self._checkpid()
+        with self._cond:
+            while not self._idle and self._created >= self.max_connections:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        return Connection(self.host, self.port, self._protocol, self.unixsocket)
+
+    def release(self, connection):
+        if self.pid != os.getpid():
             return
-        self._listlength[key] = length
+        with self._cond:
+            self._idle.append(connection)
+            self._cond.notify()
 
-    def bget(self, key, timeout=30):
-        if key in self._kv:
-            return self._kv[key]
-
-        waittogetvalue = threading.Event()
-        if key not in self._queue:
-            self._queue[key] = []
-        self._queue[key].append(waittogetvalue)
-
-        i = waittogetvalue.wait(timeout)
-        if waittogetvalue.is_set():
-            value = self._kv[key]
-            if value:
-                del self._kv[key]
-                return value
-            else:
-                logging.error(
-                    "brpop(). The logic here should be able to retrieve a value. might need an atomic execution around here.")
-                return None
-        else:
-            waittogetvalue.set()  # set it to abandon it, so the releaseblock() function will move on to next block in _queue
-            return None
+    def disconnect(self):
+        with self._cond:
+            idle = list(self._idle)
+        for connection in idle:
+            with connection.lock:
+                connection.disconnect()
 
 
 class Client(object):
-    def __init__(self, host='127.0.0.1', port=31337, poolnum=2):
-        self._protocol = ProtocolHandler()
-        self.lock = threading.RLock()
-        self._fh = []
-        for i in range(poolnum):
-            _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            _socket.connect((host, port))
-            self._fh.append(_socket.makefile('rwb'))
-        self.info = f"Connected to {host}:{port}"
+    def __init__(self, host='127.0.0.1', port=31337, poolnum=10, unixsocket=None, cache_size=0):
+        self._pool = ConnectionPool(host, port, poolnum, unixsocket)
+        self.info = f"Connected to {unixsocket or f'{host}:{port}'}"
+        # With cache_size, GET/MGET are answered from up to that many keys kept here,
+        # which the server invalidates as they change (see clientcache.py).
+        self.cache = None
+        if cache_size:
+            from clientcache import ClientCache
+            self.cache = ClientCache(self._pool, cache_size)
 
     def close(self):
-        pass
-        # self._socket.close()
+        if self.cache is not None:
+            self.cache.close()
+        self._pool.disconnect()
 
-    def execute(self, *args):
-        self.lock.acquire()
+    def _request(self, commands):
+        connection = self._pool.get_connection()
         try:
-            self._protocol.write_response(self._fh[0], args)
-            resp = self._protocol.handle_request(self._fh[0])
+            try:
+                replies = connection.request(commands)
+            except (OSError, Disconnect):
+                if not connection.used:
+                    raise
+                # A pooled socket the server already closed; retry once on a fresh one.
+                replies = connection.request(commands)
         finally:
-            self.lock.release()
+            self._pool.release(connection)
+        if self.cache is not None:
+            self.cache.written(commands)
+        return replies
+
+    def execute(self, *args):
+        resp = self._request([args])[0]
         if isinstance(resp, Error):
             raise CommandError(resp.message)
         return resp
 
+    def pipeline(self, transaction=False):
+        return Pipeline(self, transaction)
+
+    def transaction(self, func, *watches, retries=None):
+        """Run func(pipe) as a MULTI/EXEC transaction; returns the EXEC replies.
+
+        With watches, func can read them through pipe first (those commands run at
+        once), then calls pipe.multi() and queues its writes. If a watched key changes
+        before EXEC, nothing runs and func is called again, up to `retries` times.
+        """
+        attempts = 0
+        while True:
+            with self.pipeline(transaction=True) as pipe:
+                if watches:
+                    pipe.watch(*watches)
+                func(pipe)
+                try:
+                    return pipe.execute()
+                except WatchError:
+                    attempts += 1
+                    if retries is not None and attempts > retries:
+                        raise
+
     # Below are REDIS commands in client.
     def get(self, key):
+        if self.cache is not None:
+            return self.cache.get(key)
         return self.execute('GET', key)
 
-    def set(self, key, value):
+    def set(self, key, value, ex=None, px=None):
+        if ex is not None:
+            return self.execute('SET', key, value, 'EX', ex)
+        if px is not None:
+            return self.execute('SET', key, value, 'PX', px)
         return self.execute('SET', key, value)
 
     def delete(self, key):
         return self.execute('DELETE', key)
 
-    def flush(self):
+    def unlink(self, *keys):
+        return self.execute('UNLINK', *keys)
+
+    def flush(self, asynchronous=False):
+        if asynchronous:
+            return self.execute('FLUSH', 'ASYNC')
         return self.execute('FLUSH')
 
     def mget(self, *keys):
+        if self.cache is not None:
+            return self.cache.mget(keys)
         return self.execute('MGET', *keys)
 
     def mset(self, *items):
@@ -493,26 +3505,531 @@ class Client(object):
     def rpush(self, *items):
         return self.execute('RPUSH', *items)
 
-    def lpop(self, key):
+    def lpop(self, key, count=None):
+        if count is not None:
+            return self.execute('LPOP', key, count)
         return self.execute('LPOP', key)
 
-    def rpop(self, key):
+    def rpop(self, key, count=None):
+        if count is not None:
+            return self.execute('RPOP', key, count)
         return self.execute('RPOP', key)
 
+    def lmove(self, source, destination, wherefrom='LEFT', whereto='RIGHT'):
+        return self.execute('LMOVE', source, destination, wherefrom, whereto)
+
+    def blmove(self, source, destination, wherefrom='LEFT', whereto='RIGHT', timeout=0):
+        return self.execute('BLMOVE', source, destination, wherefrom, whereto, timeout)
+
+    def rpoplpush(self, source, destination):
+        return self.execute('RPOPLPUSH', source, destination)
+
+    def brpoplpush(self, source, destination, timeout=0):
+        return self.execute('BRPOPLPUSH', source, destination, timeout)
+
+    def lrange(self, key, start, stop):
+        return self.execute('LRANGE', key, start, stop)
+
+    def hset(self, key, *items):
+        return self.execute('HSET', key, *items)
+
+    def hget(self, key, field):
+        return self.execute('HGET', key, field)
+
+    def hdel(self, key, *fields):
+        return self.execute('HDEL', key, *fields)
+
+    def hlen(self, key):
+        return self.execute('HLEN', key)
+
+    def hincrby(self, key, field, increment=1):
+        return self.execute('HINCRBY', key, field, increment)
+
+    def hgetall(self, key):
+        return self.execute('HGETALL', key)
+
+    def sadd(self, key, *members):
+        return self.execute('SADD', key, *members)
+
+    def srem(self, key, *members):
+        return self.execute('SREM', key, *members)
+
+    def scard(self, key):
+        return self.execute('SCARD', key)
+
+    def sismember(self, key, member):
+        return self.execute('SISMEMBER', key, member)
+
+    def smembers(self, key):
+        return self.execute('SMEMBERS', key)
+
+    def sinter(self, *keys):
+        return self.execute('SINTER', *keys)
+
+    def zadd(self, key, *items):
+        """zadd(key, score, member, score, member, ...)"""
+        return self.execute('ZADD', key, *items)
+
+    def zrem(self, key, *members):
+        return self.execute('ZREM', key, *members)
+
+    def zcard(self, key):
+        return self.execute('ZCARD', key)
+
+    def zscore(self, key, member):
+        return self.execute('ZSCORE', key, member)
+
+    def zrank(self, key, member):
+        return self.execute('ZRANK', key, member)
+
+    def zrangebyscore(self, key, low, high, withscores=False, offset=None, count=None):
+        args = ['ZRANGEBYSCORE', key, low, high]
+        if withscores:
+            args.append('WITHSCORES')
+        if offset is not None or count is not None:
+            args += ['LIMIT', offset or 0, -1 if count is None else count]
+        return self.execute(*args)
+
+    def xadd(self, key, fields, id='*', maxlen=None, approximate=True, nomkstream=False):
+        """Append an entry (fields: a dict) to the stream at key; returns its ID."""
+        args = ['XADD', key]
+        if nomkstream:
+            args.append('NOMKSTREAM')
+        if maxlen is not None:
+            args += ['MAXLEN', '~' if approximate else '=', maxlen]
+        args.append(id)
+        for field, value in fields.items():
+            args += [field, value]
+        return self.execute(*args)
+
+    def xlen(self, key):
+        return self.execute('XLEN', key)
+
+    def xrange(self, key, start='-', end='+', count=None):
+        return self.execute('XRANGE', key, start, end, *(('COUNT', count) if count else ()))
+
+    def xrevrange(self, key, end='+', start='-', count=None):
+        return self.execute('XREVRANGE', key, end, start, *(('COUNT', count) if count else ()))
+
+    def xtrim(self, key, maxlen, approximate=True):
+        return self.execute('XTRIM', key, 'MAXLEN', '~' if approximate else '=', maxlen)
+
+    def _streamoptions(self, streams, count, block):
+        args = []
+        if count:
+            args += ['COUNT', count]
+        if block is not None:
+            args += ['BLOCK', block]
+        return args + ['STREAMS'] + list(streams) + list(streams.values())
+
+    def xread(self, streams, count=None, block=None):
+        """Entries after the ID given per key in streams ({key: id}; '$': only new ones),
+        waiting up to block ms (0: for ever) if there are none."""
+        return self.execute('XREAD', *self._streamoptions(streams, count, block))
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None, noack=False):
+        """Read as consumer of group: {key: '>'} for new entries, which stay pending
+        until xack(); {key: id} for its own pending entries after id."""
+        args = ['XREADGROUP', 'GROUP', group, consumer] + (['NOACK'] if noack else [])
+        return self.execute(*args, *self._streamoptions(streams, count, block))
+
+    def xack(self, key, group, *ids):
+        return self.execute('XACK', key, group, *ids)
+
+    def xclaim(self, key, group, consumer, min_idle_time, ids, justid=False):
+        return self.execute('XCLAIM', key, group, consumer, min_idle_time, *ids, *(('JUSTID',) if justid else ()))
+
+    def xpending(self, key, group, start=None, end=None, count=None, consumer=None):
+        """The summary of group's pending entries; with start, end and count, the entries."""
+        if count is None:
+            return self.execute('XPENDING', key, group)
+        args = ['XPENDING', key, group, start or '-', end or '+', count]
+        if consumer is not None:
+            args.append(consumer)
+        return self.execute(*args)
+
+    def xgroup_create(self, key, group, id='$', mkstream=False):
+        return self.execute('XGROUP', 'CREATE', key, group, id, *(('MKSTREAM',) if mkstream else ()))
+
+    def xgroup_setid(self, key, group, id):
+        return self.execute('XGROUP', 'SETID', key, group, id)
+
+    def xgroup_destroy(self, key, group):
+        return self.execute('XGROUP', 'DESTROY', key, group)
+
+    def xgroup_createconsumer(self, key, group, consumer):
+        return self.execute('XGROUP', 'CREATECONSUMER', key, group, consumer)
+
+    def xgroup_delconsumer(self, key, group, consumer):
+        return self.execute('XGROUP', 'DELCONSUMER', key, group, consumer)
+
+    def xinfo_stream(self, key):
+        return self.execute('XINFO', 'STREAM', key)
+
+    def xinfo_groups(self, key):
+        return self.execute('XINFO', 'GROUPS', key)
+
+    def xinfo_consumers(self, key, group):
+        return self.execute('XINFO', 'CONSUMERS', key, group)
+
+    def pfadd(self, key, *elements):
+        return self.execute('PFADD', key, *elements)
+
+    def pfcount(self, *keys):
+        return self.execute('PFCOUNT', *keys)
+
+    def pfmerge(self, destination, *sources):
+        return self.execute('PFMERGE', destination, *sources)
+
+    def bf_reserve(self, key, error_rate, capacity):
+        return self.execute('BF.RESERVE', key, error_rate, capacity)
+
+    def bf_add(self, key, item):
+        return self.execute('BF.ADD', key, item)
+
+    def bf_madd(self, key, *items):
+        return self.execute('BF.MADD', key, *items)
+
+    def bf_exists(self, key, item):
+        return self.execute('BF.EXISTS', key, item)
+
+    def bf_mexists(self, key, *items):
+        return self.execute('BF.MEXISTS', key, *items)
+
+    def bf_card(self, key):
+        return self.execute('BF.CARD', key)
+
+    def bf_info(self, key):
+        return self.execute('BF.INFO', key)
+
+    def ltrim(self, key, start, stop):
+        return self.execute('LTRIM', key, start, stop)
+
+    def lrem(self, key, count, value):
+        return self.execute('LREM', key, count, value)
+
     def llen(self, key):
         return self.execute('LLEN', key)
 
-    def blpop(self, key):
-        return self.execute('BLPOP', key)
+    def _blocking(self, command, keys, timeout):
+        if timeout is None and len(keys) == 1:
+            return self.execute(command, *keys)     # the server's default timeout.
+        return self.execute(command, *keys, timeout or 0)
+
+    def blpop(self, *keys, timeout=None):
+        """Pop from the first non-empty list, waiting up to timeout seconds (0: for ever).
+
+        With one key the reply is the value; with several it is [key, value].
+        """
+        return self._blocking('BLPOP', keys, timeout)
 
-    def brpop(self, key):
-        return self.execute('BRPOP', key)
+    def brpop(self, *keys, timeout=None):
+        return self._blocking('BRPOP', keys, timeout)
 
-    def bget(self, key):
-        return self.execute('BGET', key)
+    def bget(self, key, timeout=None):
+        return self._blocking('BGET', (key,), timeout)
 
     def setlength(self, key, length):
         return self.execute('SETLENGTH', key, length)
 
-    def flushall(self):
+    def expire(self, key, seconds):
+        return self.execute('EXPIRE', key, seconds)
+
+    def pexpire(self, key, milliseconds):
+        return self.execute('PEXPIRE', key, milliseconds)
+
+    def ttl(self, key):
+        return self.execute('TTL', key)
+
+    def pttl(self, key):
+        return self.execute('PTTL', key)
+
+    def persist(self, key):
+        return self.execute('PERSIST', key)
+
+    def flushall(self, asynchronous=False):
+        if asynchronous:
+            return self.execute('FLUSHALL', 'ASYNC')
         return self.execute('FLUSHALL')
+
+    def fcall(self, name, numkeys, *keysandargs):
+        return self.execute('FCALL', name, numkeys, *keysandargs)
+
+    def evalsha(self, digest, numkeys, *keysandargs):
+        return self.execute('EVALSHA', digest, numkeys, *keysandargs)
+
+    def scan(self, cursor=0, match=None, count=None, _type=None):
+        """One SCAN step: [next cursor, keys]; the scan is complete when the cursor is 0."""
+        args = ['SCAN', cursor]
+        if match is not None:
+            args += ['MATCH', match]
+        if count is not None:
+            args += ['COUNT', count]
+        if _type is not None:
+            args += ['TYPE', _type]
+        return self.execute(*args)
+
+    def scan_iter(self, match=None, count=None, _type=None):
+        """Every key, a SCAN step at a time; a key may come up more than once."""
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match, count, _type)
+            yield from keys
+
+    def keys(self, pattern='*'):
+        return self.execute('KEYS', pattern)
+
+    def type(self, key):
+        return self.execute('TYPE', key)
+
+    def memory_usage(self, key):
+        return self.execute('MEMORY', 'USAGE', key)
+
+    def replicaof(self, host=None, port=None):
+        """Make the server a replica of host:port; with no arguments, a primary again."""
+        if host is None:
+            return self.execute('REPLICAOF', 'NO', 'ONE')
+        return self.execute('REPLICAOF', host, port)
+
+    def slowlog_get(self, num=None):
+        """The newest SLOWLOG entries: [id, unix time, microseconds, arguments]."""
+        return self.execute('SLOWLOG', 'GET', *([] if num is None else [num]))
+
+    def slowlog_len(self):
+        return self.execute('SLOWLOG', 'LEN')
+
+    def slowlog_reset(self):
+        return self.execute('SLOWLOG', 'RESET')
+
+    def latency_latest(self):
+        return self.execute('LATENCY', 'LATEST')
+
+    def latency_history(self, event):
+        return self.execute('LATENCY', 'HISTORY', event)
+
+    def latency_reset(self, *events):
+        return self.execute('LATENCY', 'RESET', *events)
+
+    def latency_histogram(self, *commands):
+        """{command: {'calls', 'p50', 'p99', 'p999'}}, the percentiles in microseconds."""
+        return self.execute('LATENCY', 'HISTOGRAM', *commands)
+
+    def function_list(self):
+        return self.execute('FUNCTION', 'LIST')
+
+    def publish(self, channel, message):
+        return self.execute('PUBLISH', channel, message)
+
+    def pubsub(self):
+        return PubSub(self)
+
+    def pubsub_channels(self, pattern=None):
+        return self.execute('PUBSUB', 'CHANNELS', *([] if pattern is None else [pattern]))
+
+    def pubsub_numsub(self, *channels):
+        return self.execute('PUBSUB', 'NUMSUB', *channels)
+
+    def pubsub_numpat(self):
+        return self.execute('PUBSUB', 'NUMPAT')
+
+    def ping(self):
+        return self.execute('PING')
+
+
+class Pipeline(Client):
+    """Queue commands client-side and send them in a single write.
+
+    Every command method returns the pipeline, so calls can be chained; execute()
+    with no arguments sends the batch and returns the replies in order:
+
+        replies = client.pipeline().set('a', 1).get('a').execute()
+
+    With transaction=True the batch is wrapped in MULTI/EXEC and runs atomically, in
+    the same single round trip. watch() pins a connection and WATCHes keys; until
+    multi() is called, commands then run immediately, so the transaction can be built
+    from what they read:
+
+        with client.pipeline(transaction=True) as pipe:
+            pipe.watch('balance')
+            balance = pipe.get('balance')
+            pipe.multi()
+            pipe.set('balance', balance - 10)
+            pipe.execute()      # WatchError if balance changed after WATCH.
+    """
+    def __init__(self, client, transaction=False):
+        self._pool = client._pool
+        self.info = client.info
+        self.cache = client.cache   # only told about writes: reads are queued, never cached.
+        self.transaction = transaction
+        self._commands = []
+        self._connection = None     # pinned by watch() until execute() or reset().
+        self._immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def reset(self):
+        """Drop queued commands, and any WATCH with the connection it pinned."""
+        self._commands = []
+        self._immediate = False
+        self._release(unwatch=True)
+
+    def _release(self, unwatch=False):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if unwatch:
+            try:
+                connection.request([('UNWATCH',)])
+            except (OSError, Disconnect, CommandError):
+                connection.disconnect()
+        self._pool.release(connection)
+
+    def watch(self, *keys):
+        if self._commands:
+            raise CommandError('WATCH after commands were queued; call it first')
+        if self._connection is None:
+            self._connection = self._pool.get_connection()
+        self._immediate = True
+        return Client.execute(self, 'WATCH', *keys)
+
+    def multi(self):
+        """Start queuing: commands from here on are sent at execute()."""
+        self._immediate = False
+        self.transaction = True
+        return self
+
+    def _request(self, commands):
+        if self._connection is None:
+            return super(Pipeline, self)._request(commands)
+        replies = self._connection.request(commands)
+        if self.cache is not None:
+            self.cache.written(commands)
+        return replies
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def mget(self, *keys):
+        return self.execute('MGET', *keys)
+
+    def execute(self, *args, raise_on_error=True):
+        if args:
+            if self._immediate:
+                return Client.execute(self, *args)
+            self._commands.append(args)
+            return self
+
+        commands, self._commands = self._commands, []
+        if self.transaction:
+            try:
+                replies = self._request([('MULTI',)] + commands + [('EXEC',)])
+            finally:
+                self._release()     # EXEC, or the failure, ended any WATCH.
+            for resp in replies[1:-1]:
+                if isinstance(resp, Error):     # refused while queuing: EXEC ran nothing.
+                    raise CommandError(resp.message)
+            replies = replies[-1]
+            if isinstance(replies, Error):
+                raise CommandError(replies.message)
+            if replies is None:
+                raise WatchError('Watched key changed; transaction not executed')
+        elif not commands:
+            return []
+        else:
+            replies = self._request(commands)
+        if raise_on_error:
+            for resp in replies:
+                if isinstance(resp, Error):
+                    raise CommandError(resp.message)
+        return [CommandError(resp.message) if isinstance(resp, Error) else resp for resp in replies]
+
+
+class PubSub(object):
+    """A connection in subscriber mode, from Client.pubsub().
+
+    It has a socket of its own, outside the pool, since the server pushes to it once
+    subscribed. get_message() returns what arrives as a dict, like redis-py's:
+    {'type': 'message', 'pattern': None, 'channel': 'news', 'data': ...}. The replies
+    to (P)(UN)SUBSCRIBE come the same way, with the subscription count as data.
+
+        with client.pubsub() as p:
+            p.subscribe('news')
+            for message in p.listen():
+                ...
+    """
+    def __init__(self, client):
+        pool = client._pool
+        self._protocol = pool._protocol
+        self._connection = Connection(pool.host, pool.port, pool._protocol, pool.unixsocket)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._connection.disconnect()
+
+    def execute(self, *args):
+        """Send a command; its replies arrive through get_message()."""
+        connection = self._connection
+        connection.connect()
+        try:
+            self._protocol.write_response(connection._fh, args)
+        except OSError:
+            connection.disconnect()
+            raise
+
+    def subscribe(self, *channels):
+        self.execute('SUBSCRIBE', *channels)
+
+    def psubscribe(self, *patterns):
+        self.execute('PSUBSCRIBE', *patterns)
+
+    def unsubscribe(self, *channels):
+        self.execute('UNSUBSCRIBE', *channels)
+
+    def punsubscribe(self, *patterns):
+        self.execute('PUNSUBSCRIBE', *patterns)
+
+    def ping(self):
+        self.execute('PING')
+
+    def get_message(self, timeout=None):
+        """The next message, or None if none arrives within timeout seconds (None: wait)."""
+        connection = self._connection
+        connection.connect()
+        sock = connection._socket
+        sock.settimeout(timeout)
+        try:
+            frame = connection._reader.read_frame()
+        except socket.timeout:
+            return None
+        except (OSError, Disconnect):
+            connection.disconnect()
+            raise
+        sock.settimeout(None)
+        return self.message(frame)
+
+    def listen(self):
+        while True:
+            yield self.get_message()
+
+    @staticmethod
+    def message(frame):
+        """A pushed frame as a message dict."""
+        if isinstance(frame, Error):
+            raise CommandError(frame.message)
+        if isinstance(frame, list) and len(frame) == 4 and frame[0] == 'pmessage':
+            return {'type': 'pmessage', 'pattern': frame[1], 'channel': frame[2], 'data': frame[3]}
+        if isinstance(frame, list) and len(frame) == 3:
+            return {'type': frame[0], 'pattern': None, 'channel': frame[1], 'data': frame[2]}
+        return {'type': 'pong', 'pattern': None, 'channel': None, 'data': frame}
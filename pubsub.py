@@ -0,0 +1,137 @@
+"""
+Pub/Sub bookkeeping: who is subscribed to what, and which patterns match a channel.
+
+Server.publish() encodes a message once and hands the same bytes object to every
+receiver's Subscriber.push(); each network backend queues it for its socket as is.
+Patterns use Redis' glob syntax (* ? [abc] [^abc] [a-z] and \\ escapes).
+"""
+import re
+
+
+def channelname(name):
+    """Channels and patterns are compared as str, whatever type the client sent."""
+    if isinstance(name, str):
+        return name
+    if isinstance(name, (bytes, bytearray)):
+        return bytes(name).decode('utf-8', 'surrogateescape')
+    return str(name)
+
+
+def globregex(pattern):
+    """Compile a Redis glob pattern to a regex matching whole names (channels, or keys for SCAN)."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '\\' and i < n:
+            out.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i)
+            if end < 0:
+                out.append(re.escape(c))
+                continue
+            body, i = pattern[i:end], end + 1
+            negate = body.startswith('^')
+            if negate:
+                body = body[1:]
+            if not body:
+                out.append('[^\\s\\S]' if not negate else '[\\s\\S]')
+                continue
+            body = ''.join('-' if ch == '-' else re.escape(ch) for ch in body)
+            out.append(f"[{'^' if negate else ''}{body}]")
+        else:
+            out.append(re.escape(c))
+    return re.compile(''.join(out) + r'\Z', re.S)
+
+
+def literalprefix(pattern):
+    """The text every channel the pattern matches starts with."""
+    for i, c in enumerate(pattern):
+        if c in '*?[\\':
+            return pattern[:i]
+    return pattern
+
+
+class Subscriber(object):
+    """A connection's subscriptions; push(data) sends it pre-encoded bytes.
+
+    id is its CLIENT ID once asked for, redirect the client id its CLIENT TRACKING
+    invalidations go to (None: not tracking).
+    """
+    __slots__ = ('channels', 'patterns', 'push', 'id', 'redirect')
+
+    def __init__(self, push):
+        self.channels = set()
+        self.patterns = set()
+        self.push = push
+        self.id = None
+        self.redirect = None
+
+    def __len__(self):
+        return len(self.channels) + len(self.patterns)
+
+
+class PatternIndex(object):
+    """Subscribed patterns, bucketed by their literal prefix.
+
+    A pattern can only match channels starting with the text before its first
+    wildcard, so a publish looks up the channel's prefixes of the lengths in use
+    (one dict hit each) and runs only the regexes found there, not every pattern.
+    """
+    def __init__(self):
+        self._byprefix = {}     # prefix -> {pattern: [regex, set of Subscribers]}
+        self._lengths = {}      # prefix length -> number of prefixes of that length
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, subscriber):
+        prefix = literalprefix(pattern)
+        bucket = self._byprefix.get(prefix)
+        if bucket is None:
+            bucket = self._byprefix[prefix] = {}
+            self._lengths[len(prefix)] = self._lengths.get(len(prefix), 0) + 1
+        entry = bucket.get(pattern)
+        if entry is None:
+            entry = bucket[pattern] = [globregex(pattern), set()]
+            self._count += 1
+        entry[1].add(subscriber)
+
+    def remove(self, pattern, subscriber):
+        prefix = literalprefix(pattern)
+        bucket = self._byprefix.get(prefix)
+        entry = bucket.get(pattern) if bucket else None
+        if entry is None:
+            return
+        entry[1].discard(subscriber)
+        if entry[1]:
+            return
+        del bucket[pattern]
+        self._count -= 1
+        if not bucket:
+            del self._byprefix[prefix]
+            self._lengths[len(prefix)] -= 1
+            if not self._lengths[len(prefix)]:
+                del self._lengths[len(prefix)]
+
+    def match(self, channel):
+        """(pattern, subscribers) for every pattern matching channel."""
+        byprefix = self._byprefix
+        for length in self._lengths:
+            if length > len(channel):
+                continue
+            bucket = byprefix.get(channel[:length])
+            if bucket:
+                for pattern, (regex, subscribers) in bucket.items():
+                    if regex.match(channel):
+                        yield pattern, subscribers
+
+    def patterns(self):
+        return [pattern for bucket in self._byprefix.values() for pattern in bucket]
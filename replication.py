@@ -0,0 +1,216 @@
+"""
+Primary/replica replication.
+
+A replica connects to its primary and sends PSYNC with the replication id and
+offset it has. The primary answers one of two ways:
+
+    ['CONTINUE', replid]                    then the stream from that offset on, or
+    ['FULLRESYNC', replid, offset, snapshot]  then the stream from offset on.
+
+The snapshot is the SAVE file format (persistence.dump_snapshot), written by a
+forked child so the primary keeps serving meanwhile. The stream is the write
+commands as they go to the append-only file, in the same wire encoding. The offset
+counts the bytes of that stream, on the primary and on every replica alike.
+
+The primary keeps the last repl_backlog_size bytes of the stream in a
+ReplicationBacklog. A replica that was briefly disconnected resumes from its
+offset with PSYNC instead of reloading everything. That works as long as the
+primary still has the bytes it missed.
+"""
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from protocol import ProtocolHandler, RespParser, NEED_MORE, CommandError, Error, Disconnect
+
+
+def _replid():
+    return os.urandom(20).hex()
+
+
+class ReplicationBacklog(object):
+    """The tail of the replication stream, and the replicas it is sent to.
+
+    replicas maps each replica connection's Subscriber to None once it is online,
+    or to the list of stream chunks held back while its full sync is running.
+    """
+    def __init__(self, size, replid=None, offset=0, limit=256 * 1024 * 1024):
+        self.size = size
+        self.replid = replid or _replid()
+        self.offset = offset        # bytes of stream ever produced under this history.
+        self.replid2 = None         # the previous history, kept across a promotion.
+        self.offset2 = -1
+        self.limit = limit          # bytes a replica may fall behind before it is dropped.
+        self.replicas = {}
+        self._protocol = ProtocolHandler()
+        self._buf = bytearray()
+        self._start = offset        # stream offset of _buf[0].
+
+    def append(self, args):
+        buf = bytearray()
+        self._protocol._write(buf, args)
+        data = bytes(buf)
+        self._buf += data
+        self.offset += len(data)
+        if len(self._buf) > 2 * self.size:     # trim in bulk, not on every append.
+            del self._buf[:len(self._buf) - self.size]
+            self._start = self.offset - len(self._buf)
+        for subscriber, pending in self.replicas.items():
+            if pending is None:
+                subscriber.push(data, self.limit)
+            else:
+                pending.append(data)
+
+    def since(self, replid, offset):
+        """The stream from offset on, or None if it isn't (or no longer) in the backlog."""
+        if replid != self.replid and (replid != self.replid2 or offset > self.offset2):
+            return None
+        if not self._start <= offset <= self.offset:
+            return None
+        return bytes(self._buf[offset - self._start:])
+
+    def newhistory(self, replid=None):
+        """Start a new replication id; replicas that followed the old one can still resume."""
+        self.replid2, self.offset2 = self.replid, self.offset
+        self.replid = replid or _replid()
+
+    def __len__(self):
+        return len(self._buf)
+
+
+class PrimaryLink(object):
+    """A replica's connection to its primary: sync, then apply the stream, reconnecting as needed.
+
+    It runs in its own thread (a greenlet under gevent). Parsed commands are handed to
+    the server with server._callsoon(), so they are applied where every other command
+    runs. A transaction in the stream is handed over whole, once its EXEC has arrived.
+    """
+    RETRY = 1.0     # seconds between connection attempts.
+
+    def __init__(self, server, host, port):
+        self.server = server
+        self.host = host
+        self.port = int(port)
+        self.status = 'connect'     # connect, sync or up; as Redis' master_link_status.
+        self.replid = None
+        self.offset = -1
+        self.lastio = time.time()
+        self._protocol = ProtocolHandler()
+        self._sock = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            backlog = self.server._backlog
+            if backlog is not None:     # what we have already: a partial resync may do.
+                self.replid, self.offset = backlog.replid, backlog.offset
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self._sync()
+            except (OSError, Disconnect, CommandError, ValueError) as err:
+                if not self._stopped:
+                    logging.warning(f"Replication from {self.host}:{self.port}: {err}")
+            finally:
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                self.status = 'connect'
+            if not self._stopped:
+                time.sleep(self.RETRY)
+
+    def _sync(self):
+        self._sock = sock = socket.create_connection((self.host, self.port))
+        if self._stopped:
+            return
+        buf = bytearray()
+        self._protocol._write(buf, ['PSYNC', self.replid or '?', self.offset])
+        sock.sendall(buf)
+        self.status = 'sync'
+        parser = RespParser()
+        reply = self._read(sock, parser)
+        if type(reply) is Error:
+            raise CommandError(reply.message)
+        if reply[0] == 'FULLRESYNC':
+            _, replid, offset, snapshot = reply
+            kv, ttl, listlength = self._loadsnapshot(snapshot)
+            self.replid, self.offset = replid, offset
+            self.server._callsoon(self.server._replicasynced, self, kv, ttl, listlength, replid, offset)
+            logging.warning(f"Full sync from {self.host}:{self.port}: {len(kv)} keys at offset {offset}")
+        elif reply[0] == 'CONTINUE':
+            self.replid = reply[1]
+            self.server._callsoon(self.server._replicacontinued, self, self.replid)
+            logging.warning(f"Partial resync from {self.host}:{self.port} at offset {self.offset}")
+        else:
+            raise CommandError(f"unexpected PSYNC reply {reply[0]!r}")
+        self.status = 'up'
+        self._stream(sock, parser)
+
+    def _read(self, sock, parser):
+        while True:
+            frame = parser.gets()
+            if frame is not NEED_MORE:
+                return frame
+            self._recv(sock, parser)
+
+    def _recv(self, sock, parser):
+        data = sock.recv(1 << 16)
+        if not data:
+            raise Disconnect('the primary closed the connection')
+        parser.feed(data)
+        self.lastio = time.time()
+        return len(data)
+
+    def _loadsnapshot(self, snapshot):
+        from persistence import load_snapshot
+        fd, filename = tempfile.mkstemp(prefix='miniredis-replica-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(snapshot)
+            return load_snapshot(filename)
+        finally:
+            os.remove(filename)
+
+    def _stream(self, sock, parser):
+        fed = parser.buffered()     # bytes of stream fed to the parser so far.
+        transaction = None
+        while True:
+            frames = []
+            while True:
+                frame = parser.gets()
+                if frame is NEED_MORE:
+                    break
+                if type(frame) is Error:    # the primary dropped us, e.g. it became a replica.
+                    raise CommandError(frame.message)
+                if frame == ['MULTI']:
+                    transaction = [frame]
+                elif transaction is not None:
+                    transaction.append(frame)
+                    if frame == ['EXEC']:
+                        frames += transaction
+                        transaction = None
+                else:
+                    frames.append(frame)
+                if transaction is None:
+                    # Only whole commands and transactions count: the offset is where a resync resumes.
+                    self.offset += fed - parser.buffered()
+                    fed = parser.buffered()
+            if frames:
+                self.server._callsoon(self.server._applyreplicated, self, frames)
+            fed += self._recv(sock, parser)
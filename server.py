@@ -1,4 +1,5 @@
 from protocol import Server
+import argparse
 import logging
 from gevent import monkey
 
@@ -7,8 +8,59 @@ from gevent import monkey
 if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
 
-    monkey.patch_all()
-    s = Server()    # can be Server("0.0.0.0", 34567)
-    print(s.help())
-    s.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=31337)
+    parser.add_argument("--appendonly", help="append-only file to log writes to and load at startup")
+    parser.add_argument("--appendfsync", choices=('always', 'everysec', 'no'), default='everysec')
+    parser.add_argument("--dbfilename", default='dump.mrdb', help="snapshot file for SAVE/BGSAVE, loaded at startup")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, each owning a slice of the keyspace")
+    parser.add_argument("--maxmemory", type=int, default=0, help="bytes of data to keep before evicting; 0 is unlimited")
+    parser.add_argument("--maxmemory-policy", default='noeviction', choices=Server.MAXMEMORY_POLICIES)
+    parser.add_argument("--backend", default='gevent', choices=('gevent', 'asyncio'),
+                        help="asyncio uses uvloop when it is installed; no monkey patching")
+    parser.add_argument("--pubsub-buffer-limit", type=int, default=32 * 1024 * 1024,
+                        help="bytes a subscriber may fall behind before it is disconnected")
+    parser.add_argument("--functions", help="module (file.py or dotted name) whose functions FCALL/EVALSHA run")
+    parser.add_argument("--slowlog-log-slower-than", type=int, default=10000,
+                        help="microseconds a command must take to enter SLOWLOG; negative disables it")
+    parser.add_argument("--slowlog-max-len", type=int, default=128)
+    parser.add_argument("--latency-monitor-threshold", type=int, default=100,
+                        help="milliseconds of an event worth LATENCY LATEST/HISTORY; 0 disables it")
+    parser.add_argument("--no-latency-tracking", dest='latency_tracking', action='store_false',
+                        help="don't time commands (no histograms, commandstats or SLOWLOG)")
+    parser.add_argument("--replicaof", metavar="HOST:PORT", help="start as a read-only replica of this primary")
+    parser.add_argument("--repl-backlog-size", type=int, default=Server.REPL_BACKLOG_SIZE,
+                        help="bytes of recent writes kept so a reconnecting replica can resume")
+    args = parser.parse_args()
+
+    if args.backend == 'gevent':
+        monkey.patch_all()
+    replicaof = None
+    if args.replicaof:
+        if args.workers > 1:
+            parser.error("--replicaof needs a single worker")
+        host, _, port = args.replicaof.rpartition(':')
+        replicaof = (host or '127.0.0.1', int(port))
+    options = dict(appendonly=args.appendonly, appendfsync=args.appendfsync, dbfilename=args.dbfilename,
+                   maxmemory=args.maxmemory, maxmemory_policy=args.maxmemory_policy,
+                   functions=args.functions, pubsub_buffer_limit=args.pubsub_buffer_limit,
+                   latency_tracking=args.latency_tracking, slowlog_log_slower_than=args.slowlog_log_slower_than,
+                   slowlog_max_len=args.slowlog_max_len, latency_monitor_threshold=args.latency_monitor_threshold,
+                   replicaof=replicaof, repl_backlog_size=args.repl_backlog_size)
+    if args.backend == 'asyncio':
+        if args.workers > 1:
+            parser.error("--workers needs the gevent backend")
+        from aioprotocol import AsyncServer
+        s = AsyncServer(args.host, args.port, **options)
+        print(s.help())
+        s.run()
+    elif args.workers > 1:
+        from cluster import run_workers
+        print(f"Starting {args.workers} workers on {args.host}:{args.port}")
+        run_workers(args.workers, args.host, args.port, **options)
+    else:
+        s = Server(args.host, args.port, **options)
+        print(s.help())
+        s.run()
     print("End Server")
@@ -0,0 +1,421 @@
+"""
+Streams: append-only logs of field/value entries, read by ID range or through consumer groups.
+
+Every entry has an ID, ms-seq, greater than all IDs before it. Entries are kept the way
+Redis keeps them in listpacks: in chunks of up to STREAM_NODE_MAX_ENTRIES, each with its
+IDs in two uint64 arrays and its entries marshalled back to back in one bytearray, found
+through an array of offsets. An entry costs 20 bytes of ID and offset plus its encoded
+fields and values; there is no Python object for it until it is read. The first entry
+of a chunk sets the chunk's master fields, and later entries with the same field names
+only store their values.
+
+Finding an ID is a bisect over the chunks' first IDs, then over the IDs of one chunk, so
+reading a batch of n entries from anywhere in the stream costs O(log N + n). Trimming
+drops whole chunks from the head; an exact MAXLEN also skips entries at the start of the
+first chunk, which stay allocated until the rest of their chunk goes.
+
+Internally an ID is one int, ms << 64 | seq, so IDs compare and hash as ints.
+
+A ConsumerGroup keeps the last ID it delivered and its pending entries list (PEL): the
+entries delivered but not acknowledged yet, each with its consumer, when it was last
+delivered and how many times. Each Consumer keeps the IDs of its own pending entries.
+Only pending entries cost Python objects, as in Redis only they cost a rax node.
+"""
+import marshal
+from array import array
+from bisect import bisect_right
+
+
+STREAM_NODE_MAX_ENTRIES = 100
+STREAM_NODE_MAX_BYTES = 4096
+# Rough bytes, for memory accounting: an entry's ID and offset, a chunk's arrays, and
+# a pending entry in the group's and its consumer's PEL.
+ENTRY_OVERHEAD = 20
+CHUNK_OVERHEAD = 330
+PENDING_OVERHEAD = 200
+CONSUMER_OVERHEAD = 300
+
+_SEQMASK = (1 << 64) - 1
+MINID, MAXID = 0, (1 << 128) - 1
+
+
+def formatid(sid):
+    return f"{sid >> 64}-{sid & _SEQMASK}"
+
+
+def parseid(value, seq=0):
+    """ms-seq, or ms alone (taking seq as its sequence), as an ID; ValueError if it is neither."""
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value).decode('ascii', 'replace')
+    ms, sep, rest = str(value).partition('-')
+    ms = int(ms)
+    if sep:
+        seq = int(rest)
+    if not (0 <= ms <= _SEQMASK and 0 <= seq <= _SEQMASK):
+        raise ValueError(f'invalid stream ID {value!r}')
+    return ms << 64 | seq
+
+
+def nextid(lastid, ms):
+    """The ID XADD * gives an entry added at ms, after lastid."""
+    if ms > lastid >> 64:
+        return ms << 64
+    if lastid & _SEQMASK == _SEQMASK:
+        return ((lastid >> 64) + 1) << 64
+    return lastid + 1
+
+
+class _Chunk(object):
+    """Up to STREAM_NODE_MAX_ENTRIES consecutive entries; those before start were trimmed."""
+    __slots__ = ('ms', 'seq', 'offsets', 'data', 'fields', 'start')
+
+    def __init__(self, fields):
+        self.ms = array('Q')
+        self.seq = array('Q')
+        self.offsets = array('I')
+        self.data = bytearray()
+        self.fields = fields    # the master fields.
+        self.start = 0
+
+    def __len__(self):
+        return len(self.ms) - self.start
+
+    def nbytes(self):
+        return len(self.data) + ENTRY_OVERHEAD * len(self.ms) + CHUNK_OVERHEAD
+
+    def id(self, i):
+        return self.ms[i] << 64 | self.seq[i]
+
+    def find(self, sid):
+        """The index of the first live entry with an ID >= sid (len(self.ms) if none)."""
+        ms, seq = sid >> 64, sid & _SEQMASK
+        mss, seqs = self.ms, self.seq
+        lo, hi = self.start, len(mss)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            m = mss[mid]
+            if m < ms or (m == ms and seqs[mid] < seq):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def push(self, sid, blob):
+        self.ms.append(sid >> 64)
+        self.seq.append(sid & _SEQMASK)
+        self.offsets.append(len(self.data))
+        self.data += blob
+
+    def entry(self, i):
+        """Entry i as it is replied: [ID, [field, value, ...]]."""
+        offsets = self.offsets
+        end = offsets[i + 1] if i + 1 < len(offsets) else len(self.data)
+        item = marshal.loads(self.data[offsets[i]:end])
+        if type(item) is list:
+            fields, values = item
+        else:
+            fields, values = self.fields, item
+        flat = [None] * (2 * len(values))
+        flat[::2] = fields
+        flat[1::2] = values
+        return [formatid(self.id(i)), flat]
+
+
+class StreamValue(object):
+    """A stream: its entries, the last ID it gave out, and its consumer groups by name."""
+    __slots__ = ('_chunks', '_firsts', '_length', '_bytes', 'lastid', 'groups')
+
+    def __init__(self):
+        self._chunks = []
+        self._firsts = []   # the ID of each chunk's first live entry, for bisect.
+        self._length = 0
+        self._bytes = 0
+        self.lastid = MINID
+        self.groups = {}
+
+    encoding = 'stream'
+
+    def __len__(self):
+        return self._length
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + self._bytes
+        for group in self.groups.values():
+            size += group.__sizeof__()
+        return size
+
+    def add(self, sid, flat):
+        """Append an entry with ID sid (greater than lastid) and [field, value, ...] flat."""
+        fields, values = tuple(flat[::2]), tuple(flat[1::2])
+        chunks = self._chunks
+        chunk = chunks[-1] if chunks else None
+        new = (chunk is None or len(chunk.ms) >= STREAM_NODE_MAX_ENTRIES
+               or len(chunk.data) >= STREAM_NODE_MAX_BYTES)
+        # Encoded first: a value marshal can't take (ValueError) leaves the stream as it was.
+        blob = marshal.dumps(values if new or fields == chunk.fields else [fields, values])
+        if new:
+            chunk = _Chunk(fields)
+            chunks.append(chunk)
+            self._firsts.append(sid)
+            self._bytes += CHUNK_OVERHEAD
+        chunk.push(sid, blob)
+        self._bytes += len(blob) + ENTRY_OVERHEAD
+        self._length += 1
+        self.lastid = sid
+
+    def trim(self, maxlen, approximate=False):
+        """Drop entries from the head down to maxlen; approximately: whole chunks only. Returns how many."""
+        chunks = self._chunks
+        removed = 0
+        while chunks and self._length - len(chunks[0]) >= maxlen:
+            chunk = chunks.pop(0)
+            del self._firsts[0]
+            removed += len(chunk)
+            self._length -= len(chunk)
+            self._bytes -= chunk.nbytes()
+        if not approximate and self._length > maxlen:
+            chunk = chunks[0]
+            n = self._length - maxlen
+            chunk.start += n
+            self._firsts[0] = chunk.id(chunk.start)
+            self._length -= n
+            removed += n
+        return removed
+
+    def range(self, start, end, count=None, ids=None):
+        """Entries with start <= ID <= end, in order, at most count; their IDs go to ids too."""
+        out = []
+        if start > end:
+            return out
+        chunks = self._chunks
+        i = max(bisect_right(self._firsts, start) - 1, 0)
+        while i < len(chunks):
+            chunk = chunks[i]
+            mss, seqs = chunk.ms, chunk.seq
+            for j in range(chunk.find(start), len(mss)):
+                sid = mss[j] << 64 | seqs[j]
+                if sid > end:
+                    return out
+                out.append(chunk.entry(j))
+                if ids is not None:
+                    ids.append(sid)
+                if len(out) == count:
+                    return out
+            i += 1
+        return out
+
+    def revrange(self, end, start, count=None):
+        """Entries with end >= ID >= start, newest first, at most count."""
+        out = []
+        if start > end:
+            return out
+        chunks = self._chunks
+        i = bisect_right(self._firsts, end) - 1
+        while i >= 0:
+            chunk = chunks[i]
+            j = chunk.find(end + 1) - 1
+            while j >= chunk.start:
+                if chunk.id(j) < start:
+                    return out
+                out.append(chunk.entry(j))
+                if len(out) == count:
+                    return out
+                j -= 1
+            i -= 1
+        return out
+
+    def get(self, sid):
+        """The entry with ID sid, or None if there is none (any more)."""
+        i = bisect_right(self._firsts, sid) - 1
+        if i < 0:
+            return None
+        chunk = self._chunks[i]
+        j = chunk.find(sid)
+        if j < len(chunk.ms) and chunk.id(j) == sid:
+            return chunk.entry(j)
+        return None
+
+    def entries(self):
+        for chunk in self._chunks:
+            for j in range(chunk.start, len(chunk.ms)):
+                yield chunk.entry(j)
+
+    def chunks(self):
+        return len(self._chunks)
+
+    def dump(self):
+        """The stream as lists, ints and ID strings, for snapshots; load() turns it back."""
+        groups = [[name, formatid(group.lastid),
+                   [[name, consumer.seen] for name, consumer in group.consumers.items()],
+                   [[formatid(sid)] + nack for sid, nack in group.pending.items()]]
+                  for name, group in self.groups.items()]
+        return [formatid(self.lastid), list(self.entries()), groups]
+
+    @classmethod
+    def load(cls, state):
+        lastid, entries, groups = state
+        stream = cls()
+        for sid, flat in entries:
+            stream.add(parseid(sid), flat)
+        stream.lastid = parseid(lastid)
+        for name, grouplastid, consumers, pending in groups:
+            group = stream.groups[name] = ConsumerGroup(parseid(grouplastid))
+            for consumer, seen in consumers:
+                group.consumers[consumer] = Consumer(seen)
+            for sid, consumer, delivered, deliveries in pending:
+                sid = parseid(sid)
+                group.pending[sid] = [consumer, delivered, deliveries]
+                group.consumer(consumer, delivered).pending[sid] = None
+        return stream
+
+
+class Consumer(object):
+    __slots__ = ('pending', 'seen')
+
+    def __init__(self, seen):
+        self.pending = {}   # IDs of its pending entries (a dict as an insertion-ordered set).
+        self.seen = seen    # ms time it last read or claimed.
+
+
+class ConsumerGroup(object):
+    __slots__ = ('lastid', 'pending', 'consumers')
+
+    def __init__(self, lastid):
+        self.lastid = lastid
+        self.pending = {}       # ID -> [consumer name, ms time delivered, times delivered]
+        self.consumers = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __sizeof__(self):
+        return (object.__sizeof__(self) + PENDING_OVERHEAD * len(self.pending)
+                + CONSUMER_OVERHEAD * len(self.consumers))
+
+    def consumer(self, name, now):
+        """The consumer called name, created if new; it was seen now."""
+        consumer = self.consumers.get(name)
+        if consumer is None:
+            consumer = self.consumers[name] = Consumer(now)
+        consumer.seen = now
+        return consumer
+
+    def deliver(self, stream, name, count, noack, now):
+        """XREADGROUP >: up to count entries never delivered to the group, now pending for name."""
+        consumer = self.consumer(name, now)
+        ids = []
+        entries = stream.range(self.lastid + 1, MAXID, count, ids)
+        if not ids:
+            return entries
+        self.lastid = ids[-1]
+        if not noack:
+            pending, mine = self.pending, consumer.pending
+            for sid in ids:
+                nack = pending.get(sid)     # possible after XGROUP SETID went back.
+                if nack is not None and nack[0] != name:
+                    self.consumers[nack[0]].pending.pop(sid, None)
+                pending[sid] = [name, now, 1]
+                mine[sid] = None
+        return entries
+
+    def history(self, stream, name, startid, count, now):
+        """XREADGROUP with an ID: name's pending entries after startid; trimmed ones as [ID, None]."""
+        consumer = self.consumer(name, now)
+        ids = sorted([sid for sid in consumer.pending if sid > startid])
+        if count:
+            ids = ids[:count]
+        return [stream.get(sid) or [formatid(sid), None] for sid in ids]
+
+    def ack(self, ids):
+        acked = 0
+        for sid in ids:
+            nack = self.pending.pop(sid, None)
+            if nack is not None:
+                consumer = self.consumers.get(nack[0])
+                if consumer is not None:
+                    consumer.pending.pop(sid, None)
+                acked += 1
+        return acked
+
+    def claim(self, stream, name, minidle, ids, now, delivered, retrycount=None, force=False, justid=False):
+        """XCLAIM: give name the entries pending for minidle ms or more.
+
+        Returns (the entries, or IDs with justid; the IDs whose PEL entry changed).
+        """
+        consumer = self.consumer(name, now)
+        claimed, changed = [], []
+        for sid in ids:
+            nack = self.pending.get(sid)
+            if nack is None:
+                if not force or stream.get(sid) is None:
+                    continue
+                nack = self.pending[sid] = [name, delivered, 0]
+            elif now - nack[1] < minidle:
+                continue
+            if not justid:
+                entry = stream.get(sid)
+                if entry is None:   # trimmed away: nobody will ever read it, so it isn't pending.
+                    self.ack([sid])
+                    changed.append(sid)
+                    continue
+            if nack[0] != name:
+                owner = self.consumers.get(nack[0])
+                if owner is not None:
+                    owner.pending.pop(sid, None)
+                nack[0] = name
+            nack[1] = delivered
+            if retrycount is not None:
+                nack[2] = retrycount
+            elif not justid:
+                nack[2] += 1
+            consumer.pending[sid] = None
+            changed.append(sid)
+            claimed.append(formatid(sid) if justid else entry)
+        return claimed, changed
+
+    def summary(self):
+        """XPENDING key group: [count, smallest ID, greatest ID, [[consumer, count], ...]]."""
+        if not self.pending:
+            return [0, None, None, []]
+        return [len(self.pending), formatid(min(self.pending)), formatid(max(self.pending)),
+                [[name, len(consumer.pending)] for name, consumer in self.consumers.items() if consumer.pending]]
+
+    def pendingrange(self, start, end, count, now, consumer=None, minidle=0):
+        """XPENDING key group start end count: [[ID, consumer, idle ms, deliveries], ...]."""
+        if consumer is None:
+            source = self.pending
+        else:
+            source = self.consumers[consumer].pending if consumer in self.consumers else {}
+        out = []
+        for sid in sorted([sid for sid in source if start <= sid <= end]):
+            name, delivered, deliveries = self.pending[sid]
+            if now - delivered < minidle:
+                continue
+            out.append([formatid(sid), name, now - delivered, deliveries])
+            if len(out) >= count:
+                break
+        return out
+
+    def delconsumer(self, name):
+        """Forget consumer name and its pending entries; returns how many it had."""
+        consumer = self.consumers.pop(name, None)
+        if consumer is None:
+            return 0
+        for sid in consumer.pending:
+            self.pending.pop(sid, None)
+        return len(consumer.pending)
+
+
+class StreamRead(object):
+    """A parsed XREAD / XREADGROUP, kept while it waits for entries (as BlockedClient.move)."""
+    __slots__ = ('command', 'group', 'consumer', 'count', 'block', 'noack', 'keys', 'ids')
+
+    def __init__(self, command):
+        self.command = command
+        self.group = None
+        self.consumer = None
+        self.count = None
+        self.block = None       # seconds to wait, 0 for ever; None: answer at once.
+        self.noack = False
+        self.keys = []
+        self.ids = []           # per key: the ID to read after; None for XREADGROUP's >.
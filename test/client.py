@@ -2,7 +2,7 @@
 Test the server
 """
 
-import os, sys, logging
+import os, sys, logging, time, subprocess, tempfile
 import pickle
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
@@ -58,6 +58,85 @@ print(f"expecting 4, getting {client.llen('list1')}")
 
 print(client.lpush('newlist', 77))
 
+client.setlength('caplist', 3)
+client.rpush('caplist', 1, 2, 3, 4, 5)
+print(f"expecting [1, 2, 3], getting {client.get('caplist')}")
+client.lpush('caplist', 0)
+print(f"expecting [0, 1, 2], getting {client.get('caplist')}")
+
+client.set('shortlived', 'v', px=100)
+print(f"expecting 0, getting {client.ttl('shortlived')}")
+time.sleep(0.2)
+print(f"expecting None, getting {client.get('shortlived')}")
+
+client.rpush('jobs', 'job1')
+print(f"expecting ['jobs', 'job1'], getting {client.blpop('nojobs', 'jobs', timeout=1)}")
+
+client.delete('jobs')
+client.delete('processing')
+client.rpush('jobs', 'j1', 'j2', 'j3')
+print(f"expecting j1, getting {client.lmove('jobs', 'processing')}")
+print(f"expecting 1, getting {client.lrem('processing', 1, 'j1')}")
+print(f"expecting ['j2', 'j3'], getting {client.lpop('jobs', 500)}")
+
+client.delete('user:1')
+client.hset('user:1', 'name', 'ben', 'visits', 1)
+print(f"expecting 3, getting {client.hincrby('user:1', 'visits', 2)}")
+client.delete('board')
+client.zadd('board', 10, 'ann', 30, 'bob', 20, 'cat')
+print(f"expecting ['cat', 'bob'], getting {client.zrangebyscore('board', '(10', '+inf')}")
+client.delete('user:2')
+print(f"expecting [1, 1, 3], getting {client.pipeline(transaction=True).hset('user:2', 'a', 1).hlen('user:2').hincrby('user:2', 'a', 2).execute()}")
+
+subscriber = client.pubsub()
+subscriber.subscribe('greetings')
+subscriber.get_message(1)
+print(f"expecting 1, getting {client.publish('greetings', 'hi')}")
+print(f"expecting hi, getting {subscriber.get_message(1)['data']}")
+subscriber.close()
+
+print(f"expecting list, getting {client.type('processing')}")
+print(f"expecting ['user:1'], getting {client.keys('user:1*')}")
+print(f"expecting True, getting {client.latency_histogram('HSET')['HSET']['calls'] >= 1}")
+print(f"expecting True, getting {'role:master' in client.execute('INFO', 'replication')}")
+client.rpush('unlinked', *range(1000))
+print(f"expecting 1, getting {client.unlink('unlinked', 'never-set')}")
+
+cached = Client(cache_size=100)
+client.set('config:mode', 'fast')
+cached.get('config:mode')
+client.set('config:mode', 'safe')
+time.sleep(0.1)
+print(f"expecting safe, getting {cached.get('config:mode')}")
+cached.close()
+
+client.delete('job-stream')
+client.xgroup_create('job-stream', 'workers', '$', mkstream=True)
+client.xadd('job-stream', {'task': 'resize', 'image': 'a.png'})
+job = client.xreadgroup('workers', 'worker-1', {'job-stream': '>'}, count=10)[0][1][0]
+print(f"expecting ['task', 'resize', 'image', 'a.png'], getting {job[1]}")
+print(f"expecting 1, getting {client.xack('job-stream', 'workers', job[0])}")
+
+# A replica keeps the group's pending entries too, so a failover doesn't redeliver them.
+replica_server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server.py'),
+                                   '--port', '31338', '--replicaof', '127.0.0.1:31337', '--dbfilename', os.path.join(tempfile.mkdtemp(), 'dump.mrdb')])
+time.sleep(1)
+replica = Client(port=31338)
+while 'master_link_status:up' not in replica.execute('INFO', 'replication'):
+    time.sleep(0.1)
+client.xadd('job-stream', {'task': 'crop', 'image': 'b.png'})
+client.xreadgroup('workers', 'worker-1', {'job-stream': '>'})
+time.sleep(0.2)
+print(f"expecting {client.xpending('job-stream', 'workers')}, getting {replica.xpending('job-stream', 'workers')}")
+replica.close()
+replica_server.terminate()
+replica_server.wait()
+
+client.unlink('visitors', 'seen')
+client.pfadd('visitors', *[f'user:{i}' for i in range(1000)])
+print(f"expecting True, getting {980 <= client.pfcount('visitors') <= 1020}")
+print(f"expecting [1, 0], getting {client.bf_madd('seen', 'job:2', 'job:2')}")
+
 logging.info("Done")
 
 # testing bytes